@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+'''a low-level fastcgi server on asyncio (trollius on python 2), any
+event loop implementation may be used (e.g.: uvloop)
+
+handlers are called as usual, handler(request, type, content), but
+may also return a coroutine (or a future), the request goes on when
+it is done, as if the handler returned its result. the events of a
+request wait for the coroutine of the previous one, so they are still
+handled in order, other requests are handled meanwhile. generators
+are taken for coroutines, to stream a response from one a handler
+calls request.stream(generator) instead of returning it
+
+    @asyncio.coroutine
+    def handler(request, type, content):
+        if type == fastcgi.FCGI_PARAMS:
+            rows = yield From(query(request.params['QUERY_STRING']))
+            for row in rows:
+                request.write(row)
+                # wait while the web server is slower than us
+                yield From(request.drain())
+        ...
+
+request.drain() is a future that is done once the transport of the
+request connection accepts more output, the connection is not read
+meanwhile, nor while the input waiting for the handlers is above the
+watermarks (see FastCGIConnectionState.readingPaused)
+'''
+
+import sys
+import socket
+import traceback
+import collections
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import fastcgi
+
+FastCGIConnectionState = fastcgi.FastCGIConnectionState
+LazyRecords = fastcgi.LazyRecords
+isIterator = fastcgi.isIterator
+asString = fastcgi.asString
+
+def _isAwaitable(result):
+    return asyncio.iscoroutine(result) or isinstance(result, asyncio.Future)
+
+class CoroutineExecutor(object):
+    '''calls handlers in the event loop and runs the coroutines they
+    return, see fastcgi.FastCGIProcessor.executor
+    '''
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiting = {}       # request state -> events waiting for its coroutine
+
+    def dispatch(self, requestState, function, *args):
+        # args are the handler and its arguments, function is not
+        # used, it does not know about coroutines
+        handler, requestState, type, content = args
+        waiting = self.waiting.get(requestState)
+        if waiting is not None:
+            waiting.append((handler, type, content))
+        else:
+            self.call(handler, requestState, type, content)
+
+    def call(self, handler, requestState, type, content):
+        requestState.callCount += 1
+        if content:
+            requestState.inputHandled(len(content))
+        if requestState.streaming or requestState.shed or requestState.dropped:
+            # see FastCGIProcessor.callHandler
+            return
+        if requestState.cancelled and type != fastcgi.FCGI_ABORT_REQUEST:
+            return
+        try:
+            result = handler(requestState, type, content)
+        except Exception, err:
+            self.failed(requestState, err)
+            return
+
+        if _isAwaitable(result):
+            self.waiting[requestState] = collections.deque()
+            task = asyncio.ensure_future(result, loop=self.loop)
+            task.add_done_callback(lambda task: self.done(requestState, task))
+            requestState.addCancelCallback(lambda requestState: task.cancel())
+        elif isIterator(result):
+            requestState.stream(result)
+        elif not result:
+            requestState.end(0)
+
+    def done(self, requestState, task):
+        waiting = self.waiting.pop(requestState)
+        if task.cancelled():
+            requestState.end(1)
+            return
+        err = task.exception()
+        if err is not None:
+            self.failed(requestState, err)
+            return
+        result = task.result()
+        if isIterator(result):
+            requestState.stream(result)
+        elif not result:
+            requestState.end(0)
+
+        while waiting:
+            handler, type, content = waiting.popleft()
+            self.call(handler, requestState, type, content)
+            if requestState in self.waiting:
+                # another coroutine, the rest waits for it
+                self.waiting[requestState].extend(waiting)
+                break
+
+    def failed(self, requestState, err):
+        print 'processor: exception occurred while handling request id %i, exception: %s' % (
+            requestState.requestId, str(err))
+        if sys.exc_info()[1] is err:
+            traceback.print_exc(file=sys.stdout)
+        requestState.end(1)
+
+class FastCGIProtocol(asyncio.Protocol):
+    '''handles a connection with the web server
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.connectionState = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.processor = self.server.fcgiProcessor
+        self.server.connections.add(self)
+
+        self.paused = False             # transport buffer is full
+        self.readPaused = False
+        self.drainWaiters = []
+        self.pendingOutput = collections.deque()    # output behind LazyRecords
+        self.closing = False
+
+        self.connectionState = FastCGIConnectionState(self.loseConnection, self.write, drain=self.drain)
+        self.connectionState.resumeReading = self.checkBackpressure
+
+    def write(self, data):
+        if self.pendingOutput or isinstance(data, LazyRecords):
+            # files are read a record at a time, as the transport
+            # takes them
+            self.pendingOutput.append(data)
+            self.writePending()
+        else:
+            self.transport.write(asString(data))
+
+    def writePending(self):
+        pendingOutput = self.pendingOutput
+        while pendingOutput and not self.paused:
+            data = pendingOutput[0]
+            if isinstance(data, LazyRecords):
+                self.transport.write(data.read())
+                if len(data):
+                    continue
+                data.done()
+            else:
+                self.transport.write(asString(data))
+            pendingOutput.popleft()
+
+        if self.closing and not pendingOutput:
+            self.transport.close()
+
+    def loseConnection(self):
+        # with pending output, the connection is closed once it is written
+        self.closing = True
+        if not self.pendingOutput:
+            self.transport.close()
+
+    def drain(self):
+        '''a future that is done once the transport accepts more output
+        '''
+        if self.connectionState:
+            # corked output counts
+            self.connectionState.flush()
+
+        future = asyncio.Future(loop=self.server.loop)
+        if self.paused and self.connectionState:
+            self.drainWaiters.append(future)
+        else:
+            future.set_result(None)
+        return future
+
+    def pause_writing(self):
+        self.paused = True
+        self.checkBackpressure()
+
+    def resume_writing(self):
+        self.paused = False
+        self.writePending()
+        self.wakeDrainWaiters()
+        self.checkBackpressure()
+
+    def checkBackpressure(self):
+        cs = self.connectionState
+        if cs is None or self.closing:
+            return
+        unsent = self.transport.get_write_buffer_size()
+        if cs.scheduler is not None:
+            # output waits in the scheduler, the other requests of the
+            # connection are still read
+            cs.setUnsentOutput(unsent + len(cs.scheduler))
+            paused = cs.readingPaused()
+        else:
+            cs.setUnsentOutput(unsent)
+            paused = cs.readingPaused() or self.paused
+        if paused != self.readPaused:
+            self.readPaused = paused
+            if paused:
+                self.transport.pause_reading()
+            else:
+                self.transport.resume_reading()
+
+    def wakeDrainWaiters(self):
+        drainWaiters = self.drainWaiters
+        self.drainWaiters = []
+        for future in drainWaiters:
+            if not future.done():
+                future.set_result(None)
+
+    def data_received(self, data):
+        cs = self.connectionState
+        cs.cork()
+        try:
+            self.processor.processRawInput(cs, data)
+            self.processor.generateOutput(self.server.handler)
+        finally:
+            cs.uncork()
+        self.checkBackpressure()
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        for data in self.pendingOutput:
+            if isinstance(data, LazyRecords):
+                data.done()
+        self.pendingOutput.clear()
+        self.connectionState.cleanup()
+        self.connectionState = None
+        self.processor = None
+        # writes of waiting handlers are dropped from now on
+        self.wakeDrainWaiters()
+
+class FastCGIServer(object):
+    '''the protocol factory, e.g.:
+
+        server = FastCGIServer(handler)
+        loop.run_until_complete(server.listen(('127.0.0.1', 8030)))
+        loop.run_forever()
+    '''
+
+    def __init__(self, handler, loop=None):
+        self.handler = handler
+        self.loop = loop or asyncio.get_event_loop()
+        self.connections = set()
+
+        self.fcgiProcessor = fastcgi.FastCGIProcessor()
+        self.fcgiProcessor.executor = CoroutineExecutor(self.loop)
+        # for fcgiProcessor.requestTimeout
+        self.fcgiProcessor.callLater = self.loop.call_later
+
+    def __call__(self):
+        return FastCGIProtocol(self)
+
+    def listen(self, address, backlog=100):
+        '''a coroutine creating an asyncio server, address is a (host,
+        port) tuple, a unix socket path, a listening socket or its
+        file descriptor (e.g.: fastcgi.FCGI_LISTENSOCK_FILENO)
+        '''
+        if isinstance(address, int):
+            address = socket.fromfd(address, socket.AF_INET, socket.SOCK_STREAM)
+        if isinstance(address, (str, unicode)):
+            return self.loop.create_unix_server(self, address, backlog=backlog)
+        if isinstance(address, tuple):
+            return self.loop.create_server(self, address[0], address[1], backlog=backlog)
+        return self.loop.create_server(self, sock=address, backlog=backlog)
+
+    def run(self, address):
+        '''serve on address until the loop is stopped
+        '''
+        server = self.loop.run_until_complete(self.listen(address))
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
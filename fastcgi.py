@@ -11,15 +11,24 @@ Copyright Alexandre Girão <alexgirao@gmail.com> 2008, 2007
 '''
 
 import sys
+import os
+import time
+import errno
+import mmap
 import struct
 import socket
+import threading
 import pprint
 import traceback
 import random
 import cStringIO
+import collections
+import cgi
+import urlparse
 
 _pack = struct.pack
 _unpack = struct.unpack
+_sendfile = getattr(os, 'sendfile', None)
 
 #
 
@@ -82,14 +91,27 @@ FCGI_BeginRequestBody_STRUCT_LENGTH = struct.calcsize(FCGI_BeginRequestBody)
 FCGI_EndRequestBody_STRUCT_LENGTH = struct.calcsize(FCGI_EndRequestBody)
 FCGI_UnknownTypeBody_STRUCT_LENGTH = struct.calcsize(FCGI_UnknownTypeBody)
 
+# precompiled structures, used to parse records straight from input buffers
+
+_headerStruct = struct.Struct(FCGI_Header)
+_lengthsStruct = struct.Struct("!HB")    # contentLength and paddingLength
+_pairLengthStruct = struct.Struct("!I")  # name-value pair long length
+
+# records are padded to multiples of 8 bytes, as recommended by the spec
+_padding = ['\0' * i for i in xrange(8)]
+
 # Constants
 
 FCGI_LISTENSOCK_FILENO = 0      # listening socket file number
 FCGI_HEADER_LEN = 8             # number of bytes in a FCGI_Header
 FCGI_VERSION_1 = 1              # value for version component of FCGI_Header
+FCGI_MAX_CONTENT_LEN = 0xffff   # contentLength component of FCGI_Header is 16 bits
 
 assert FCGI_HEADER_LEN == FCGI_Header_STRUCT_LENGTH
 
+# larger stream output is split in records of this size, which needs no padding
+_maxChunk = FCGI_MAX_CONTENT_LEN & ~7
+
 # Values for type component of FCGI_Header
 FCGI_BEGIN_REQUEST      = 1
 FCGI_ABORT_REQUEST      = 2
@@ -187,22 +209,38 @@ def writePair(name, value):
 
     return data + name + value
 
-def readPair(data, pos):
-    """read a fastcgi name-value pair"""
+def readPairLengths(data, pos, end):
+    """read the lengths of a fastcgi name-value pair, returns
+    (nameLength, valueLength, pos) or None if data ends before
+    """
+    if pos >= end:
+        return None
     namelen = ord(data[pos])
     if namelen & 0x80:
-        namelen = _unpack("!I", data[pos:pos + 4])[0] & 0x7fffffff
+        if pos + 4 > end:
+            return None
+        namelen = _pairLengthStruct.unpack_from(data, pos)[0] & 0x7fffffff
         pos += 4
     else:
         pos += 1
 
+    if pos >= end:
+        return None
     valuelen = ord(data[pos])
     if valuelen & 0x80:
-        valuelen = _unpack("!I", data[pos:pos + 4])[0] & 0x7fffffff
+        if pos + 4 > end:
+            return None
+        valuelen = _pairLengthStruct.unpack_from(data, pos)[0] & 0x7fffffff
         pos += 4
     else:
         pos += 1
 
+    return namelen, valuelen, pos
+
+def readPair(data, pos):
+    """read a fastcgi name-value pair"""
+    namelen, valuelen, pos = readPairLengths(data, pos, len(data))
+
     name = data[pos:pos + namelen]
     pos += namelen
     
@@ -211,6 +249,92 @@ def readPair(data, pos):
 
     return name, value, pos
 
+class PairReader(object):
+    '''incremental fastcgi name-value pairs decoder, a pair may be
+    split across any number of records (e.g.: nginx does this with
+    large FCGI_PARAMS)
+    '''
+
+    def __init__(self):
+        self.head = ''          # incomplete lengths of a split pair
+        self.nameLength = 0
+        self.pieces = None      # name and value bytes of a split pair
+        self.missing = 0        # bytes still missing to complete it
+
+    def incomplete(self):
+        '''true if a split pair is waiting for more data
+        '''
+        return bool(self.head) or self.pieces is not None
+
+    def feed(self, data, views=False):
+        '''decode data (string or bytes-like), returns a list of
+        complete (name, value) pairs, with views set the values are
+        memoryview slices of data, except for pairs split across calls
+        '''
+        pairs = []
+        view = memoryview(data)
+        pos = 0
+        end = len(view)
+
+        if self.head or self.pieces is not None:
+            pos = self._resume(view, pos, end, pairs)
+
+        while pos < end:
+            lengths = readPairLengths(view, pos, end)
+            if lengths is None:
+                self.head = view[pos:end].tobytes()
+                break
+
+            namelen, valuelen, p = lengths
+            npos = p + namelen + valuelen
+            if npos > end:
+                self.nameLength = namelen
+                self.pieces = [view[p:end].tobytes()]
+                self.missing = npos - end
+                break
+
+            vpos = p + namelen
+            value = view[vpos:npos]
+            if not views:
+                value = value.tobytes()
+            pairs.append((view[p:vpos].tobytes(), value))
+            pos = npos
+
+        return pairs
+
+    def _resume(self, view, pos, end, pairs):
+        # complete the pair split at a previous record
+
+        if self.pieces is None:
+            # lengths are at most 8 bytes long, complete them
+            head = self.head
+            while pos < end:
+                head += view[pos]
+                pos += 1
+                lengths = readPairLengths(head, 0, len(head))
+                if lengths is not None:
+                    self.head = ''
+                    self.nameLength = lengths[0]
+                    self.pieces = []
+                    self.missing = lengths[0] + lengths[1]
+                    break
+            else:
+                self.head = head
+                return pos
+
+        take = min(self.missing, end - pos)
+        if take:
+            self.pieces.append(view[pos:pos + take].tobytes())
+            self.missing -= take
+            pos += take
+
+        if not self.missing:
+            pair = ''.join(self.pieces)
+            pairs.append((pair[:self.nameLength], pair[self.nameLength:]))
+            self.pieces = None
+
+        return pos
+
 def splitRecords(data, pos=0):
     r = []
     datalen = len(data)
@@ -279,32 +403,817 @@ def makeDiscreteRecord(type, requestId, discreteStruct, *discreteValues):
 def makeStreamRecord(type, requestId, data):
     return '%s%s' % (_pack(FCGI_Header, 1, type, requestId, len(data), 0), data)
 
+def asString(data):
+    '''returns a string with the contents of a bytes-like object
+    '''
+    if isinstance(data, str):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(data)
+
+def sliceBuffer(data, size):
+    '''split a bytes-like object in slices of at most size bytes
+    without copying
+    '''
+    length = len(data)
+    try:
+        view = memoryview(data)
+    except TypeError:
+        # e.g.: mmap only implements the old buffer interface
+        return [buffer(data, pos, size) for pos in xrange(0, length, size)]
+    return [view[pos:pos + size] for pos in xrange(0, length, size)]
+
+class LazyRecords(object):
+    '''output made as transports take it instead of written at once,
+    transports send it with sendTo(sock) or with read(), len() is the
+    amount of bytes still to be sent, not 0 until it is all sent, done()
+    drops the rest. read() returns whole records (header, payload and
+    padding), one or more, so the output of other requests may go in
+    between (see OutputScheduler), '' if there is none yet. this base
+    has nothing to send
+    '''
+
+    def __len__(self):
+        return 0
+
+    def sendTo(self, sock):
+        '''send as much as possible to a connected socket without
+        blocking, returns the amount of bytes sent
+        '''
+        return 0
+
+    def read(self):
+        return ''
+
+    def done(self):
+        pass
+
+class FileRecords(LazyRecords):
+    '''stream records whose content is a region of a file, sendTo()
+    sends the payload straight from the file to the socket
+    '''
+
+    def __init__(self, header, fileobj, offset, count, close=False):
+        self.header = header            # cached version, type and requestId
+        self.file = fileobj
+        self.offset = offset            # next payload byte
+        self.count = count              # payload bytes left
+        self.close = close              # close file when done
+
+        self.pending = ''               # padding and header not yet sent
+        self.chunk = 0                  # payload bytes left for the current record
+        self.trailer = ''               # padding of the current record
+        self.map = None
+
+        records = (count + _maxChunk - 1) // _maxChunk
+        self.size = count + records * FCGI_HEADER_LEN + (-count & 7)
+
+    def __len__(self):
+        return self.size
+
+    def _next(self):
+        # queue the next record header
+        length = min(self.count, _maxChunk)
+        padding = -length & 7
+        self.pending += _pack(FCGI_HeaderCached, self.header, length, padding)
+        self.chunk = length
+        self.trailer = _padding[padding]
+
+    def _consumed(self, amount):
+        self.offset += amount
+        self.count -= amount
+        self.chunk -= amount
+        self.size -= amount
+        if not self.chunk:
+            # the record padding goes out with the next record header
+            self.pending = self.trailer
+            self.trailer = ''
+            if self.count:
+                self._next()
+
+    def _map(self):
+        if self.map is None:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def sendTo(self, sock):
+        '''send as much as possible to a connected socket without
+        blocking, returns the amount of bytes sent
+        '''
+        total = 0
+        try:
+            while self.size:
+                if not self.pending and not self.chunk:
+                    self._next()
+
+                if self.pending:
+                    sent = sock.send(self.pending)
+                    self.pending = self.pending[sent:]
+                    self.size -= sent
+                    total += sent
+                    if self.pending:
+                        break
+                    continue
+
+                if _sendfile:
+                    sent = _sendfile(sock.fileno(), self.file.fileno(), self.offset, self.chunk)
+                else:
+                    # no sendfile(2), send straight from a memory map
+                    sent = sock.send(buffer(self._map(), self.offset, self.chunk))
+                if not sent:
+                    raise IOError('%r ended before the expected size' % self.file)
+                self._consumed(sent)
+                total += sent
+        except (socket.error, OSError), err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        if not self.size:
+            self.done()
+        return total
+
+    def read(self):
+        '''returns the next record (header, payload and padding) as a
+        string, the header of the one after is left for the next call
+        '''
+        if not self.size:
+            return ''
+        if not self.pending and not self.chunk:
+            self._next()
+        # the header, after the padding of the previous record when
+        # sendTo() sent it
+        header = self.pending
+        chunk = self.chunk
+        payload = self._map()[self.offset:self.offset + chunk]
+        if len(payload) != chunk:
+            raise IOError('%r ended before the expected size' % self.file)
+        data = header + payload + self.trailer
+        self.offset += chunk
+        self.count -= chunk
+        self.chunk = 0
+        self.pending = self.trailer = ''
+        self.size -= len(data)
+        if not self.size:
+            self.done()
+        return data
+
+    def done(self):
+        '''release the file, may be called early to abort
+        '''
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.close and self.file is not None:
+            self.file.close()
+        self.file = None
+        self.size = 0
+
+def isIterator(result):
+    '''true for handler results that stream the response (e.g.: a
+    generator), see FastCGIRequestState.stream
+    '''
+    return hasattr(result, 'next')
+
+class IteratorRecords(LazyRecords):
+    '''the output of a streaming request (see FastCGIRequestState.stream),
+    the iterator is pulled as the transport takes
+    output, len() is not 0 until it is exhausted and its records are sent
+    '''
+
+    # chunks are pulled until there is this much output to send
+    chunkSize = 65536
+
+    def __init__(self, requestState, iterator):
+        self.requestState = requestState
+        self.iterator = iterator
+        self.pending = []               # records of the request, end included
+        self.size = 0                   # bytes in pending
+
+    def __len__(self):
+        return self.size + (self.iterator is not None)
+
+    def append(self, *pieces):
+        # the request writes here while streaming
+        for data in pieces:
+            if isinstance(data, LazyRecords):
+                while len(data):
+                    data = data.read()
+                    self.pending.append(data)
+                    self.size += len(data)
+                continue
+            data = asString(data)
+            self.pending.append(data)
+            self.size += len(data)
+
+    def _pull(self):
+        requestState = self.requestState
+        while self.iterator is not None and self.size < self.chunkSize:
+            if requestState.ended:
+                # aborted
+                self.done()
+                break
+            try:
+                chunk = self.iterator.next()
+            except StopIteration:
+                self.iterator = None
+                requestState.end(0)
+            except Exception, err:
+                print 'processor: exception occurred while streaming request id %i, exception: %s' % (
+                    requestState.requestId, str(err))
+                traceback.print_exc(file=sys.stdout)
+                self.iterator = None
+                requestState.end(1)
+            else:
+                requestState.write(chunk)
+
+    def sendTo(self, sock):
+        total = 0
+        try:
+            while 1:
+                self._pull()
+                if not self.size:
+                    break
+                data = ''.join(self.pending)
+                self.pending = []
+                sent = sock.send(data)
+                self.size -= sent
+                total += sent
+                if sent < len(data):
+                    self.pending.append(data[sent:])
+                    break
+        except socket.error, err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return total
+
+    def read(self):
+        self._pull()
+        data = ''.join(self.pending)
+        self.pending = []
+        self.size = 0
+        return data
+
+    def done(self):
+        '''stop pulling the iterator, e.g.: the connection was lost
+        '''
+        iterator = self.iterator
+        self.iterator = None
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+class _RequestOutput(object):
+    # the output of a request queued by OutputScheduler, split in
+    # records, so those of different requests are interleaved and
+    # never mixed
+
+    def __init__(self, scheduler, requestState):
+        self.scheduler = scheduler
+        self.requestState = requestState
+        self.records = collections.deque()  # lists of pieces and LazyRecords
+        self.left = 0                   # bytes until the last record is complete
+        self.deficit = 0                # bytes it may send this round
+        self.active = False             # in one of the scheduler lists
+
+    def append(self, *pieces):
+        # the request writes here, see FastCGIRequestState.writeTransport
+        records = self.records
+        for data in pieces:
+            if isinstance(data, LazyRecords):
+                records.append(data)
+                continue
+            pos = 0
+            length = len(data)
+            self.scheduler.backlog += length
+            while pos < length:
+                if not self.left:
+                    contentLength, paddingLength = _lengthsStruct.unpack_from(data, pos + 4)
+                    self.left = FCGI_HEADER_LEN + contentLength + paddingLength
+                    records.append([])
+                size = min(self.left, length - pos)
+                records[-1].append(data if size == length else data[pos:pos + size])
+                self.left -= size
+                pos += size
+        self.scheduler.activate(self)
+
+    def pop(self):
+        # the pieces of the next records, None if there are none
+        records = self.records
+        while records:
+            record = records[0]
+            if isinstance(record, LazyRecords):
+                data = record.read()
+                if not len(record):
+                    records.popleft()
+                if data:
+                    return [data]
+                continue
+            if self.left and len(records) == 1:
+                # not complete yet
+                return None
+            for data in record:
+                self.scheduler.backlog -= len(data)
+            return records.popleft()
+        return None
+
+    def done(self):
+        for record in self.records:
+            if isinstance(record, LazyRecords):
+                record.done()
+        self.records.clear()
+
+class OutputScheduler(LazyRecords):
+    '''shares the output of a multiplexed connection among its requests
+    (see FastCGIProcessor.fairOutput), records
+    are taken from the requests as the transport takes output, by
+    deficit round robin with quantum * request.priority bytes per round,
+    requests that had nothing to send go first, so short responses and
+    the end of requests are not stuck behind a large one
+    '''
+
+    quantum = 65536                 # the largest record fits in
+    # records are taken until there is this much output to send
+    chunkSize = 65536
+
+    def __init__(self, connectionState):
+        self.connectionState = connectionState
+        self.newFlows = collections.deque()     # requests that were idle
+        self.oldFlows = collections.deque()
+        self.pending = collections.deque()      # output taken, not yet sent
+        self.size = 0                           # bytes in pending
+        self.backlog = 0                        # bytes the requests wrote, files aside
+        self.queued = False                     # given to the transport
+
+    def __len__(self):
+        return self.size + self.backlog + len(self.newFlows) + len(self.oldFlows)
+
+    def output(self, requestState):
+        '''a writeTransport for requestState
+        '''
+        return _RequestOutput(self, requestState).append
+
+    def activate(self, flow):
+        if not flow.active:
+            # a quantum first, the priority counts from the next round
+            flow.active = True
+            flow.deficit = self.quantum
+            self.newFlows.append(flow)
+        if not self.queued and self.connectionState:
+            self.queued = True
+            self.connectionState.write(self)
+
+    def _next(self):
+        # the records of the next request in turn, None if there are none
+        while 1:
+            flows = self.newFlows or self.oldFlows
+            if not flows:
+                return None
+            flow = flows[0]
+            if flow.deficit <= 0:
+                # its turn is over
+                flow.deficit += self.quantum * flow.requestState.priority
+                flows.popleft()
+                self.oldFlows.append(flow)
+                continue
+            record = flow.pop()
+            if record is None:
+                flows.popleft()
+                flow.active = False
+                continue
+            for data in record:
+                flow.deficit -= len(data)
+            return record
+
+    def _fill(self):
+        pending = self.pending
+        strings = []
+        while self.size < self.chunkSize:
+            record = self._next()
+            if record is None:
+                break
+            for data in record:
+                self.size += len(data)
+                if type(data) is str:
+                    strings.append(data)
+                    continue
+                if strings:
+                    pending.append(''.join(strings))
+                    strings = []
+                pending.append(data)
+        if strings:
+            pending.append(''.join(strings))
+
+    def sendTo(self, sock):
+        total = 0
+        pending = self.pending
+        try:
+            while 1:
+                if not pending:
+                    self._fill()
+                    if not pending:
+                        break
+                data = pending[0]
+                sent = sock.send(data)
+                self.size -= sent
+                total += sent
+                if sent < len(data):
+                    pending[0] = data[sent:] if type(data) is str else memoryview(data)[sent:]
+                    break
+                pending.popleft()
+        except socket.error, err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        if not len(self):
+            # the transport drops it, activate() gives it back
+            self.queued = False
+        return total
+
+    def read(self):
+        self._fill()
+        data = ''.join([asString(data) for data in self.pending])
+        self.pending.clear()
+        self.size = 0
+        if not len(self):
+            self.queued = False
+        return data
+
+    def done(self):
+        '''drop the output left, e.g.: the connection was lost
+        '''
+        for flows in (self.newFlows, self.oldFlows):
+            for flow in flows:
+                flow.done()
+                flow.active = False
+            flows.clear()
+        self.pending.clear()
+        self.size = self.backlog = 0
+        self.queued = False
+
+class CoDelShedder(object):
+    '''load shedding after CoDel (controlled delay): the delay a request
+    waits for its handler is fine in bursts, but once even the shortest
+    delay of an interval is above target there is a standing queue, then
+    the requests that waited more than target are shed (answered at once)
+    until the delay is back below target, so overload ends in fast 503s
+    instead of timeouts (see FastCGIProcessor.shedder)
+    '''
+
+    def __init__(self, target=0.05, interval=0.5):
+        self.target = target            # seconds
+        self.interval = interval
+        self.intervalEnd = None
+        self.minDelay = None            # shortest delay of this interval
+        self.dropping = False
+        self.lock = threading.Lock()    # handlers may run in threads, see FastCGIProcessor.executor
+
+    def shed(self, delay, now):
+        '''true if a request that waited delay seconds is to be shed,
+        from any thread
+        '''
+        self.lock.acquire()
+        try:
+            if self.intervalEnd is None:
+                self.intervalEnd = now + self.interval
+            if self.minDelay is None or delay < self.minDelay:
+                self.minDelay = delay
+
+            if now >= self.intervalEnd:
+                # an interval without requests is no standing queue
+                self.dropping = self.minDelay > self.target and now < self.intervalEnd + self.interval
+                self.minDelay = None
+                self.intervalEnd = now + self.interval
+
+            return self.dropping and delay > self.target
+        finally:
+            self.lock.release()
+
+class Lane(object):
+    '''a share of the handler capacity kept for some requests (a
+    bulkhead, see FastCGIProcessor.lanes), so a slow class of requests
+    (e.g.: exports) cannot take the capacity others need (e.g.: health
+    checks). a request belongs to the first lane with a prefix of the
+    path segments of its SCRIPT_NAME or REQUEST_URI, or with its role, a
+    lane with neither takes any request
+
+    at most concurrency requests of a lane run at once (0 is no limit),
+    up to queueSize more wait for one of them to end, their events are
+    held meanwhile, the requests above that are answered like shed ones
+    (see FastCGIProcessor.shedRequest). the handlers of a lane run in
+    executor, the one of the processor when None
+    '''
+
+    def __init__(self, name, prefixes=(), roles=(), concurrency=0, queueSize=0, executor=None):
+        self.name = name
+        self.prefixes = tuple(prefixes)
+        self.roles = frozenset(roles)
+        self.concurrency = concurrency
+        self.queueSize = queueSize
+        self.executor = executor
+
+        self.running = 0
+        self.waiting = collections.deque()  # request states, in arrival order
+        self.held = {}                      # request state -> (processor, handler, event)s
+        self.starting = False
+        self.shedCount = 0
+
+    def __repr__(self):
+        return '<Lane %s running=%i waiting=%i shed=%i>' % (
+            self.name, self.running, len(self.waiting), self.shedCount)
+
+    def match(self, requestState):
+        if not self.prefixes and not self.roles:
+            return True
+        if requestState.role in self.roles:
+            return True
+        if self.prefixes:
+            params = requestState.params
+            for name in ('SCRIPT_NAME', 'REQUEST_URI'):
+                if self.matchPath(params.get(name, '')):
+                    return True
+        return False
+
+    def matchPath(self, path):
+        # a prefix matches whole segments: '/export' matches '/export',
+        # '/export/a' and '/export?a', not '/exporter'
+        for prefix in self.prefixes:
+            if path.startswith(prefix) and (len(path) == len(prefix) or
+                    prefix.endswith('/') or path[len(prefix)] in '/?'):
+                return True
+        return False
+
+    def dispatch(self, processor, handler, item):
+        '''handle an event of a request of this lane, item is a
+        (requestState, type, content) tuple
+        '''
+        requestState = item[0]
+        held = self.held.get(requestState)
+        if held is not None:
+            held.append((processor, handler, item))
+            return
+
+        if item[1] == FCGI_PARAMS:
+            # the first event
+            if self.concurrency and self.running >= self.concurrency:
+                if len(self.waiting) >= self.queueSize:
+                    self.shedCount += 1
+                    requestState.lane = None
+                    processor.shedRequest(requestState)
+                    return
+                self.waiting.append(requestState)
+                self.held[requestState] = [(processor, handler, item)]
+                return
+            self.running += 1
+        self.call(processor, handler, item)
+
+    def call(self, processor, handler, item):
+        executor = self.executor or processor.executor
+        if executor:
+            executor.dispatch(item[0], processor.callHandler, handler, *item)
+        else:
+            processor.callHandler(handler, *item)
+
+    def release(self, requestState):
+        '''requestState ended, the next waiting request runs, see
+        FastCGIRequestState.end
+        '''
+        if self.held.pop(requestState, None) is not None:
+            # it never ran, nothing to tell its handler (e.g.: an abort)
+            self.waiting.remove(requestState)
+            requestState.dropped = True
+            return
+
+        self.running -= 1
+        if self.starting:
+            # it ended right away, the loop below goes on
+            return
+        self.starting = True
+        try:
+            while self.waiting and self.running < self.concurrency:
+                requestState = self.waiting.popleft()
+                self.running += 1
+                for processor, handler, item in self.held.pop(requestState):
+                    self.call(processor, handler, item)
+        finally:
+            self.starting = False
+
+    def stop(self):
+        if self.executor:
+            self.executor.stop()
+
 def dictToPairs(d):
     r = []
     for k, v in d.items():
         r.append(writePair(k,str(v)))
     return r
 
+class cachedproperty(object):
+    '''a property computed on first access, the result is kept at
+    instance._cache until it is cleared
+    '''
+
+    def __init__(self, compute):
+        self.compute = compute
+        self.name = compute.__name__
+        self.__doc__ = compute.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return instance._cache[self.name]
+        except KeyError:
+            value = instance._cache[self.name] = self.compute(instance)
+            return value
+
+class FastCGIEnvironment(collections.MutableMapping):
+    '''the request environment (FCGI_PARAMS), values are kept as views
+    of the raw records and only decoded when accessed, parsed views
+    of common variables are computed once
+    '''
+
+    def __init__(self):
+        self._values = {}       # name -> memoryview (raw) or string (decoded)
+        self._cache = {}
+        self._reader = None
+
+    def feed(self, content):
+        '''index a FCGI_PARAMS record content
+        '''
+        if self._reader is None:
+            self._reader = PairReader()
+        if not isinstance(content, str):
+            # the record must outlive the input buffer it came from
+            content = content.tobytes()
+        self._values.update(self._reader.feed(content, True))
+        self._cache.clear()
+
+    def close(self):
+        '''end of FCGI_PARAMS stream, returns false if the last pair
+        is incomplete
+        '''
+        reader = self._reader
+        self._reader = None
+        return not (reader and reader.incomplete())
+
+    def __getitem__(self, name):
+        value = self._values[name]
+        if type(value) is memoryview:
+            value = self._values[name] = value.tobytes()
+        return value
+
+    def __setitem__(self, name, value):
+        self._values[name] = value
+        self._cache.clear()
+
+    def __delitem__(self, name):
+        del self._values[name]
+        self._cache.clear()
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    @cachedproperty
+    def queryArgs(self):
+        '''QUERY_STRING as a dict of lists of values
+        '''
+        return urlparse.parse_qs(self.get('QUERY_STRING', ''), keep_blank_values=True)
+
+    @cachedproperty
+    def cookies(self):
+        '''HTTP_COOKIE as a dict, the first occurrence of a name wins
+        '''
+        cookies = {}
+        for item in self.get('HTTP_COOKIE', '').split(';'):
+            name, _, value = item.partition('=')
+            name = name.strip()
+            if name and name not in cookies:
+                cookies[name] = value.strip()
+        return cookies
+
+    @cachedproperty
+    def contentType(self):
+        '''CONTENT_TYPE as (lowercase mime type, dict of parameters)
+        '''
+        mimetype, params = cgi.parse_header(self.get('CONTENT_TYPE', ''))
+        return mimetype.lower(), params
+
+    @cachedproperty
+    def charset(self):
+        '''charset parameter of CONTENT_TYPE or None
+        '''
+        return self.contentType[1].get('charset')
+
+    @cachedproperty
+    def acceptEncodings(self):
+        '''HTTP_ACCEPT_ENCODING as a list of codings, preferred first,
+        codings with q=0 are omitted
+        '''
+        codings = []
+        for item in self.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            parts = item.split(';')
+            coding = parts[0].strip().lower()
+            q = 1.0
+            for param in parts[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if coding and q > 0:
+                codings.append((q, coding))
+        codings.sort(key=lambda c: -c[0])
+        return [c[1] for c in codings]
+
 ## FastCGI Classes
 #
+# - FastCGIEnvironment      - lazy request params
 # - FastCGIConnectionState
 # - FastCGIRequestState     - the request state, request specific information
 # - FastCGIProcessor        - manages requests, detached from protocol to allow multiplexing
 #
 
 class FastCGIConnectionState(object):
-    def __init__(self, loseConnection, writeTransport):
+
+    # queued output is written as soon as it reaches this size
+    outputThreshold = 65536
+
+    # read backpressure (see readingPaused), transports stop reading a
+    # connection once it or the whole process goes above a high
+    # watermark, and read again once all are back below the low ones,
+    # in bytes, 0 disables a pair
+    inputHighWatermark = 1 << 20        # FCGI_STDIN and FCGI_DATA not yet handled
+    inputLowWatermark = 256 << 10
+    outputHighWatermark = 1 << 20       # output the transport did not send yet
+    outputLowWatermark = 256 << 10
+    processInputHighWatermark = 64 << 20
+    processInputLowWatermark = 16 << 20
+    processOutputHighWatermark = 64 << 20
+    processOutputLowWatermark = 16 << 20
+
+    # totals of all connections of this process
+    processQueuedInput = 0
+    processUnsentOutput = 0
+    pausedConnections = set()
+
+    def __init__(self, loseConnection, writeTransport, writeSequence=None, drain=None):
+        '''writeSequence, when given, writes a list of bytes-like objects
+        at once, drain returns something to wait on (e.g.: a Deferred)
+        until the transport takes more output, see FastCGIRequestState.drain
+        '''
         self.loseConnection = loseConnection
         self.writeTransport = writeTransport
+        self.writeSequence = writeSequence
+        self.drain = drain
         self.requestsPool = {}
-        self.pendingData = None
+        self.requestsSeen = 0
+        self.processor = None           # the FastCGIProcessor counting it, see FastCGIProcessor.admit
+        self.scheduler = None           # see FastCGIProcessor.fairOutput
+        self.closing = False            # closed once its requests ended, see FastCGIRequestState._end
+
+        # see readingPaused()
+        self.queuedInput = 0
+        self.unsentOutput = 0
+        self.paused = False
+        self.resumeReading = None       # set by transports, called when reading may go on
+
+        # while corked, output is queued and written at once by uncork()
+        self.corked = 0
+        self.output = []
+        self.outputSize = 0
+
+        # raw input not yet processed lives at inputBuffer[inputStart:inputEnd],
+        # bytes before inputStart may be referenced by memoryviews handed out
+        # to handlers, so they are never overwritten
+        self.inputBuffer = None
+        self.inputStart = 0
+        self.inputEnd = 0
 
     def addRequest(self, id, state):
+        if self.processor:
+            if not self.requestsPool:
+                # a connection counts while it has requests
+                self.processor.activeConnections += 1
+            self.processor.activeRequests += 1
         self.requestsPool[id] = state
+        self.requestsSeen += 1
 
     def removeRequest(self, id):
         if self.requestsPool:
             del self.requestsPool[id]
+            if self.processor:
+                self.processor.activeRequests -= 1
+                if not self.requestsPool:
+                    self.processor.activeConnections -= 1
 
     def hasRequest(self, id):
         return id in self.requestsPool
@@ -312,12 +1221,219 @@ class FastCGIConnectionState(object):
     def getRequest(self, id):
         return self.requestsPool[id]
 
+    def busy(self):
+        '''false for an idle keep-alive connection, which can be closed
+        without losing a request
+        '''
+        return bool(self.requestsPool or not self.requestsSeen
+                    or self.inputStart < self.inputEnd)
+
+    def reserveInput(self, size):
+        '''returns a writable memoryview with room for at least size
+        bytes of raw input (e.g.: for socket.recv_into), the amount
+        actually received must be given to FastCGIProcessor.processInput
+        '''
+        buf = self.inputBuffer
+        start = self.inputStart
+        end = self.inputEnd
+        pending = end - start
+
+        if pending >= FCGI_HEADER_LEN:
+            # make room for the rest of the pending record, so it gets
+            # contiguous and is never copied more than once
+            contentLength, paddingLength = _lengthsStruct.unpack_from(buf, start + 4)
+            size = max(size, FCGI_HEADER_LEN + contentLength + paddingLength - pending)
+
+        if buf is None or len(buf) - end < size:
+            # allocate a new buffer instead of compacting the current
+            # one, only the partial record at its tail is carried over
+            newbuf = bytearray(pending + size)
+            if pending:
+                newbuf[0:pending] = buf[start:end]
+            self.inputBuffer = buf = newbuf
+            self.inputStart = 0
+            self.inputEnd = end = pending
+
+        return memoryview(buf)[end:]
+
+    def write(self, *pieces):
+        '''queue output pieces, they are written to the transport
+        immediately unless the connection is corked
+        '''
+        output = self.output
+        if output is None:
+            # connection is gone
+            return
+
+        for data in pieces:
+            output.append(data)
+            self.outputSize += len(data)
+
+        if not self.corked or self.outputSize >= self.outputThreshold:
+            self.flush()
+
+    def flush(self):
+        '''write all queued output to the transport, strings are joined
+        and written with a single call, other bytes-like objects (large
+        output slices) are written as they are, never copied
+        '''
+        output = self.output
+        if not output:
+            return
+
+        self.output = []
+        self.outputSize = 0
+
+        writeTransport = self.writeTransport
+        if len(output) == 1:
+            writeTransport(output[0])
+            return
+
+        if self.writeSequence:
+            # headers go along with their content, nothing is joined
+            pieces = []
+            for data in output:
+                if isinstance(data, LazyRecords):
+                    if pieces:
+                        self.writeSequence(pieces)
+                        pieces = []
+                    writeTransport(data)
+                else:
+                    pieces.append(data)
+            if pieces:
+                self.writeSequence(pieces)
+            return
+
+        strings = []
+        for data in output:
+            if type(data) is str:
+                strings.append(data)
+            else:
+                if strings:
+                    writeTransport(''.join(strings))
+                    strings = []
+                writeTransport(data)
+        if strings:
+            writeTransport(''.join(strings))
+
+    def cork(self):
+        '''queue output until uncork(), calls may be nested
+        '''
+        self.corked += 1
+
+    def uncork(self):
+        self.corked -= 1
+        if not self.corked and self.writeTransport:
+            self.flush()
+
+    def queueInput(self, amount):
+        self.queuedInput += amount
+        FastCGIConnectionState.processQueuedInput += amount
+
+    def inputHandled(self, amount):
+        if self.requestsPool is None:
+            # cleaned up already
+            return
+        self.queuedInput -= amount
+        FastCGIConnectionState.processQueuedInput -= amount
+        self.wakeUp()
+
+    def setUnsentOutput(self, amount):
+        '''transports tell how much output they did not send yet
+        '''
+        previous = self.unsentOutput
+        FastCGIConnectionState.processUnsentOutput += amount - previous
+        self.unsentOutput = amount
+        if amount < self.outputLowWatermark <= previous:
+            self.wakeUp()
+
+    def wakeUp(self):
+        if not FastCGIConnectionState.pausedConnections:
+            return
+        if self.paused and self.resumeReading:
+            self.resumeReading()
+        if not self.processAbove(True):
+            # the process went below its low watermarks, any paused
+            # connection may read again
+            for cs in list(FastCGIConnectionState.pausedConnections):
+                if cs is not self and cs.resumeReading:
+                    cs.resumeReading()
+
+    @classmethod
+    def processAbove(cls, low):
+        if low:
+            inputMark, outputMark = cls.processInputLowWatermark, cls.processOutputLowWatermark
+        else:
+            inputMark, outputMark = cls.processInputHighWatermark, cls.processOutputHighWatermark
+        return (inputMark and cls.processQueuedInput > inputMark) or \
+            (outputMark and cls.processUnsentOutput > outputMark)
+
+    def readingPaused(self):
+        '''true while the transport should not read from this connection,
+        transports check it after processing input and when resumeReading
+        is called
+        '''
+        # once paused, until below every low watermark
+        low = self.paused
+        if low:
+            inputMark, outputMark = self.inputLowWatermark, self.outputLowWatermark
+        else:
+            inputMark, outputMark = self.inputHighWatermark, self.outputHighWatermark
+
+        paused = bool((inputMark and self.queuedInput > inputMark) or
+            (outputMark and self.unsentOutput > outputMark) or
+            self.processAbove(low))
+
+        if paused != self.paused:
+            self.paused = paused
+            if paused:
+                FastCGIConnectionState.pausedConnections.add(self)
+            else:
+                FastCGIConnectionState.pausedConnections.discard(self)
+        return paused
+
     def cleanup(self):
+        FastCGIConnectionState.processQueuedInput -= self.queuedInput
+        FastCGIConnectionState.processUnsentOutput -= self.unsentOutput
+        FastCGIConnectionState.pausedConnections.discard(self)
+        self.queuedInput = self.unsentOutput = 0
+        self.resumeReading = None
+
+        if self.processor:
+            if self.requestsPool:
+                self.processor.activeConnections -= 1
+                self.processor.activeRequests -= len(self.requestsPool)
+            self.processor = None
+
+        for requestState in self.requestsPool.values():
+            requestState.connectionLost()
         self.requestsPool.clear()
         self.requestsPool = None
+        if self.scheduler is not None:
+            self.scheduler.done()
+            self.scheduler.connectionState = None
+            self.scheduler = None
         self.writeTransport = None
+        self.writeSequence = None
+        self.output = None
         self.loseConnection = None
-        self.pendingData = None
+        self.inputBuffer = None
+
+def _discard(*pieces):
+    pass
+
+class _InputBatch(list):
+    # FCGI_STDIN or FCGI_DATA chunks of a request, see
+    # FastCGIProcessor.batchInput
+
+    def __init__(self, first):
+        list.__init__(self, (first,))
+        self.size = len(first)
+
+    def join(self):
+        if len(self) == 1:
+            return self[0]
+        return ''.join([asString(chunk) for chunk in self])
 
 class FastCGIRequestState(object):
     '''a low level class that store and manages request state
@@ -327,7 +1443,11 @@ class FastCGIRequestState(object):
         connectionState.addRequest(requestId, self)
 
         self.connectionState = connectionState
-        self.writeTransport = connectionState.writeTransport
+        if connectionState.scheduler is not None:
+            self.writeTransport = connectionState.scheduler.output(self)
+        else:
+            self.writeTransport = connectionState.write
+        self.drainTransport = connectionState.drain
 
         self.requestId = requestId
         
@@ -338,66 +1458,264 @@ class FastCGIRequestState(object):
         self.keepConnection = False     # FCGI_KEEP_CONN flag at FCGI_BEGIN_REQUEST
 
         self.callCount = 0              # how many times this request state was handled
+        self.priority = 1               # share of the connection output, see FastCGIProcessor.fairOutput
 
-        self.params = {}
+        self.params = FastCGIEnvironment()
         self.paramsReady = False
         
         self.stdinLength = 0            # amount of stdin received so far
         self.dataLength = 0             # amount of data received so far
+        self.queuedInput = 0            # amount of stdin and data not yet handled
         
         self.appStatus = 0              # appStatus used to end this request
         self.needCloseStderr = False
 
         self.ended = False
+        self.streaming = False          # see stream()
+        self.shed = False               # answered by FastCGIProcessor.shedRequest
+        self.dropped = False            # ended before its handler ran, see Lane.release
+        self.beginTime = time.time()    # FCGI_BEGIN_REQUEST arrival, see FastCGIProcessor.shedder
+        self.deadline = None            # see FastCGIProcessor.requestTimeout
+        self.lane = None                # see FastCGIProcessor.lanes
+        self.endpoint = None            # handler routed to, see router.Router
+        self.pathArgs = None            # {name} values of its route
+        self.cacheHit = False           # answered by a responsecache.ResponseCache
+        self.coalesced = False          # answered by a singleflight.SingleFlight
+
+        # see cancel()
+        self.cancelled = False
+        self.cancelReason = None
+        self.cancelCallbacks = None
+
+    def _writeStream(self, header, data):
+        length = len(data)
+
+        if length <= _maxChunk:
+            if type(data) is not str:
+                # small enough to be copied and coalesced with other output
+                data = asString(data)
+            padding = -length & 7
+            self.writeTransport(_pack(FCGI_HeaderCached, header, length, padding),
+                data, _padding[padding])
+            return
+
+        # split in as many records as needed, referencing data
+        pieces = []
+        for chunk in sliceBuffer(data, _maxChunk):
+            length = len(chunk)
+            padding = -length & 7
+            pieces.append(_pack(FCGI_HeaderCached, header, length, padding))
+            pieces.append(chunk)
+            if padding:
+                pieces.append(_padding[padding])
+        self.writeTransport(*pieces)
 
     def write(self, data):
-        '''write to the stdout channel (normal output)
+        '''write to the stdout channel (normal output), data may be a
+        string or any bytes-like object (e.g.: memoryview, bytearray,
+        mmap) of any size, large objects are sent without being copied
+        so they must not be modified afterwards
         '''
         if data:
             # this prevents the user from closing the stdout stream, let end() do this
-            self.writeTransport(_pack(FCGI_HeaderCached, self.stdoutHeader, len(data), 0))
-            self.writeTransport(data)
+            self._writeStream(self.stdoutHeader, data)
 
     def error(self, data):
-        '''write to the error channel
+        '''write to the error channel, see write()
         '''
         if data:
             # this prevents the user from closing the stderr stream, let end() do this
-            self.writeTransport(_pack(FCGI_HeaderCached, self.stderrHeader, len(data), 0))
-            self.writeTransport(data)
+            self._writeStream(self.stderrHeader, data)
             self.needCloseStderr = True
 
+    def sendfile(self, file, offset=0, count=None):
+        '''write count bytes of file (a path or a file object) starting
+        at offset to the stdout channel, count defaults to the rest of
+        the file. the transport sends the payload straight from the
+        file, using sendfile(2) where available
+        '''
+        close = isinstance(file, basestring)
+        if close:
+            file = open(file, 'rb')
+
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+
+        if count <= 0:
+            if close:
+                file.close()
+            return
+
+        self.writeTransport(FileRecords(self.stdoutHeader, file, offset, count, close))
+
+    def flush(self):
+        '''write queued output now, useful when streaming a response
+        from a corked connection
+        '''
+        if self.connectionState:
+            self.connectionState.flush()
+
+    def stream(self, iterator):
+        '''write the chunks iterator yields to the stdout channel as the
+        transport takes them, so large responses need little memory, and
+        end the request once it is exhausted (end(1) if it raises). it is
+        what handlers returning an iterator (e.g.: a generator) do, the
+        handler is not called again for this request. chunks are pulled
+        by the event loop, or by the thread of a threadpool.HandlerPool
+        running the handler
+        '''
+        if self.ended or self.streaming:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            return
+
+        self.streaming = True
+        records = IteratorRecords(self, iterator)
+        # from now on, the output of the request goes after the chunks
+        write = self.writeTransport
+        self.writeTransport = records.append
+        write(records)
+
+    def queueInput(self, amount):
+        self.queuedInput += amount
+        self.connectionState.queueInput(amount)
+
+    def inputHandled(self, amount):
+        '''amount bytes of queued input were given to the handler,
+        executors call it, see FastCGIConnectionState.readingPaused
+        '''
+        amount = min(amount, self.queuedInput)
+        if amount:
+            self.queuedInput -= amount
+            if self.connectionState:
+                self.connectionState.inputHandled(amount)
+
+    def drain(self):
+        '''write queued output and return something to wait on until
+        the transport takes more output, a Deferred with twistedfcgi, a
+        future with asynciofcgi, None if the transport has no flow control.
+        in a threadpool.HandlerPool thread it blocks until then instead
+        '''
+        if self.drainTransport:
+            return self.drainTransport()
+
+    def addCancelCallback(self, callback):
+        '''call callback(request) once the request is cancelled, right
+        away if it is already, see cancel()
+        '''
+        if self.cancelled:
+            callback(self)
+        elif self.cancelCallbacks is None:
+            self.cancelCallbacks = [callback]
+        else:
+            self.cancelCallbacks.append(callback)
+
+    def cancel(self, reason):
+        '''nobody waits for this request anymore, reason is 'abort'
+        (FCGI_ABORT_REQUEST), 'disconnect' (the connection was lost) or
+        'timeout' (see FastCGIProcessor.requestTimeout). its pending
+        events are dropped, executors stop the work they can (e.g.: a
+        Deferred, a coroutine or an offloaded request), handlers running
+        in threads may check cancelled or add a callback
+        '''
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.cancelReason = reason
+
+        callbacks = self.cancelCallbacks
+        self.cancelCallbacks = None
+        for callback in callbacks or ():
+            try:
+                callback(self)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+
+    def connectionLost(self):
+        '''the connection closed before the request ended, output is
+        discarded from now on
+        '''
+        self.ended = True
+        self.connectionState = None
+        self.queuedInput = 0            # the connection totals are gone
+        self.writeTransport = _discard
+        self.write = self.error = _discard
+
+        deadline = self.deadline
+        if deadline is not None:
+            self.deadline = None
+            deadline.cancel()
+
+        self.cancel('disconnect')
+        self._leaveLane()
+
+    def _leaveLane(self):
+        lane = self.lane
+        if lane is not None:
+            self.lane = None
+            lane.release(self)
+
     def end(self, appStatus=0, protocolStatus=FCGI_REQUEST_COMPLETE):
         if not self.connectionState:
             # ended already
             return
         
-        self.ended = True
-        self.appStatus = appStatus
-
         # close stdout stream
-        self.writeTransport(_pack(FCGI_HeaderCached, self.stdoutHeader, 0, 0))
+        closing = _pack(FCGI_HeaderCached, self.stdoutHeader, 0, 0)
 
         if self.needCloseStderr:
             # close stderr stream
-            self.writeTransport(_pack(FCGI_HeaderCached, self.stderrHeader, 0, 0))
+            closing += _pack(FCGI_HeaderCached, self.stderrHeader, 0, 0)
         
         # respond FCGI_END_REQUEST
-        self.writeTransport(_pack(FCGI_Header, 1, FCGI_END_REQUEST, self.requestId, FCGI_EndRequestBody_STRUCT_LENGTH, 0))
-        self.writeTransport(_pack(FCGI_EndRequestBody, appStatus, protocolStatus))
+        self._end(appStatus, closing,
+            _pack(FCGI_Header, 1, FCGI_END_REQUEST, self.requestId, FCGI_EndRequestBody_STRUCT_LENGTH, 0),
+            _pack(FCGI_EndRequestBody, appStatus, protocolStatus))
+
+    def endWith(self, response, appStatus=0):
+        '''end the request with response, its records encoded already
+        (e.g.: FCGI_STDOUT and FCGI_END_REQUEST of a cached response, see
+        responsecache), written with a single call
+        '''
+        if not self.connectionState:
+            # ended already
+            return
+        self._end(appStatus, response)
 
-        if not self.keepConnection and self.connectionState.loseConnection:
-            self.connectionState.loseConnection()
+    def _end(self, appStatus, *pieces):
+        self.ended = True
+        self.appStatus = appStatus
+        self.writeTransport(*pieces)
+
+        if not self.keepConnection:
+            # the other requests of the connection (e.g.: when this one
+            # was refused, see FastCGIProcessor.admit) end first
+            self.connectionState.closing = True
 
         self.write = lambda _: None
         self.error = lambda _: None
 
         self.writeTransport = None
 
+        deadline = self.deadline
+        if deadline is not None:
+            self.deadline = None
+            deadline.cancel()
+
         if self.connectionState:
             cs = self.connectionState
             self.connectionState = None
             cs.removeRequest(self.requestId)
+            if self.queuedInput:
+                # nobody will handle it
+                cs.inputHandled(self.queuedInput)
+                self.queuedInput = 0
+            if cs.closing and not cs.requestsPool and cs.loseConnection:
+                cs.flush()
+                cs.loseConnection()
+
+        # a waiting request of its lane may run
+        self._leaveLane()
 
 class FastCGIProcessor(object):
     '''manage requests processing and liveness'''
@@ -422,21 +1740,86 @@ class FastCGIProcessor(object):
             if hasattr(instance, 'config') and self.name in instance.config:
                 del instance.config[self.name]
     
+    # advertised through FCGI_GET_VALUES, admit() enforces configMpxsConns,
+    # the limits it enforces on requests and connections are maxReqs and
+    # maxConns
     configMaxConns  = configproperty('FCGI_MAX_CONNS')
     configMaxReqs   = configproperty('FCGI_MAX_REQS')
     configMpxsConns = configproperty('FCGI_MPXS_CONNS')
 
+    # refuse the requests above this many requests, or beginning on
+    # more than this many connections with requests, with FCGI_OVERLOADED
+    # (see admit), 0 disables a limit. e.g.: configMaxReqs and
+    # configMaxConns, which FCGI_GET_VALUES advertises
+    maxReqs = 0
+    maxConns = 0
+
     # set to true to analyze
     showWarnings = False
     showErrors = False
 
+    # set to true to receive FCGI_STDIN and FCGI_DATA content as
+    # memoryview slices of the input buffer instead of strings
+    zeroCopyInput = False
+
+    # set to a size in bytes to merge the FCGI_STDIN (or FCGI_DATA)
+    # chunks of a request that are next to each other in the event
+    # queue into a single handler call, up to that size, the content
+    # is then a string joining them, 0 calls the handler once per record
+    batchInput = 0
+
+    # set to true to interleave the output of the requests multiplexed
+    # on a connection (see configMpxsConns), instead of sending it in
+    # the order it is written, see OutputScheduler
+    fairOutput = False
+
+    # set to a threadpool.HandlerPool to run handlers out of the
+    # event loop, None calls them right away
+    executor = None
+
+    # set to a CoDelShedder to answer the requests that waited too
+    # long for a handler with overloadedResponse instead (see callHandler)
+    shedder = None
+
+    # set to a list of Lane, a request is handled within the first lane
+    # it matches (see generateOutput), or as usual if it matches none
+    lanes = None
+
+    # set to a singleflight.SingleFlight to answer the identical
+    # requests running at once (e.g.: GETs of the same URI) with the
+    # output of the first one, their handlers are not called
+    coalescer = None
+
+    # requests taking longer than this many seconds are ended with an
+    # error, 0 disables it, callLater(delay, function, *args) returning
+    # something to cancel() is set by transports (e.g.: reactor.callLater)
+    requestTimeout = 0
+    callLater = None
+
+    overloadedResponse = 'Status: 503 Service Unavailable\r\nRetry-After: 1\r\n' \
+        'Content-Type: text/plain\r\n\r\nservice overloaded, try again later\n'
+
     def __init__(self):
         # populate configuration
         self.configMaxConns = 10
         self.configMaxReqs = 100
         self.configMpxsConns = 1    # 1 = True, 0 = False
 
-        self.eventQueue = []       # a list of (requestState, FCGI_(type), data)
+        # processes sharing the listening socket (e.g.: pre-forked
+        # workers), the configuration is per process, FCGI_GET_VALUES
+        # answers the totals
+        self.processes = 1
+
+        self.requestCount = 0       # requests begun so far
+        self.refusedCount = 0       # FCGI_BEGIN_REQUESTs refused by admit()
+        self.shedCount = 0          # requests answered by shedRequest()
+        self.timedOutCount = 0      # requests ended by requestTimedOut()
+
+        # connections with requests not ended yet, and those requests
+        self.activeConnections = 0
+        self.activeRequests = 0
+
+        self.eventQueue = collections.deque()      # (requestState, FCGI_(type), data)
 
     def _processGetValues(self, connectionState, content):
         # process FCGI_GET_VALUES logic
@@ -450,12 +1833,15 @@ class FastCGIProcessor(object):
                 self.warning(connectionState, 'FCGI_GET_VALUES expect empty values, but found a value for name %r' % name)
                 return
             if name in self.config:
-                valuesResult[name] = self.config[name]
+                if name == FCGI_MPXS_CONNS:
+                    valuesResult[name] = self.config[name]
+                else:
+                    valuesResult[name] = self.config[name] * self.processes
             else:
                 # omit as spec says, but warn also
                 self.warning(connectionState, 'FCGI_GET_VALUES received an unknown variable: %r' % name)
 
-        connectionState.writeTransport(makeStreamRecord(FCGI_GET_VALUES_RESULT,
+        connectionState.write(makeStreamRecord(FCGI_GET_VALUES_RESULT,
             FCGI_NULL_REQUEST_ID, ''.join(dictToPairs(valuesResult))))
 
     def _processParams(self, requestState, content):
@@ -466,20 +1852,14 @@ class FastCGIProcessor(object):
             return
 
         if not content:
+            if not requestState.params.close():
+                self.fatalRequestError(requestState, 'FCGI_PARAMS content is corrupted')
+                return
             requestState.paramsReady = True
             self.eventQueue.append((requestState, FCGI_PARAMS, None))
             return
 
-        pos = 0
-        _l = len(content)
-        _p = requestState.params
-        while pos < _l:
-            name, value, pos = readPair(content, pos)
-            _p[name] = value
-
-        if pos != _l:
-            self.fatalRequestError(requestState, 'FCGI_PARAMS content is corrupted')
-            return
+        requestState.params.feed(content)
 
     def _processStdin(self, requestState, content):
         # process FCGI_STDIN logic
@@ -500,9 +1880,11 @@ class FastCGIProcessor(object):
             return
 
         requestState.stdinLength += len(content)
+        requestState.queueInput(len(content))
 
         # notify stdin input
-        self.eventQueue.append((requestState, FCGI_STDIN, content))
+        if not (self.batchInput and self._batch(requestState, FCGI_STDIN, content)):
+            self.eventQueue.append((requestState, FCGI_STDIN, content))
         
     def _processData(self, requestState, content):
         # process FCGI_DATA logic
@@ -523,9 +1905,29 @@ class FastCGIProcessor(object):
             return
 
         requestState.dataLength += len(content)
+        requestState.queueInput(len(content))
 
         # notify data input
-        self.eventQueue.append((requestState, FCGI_DATA, content))
+        if not (self.batchInput and self._batch(requestState, FCGI_DATA, content)):
+            self.eventQueue.append((requestState, FCGI_DATA, content))
+
+    def _batch(self, requestState, recordType, content):
+        # merge content into the last event when it is a chunk of the
+        # same stream, true if it was
+        eventQueue = self.eventQueue
+        if not eventQueue:
+            return False
+        lastRequestState, lastType, batch = eventQueue[-1]
+        if lastRequestState is not requestState or lastType != recordType or not batch:
+            return False
+        if type(batch) is not _InputBatch:
+            batch = _InputBatch(batch)
+            eventQueue[-1] = (requestState, recordType, batch)
+        if batch.size + len(content) > self.batchInput:
+            return False
+        batch.append(content)
+        batch.size += len(content)
+        return True
 
     def _processAbortRequest(self, requestState, content):
         # process FCGI_ABORT_REQUEST logic
@@ -534,6 +1936,7 @@ class FastCGIProcessor(object):
             requestState.error('FCGI_ABORT_REQUEST sent unexpected content while aborting request %i' % requestState.requestId)
 
         requestState.end(1)
+        requestState.cancel('abort')
         
         # notify abort
         self.eventQueue.append((requestState, FCGI_ABORT_REQUEST, None))
@@ -547,12 +1950,46 @@ class FastCGIProcessor(object):
         FCGI_DATA:          _processData            # request, stream
     }
 
+    def admit(self, connectionState):
+        '''FCGI_REQUEST_COMPLETE if a new request of connectionState may
+        begin, the FCGI_END_REQUEST protocol status refusing it otherwise:
+        FCGI_CANT_MPX_CONN for a second request on a connection when
+        configMpxsConns is false, FCGI_OVERLOADED above maxReqs requests
+        or maxConns connections with requests
+        '''
+        if connectionState.requestsPool and not self.configMpxsConns:
+            return FCGI_CANT_MPX_CONN
+        if self.maxReqs and self.activeRequests >= self.maxReqs:
+            return FCGI_OVERLOADED
+        if self.maxConns and not connectionState.requestsPool and self.activeConnections >= self.maxConns:
+            return FCGI_OVERLOADED
+        return FCGI_REQUEST_COMPLETE
+
+    def requestTimedOut(self, requestState):
+        requestState.deadline = None
+        if requestState.ended:
+            return
+        self.timedOutCount += 1
+        requestState.error('request %i timed out after %s seconds\n' % (
+            requestState.requestId, self.requestTimeout))
+        requestState.end(1)
+        requestState.cancel('timeout')
+
+    def shedRequest(self, requestState):
+        '''answer requestState with overloadedResponse, its handler is
+        not called
+        '''
+        self.shedCount += 1
+        requestState.shed = True
+        requestState.write(self.overloadedResponse)
+        requestState.end(0)
+
     def warning(self, connectionState, msg):
         '''notify warnings to web server, not request associated
         '''
         if self.showWarnings:
             print 'warning: %s' % msg
-        connectionState.writeTransport(makeStreamRecord(FCGI_STDERR, FCGI_NULL_REQUEST_ID, msg))
+        connectionState.write(makeStreamRecord(FCGI_STDERR, FCGI_NULL_REQUEST_ID, msg))
 
     def fatalRequestError(self, requestState, msg, protocolStatus=FCGI_REQUEST_COMPLETE):
         '''fatal error happend to a request, valid request id is required
@@ -581,9 +2018,28 @@ class FastCGIProcessor(object):
             if connectionState.hasRequest(requestId):
                 self.warning(connectionState, 'request id %s already created for connection %s' % (requestId, id(connectionState)))
                 return
-            requestState = FastCGIRequestState(connectionState, requestId)
+            connectionState.processor = self
 
             role, flags = _unpack(FCGI_BeginRequestBody, content)
+
+            if self.fairOutput and connectionState.scheduler is None:
+                connectionState.scheduler = OutputScheduler(connectionState)
+
+            protocolStatus = self.admit(connectionState)
+            requestState = FastCGIRequestState(connectionState, requestId)
+            if protocolStatus != FCGI_REQUEST_COMPLETE:
+                # refused right away, the web server may try elsewhere,
+                # FCGI_END_REQUEST only, there was no stdout stream
+                requestState.keepConnection = bool(flags & FCGI_KEEP_CONN)
+                requestState.endWith(
+                    _pack(FCGI_Header, 1, FCGI_END_REQUEST, requestId, FCGI_EndRequestBody_STRUCT_LENGTH, 0) +
+                    _pack(FCGI_EndRequestBody, 0, protocolStatus))
+                self.refusedCount += 1
+                return requestState
+            self.requestCount += 1
+            if self.requestTimeout and self.callLater:
+                requestState.deadline = self.callLater(self.requestTimeout, self.requestTimedOut, requestState)
+
             if role not in FCGI_VALID_ROLES:
                 self.fatalRequestError(requestState, 'FCGI_BEGIN_REQUEST(%i) with an unknown role %i' %
                                        (requestState.requestId, role), FCGI_UNKNOWN_ROLE)
@@ -623,51 +2079,140 @@ class FastCGIProcessor(object):
         '''dispatch output handlers for the requests that are ready
         call handler(requestState, record type, related content)
         '''
-
         while self.eventQueue:
-            item = self.eventQueue.pop(0)
-            try:
-                item[0].callCount += 1
-                # call handler(requestState, record type, related content)
-                if not handler(*item):
-                    # returning not null value means that the handler expect more data
-                    # to come, this is specialy useful for interleaving stdin and stdout
-                    # streams (e.g.: respond while receive) or when dealing with
-                    # keep-alive connections.
-                    item[0].end(0)
-            except socket.error:
-                # let protocol/server handle socket related errors
-                raise
-            except Exception, err:
-                print 'processor: exception occurred while handling request id %i, exception: %s' % (
-                    item[0].requestId, str(err))
-                traceback.print_exc(file=sys.stdout)
-                item[0].end(1)
+            item = self.eventQueue.popleft()
+            if item[0].cancelled and item[1] != FCGI_ABORT_REQUEST:
+                # nobody waits for it, the handler hears of the abort only
+                continue
+            if type(item[2]) is _InputBatch:
+                item = (item[0], item[1], item[2].join())
+            if self.coalescer is not None and self.coalescer.dispatch(self, handler, item):
+                # held for, or answered with, the output of an identical request
+                continue
+            self.dispatchEvent(handler, item)
+
+    def dispatchEvent(self, handler, item):
+        '''call handler for item, a (requestState, type, content) tuple,
+        within the lane of the request, in the executor
+        '''
+        lane = item[0].lane
+        if lane is None and self.lanes and item[1] == FCGI_PARAMS:
+            lane = self.classify(item[0])
+        if lane is not None:
+            # the lane may hold it, or run it in its executor
+            lane.dispatch(self, handler, item)
+        elif self.executor:
+            # events of a request are handled in order
+            self.executor.dispatch(item[0], self.callHandler, handler, *item)
+        else:
+            self.callHandler(handler, *item)
 
-    def processRawInput(self, connectionState, data):
-        if connectionState.pendingData:
-            data = connectionState.pendingData + data
-            connectionState.pendingData = None
+    def classify(self, requestState):
+        '''the lane of requestState, once its params are complete
+        '''
+        for lane in self.lanes:
+            if lane.match(requestState):
+                requestState.lane = lane
+                return lane
+        return None
+
+    def callHandler(self, handler, requestState, type, content):
+        try:
+            requestState.callCount += 1
+            if content:
+                requestState.inputHandled(len(content))
+            if requestState.streaming or requestState.shed or requestState.dropped:
+                # answered already, see FastCGIRequestState.stream and
+                # shedRequest, or nothing to tell its handler
+                return
+            if requestState.cancelled and type != FCGI_ABORT_REQUEST:
+                # queued before it was cancelled
+                return
+            if type == FCGI_PARAMS and self.shedder:
+                # the first event of a request, how long did it wait
+                now = time.time()
+                if self.shedder.shed(now - requestState.beginTime, now):
+                    self.shedRequest(requestState)
+                    return
+            # call handler(requestState, record type, related content)
+            result = handler(requestState, type, content)
+            if isIterator(result):
+                requestState.stream(result)
+            elif not result:
+                # returning not null value means that the handler expect more data
+                # to come, this is specialy useful for interleaving stdin and stdout
+                # streams (e.g.: respond while receive) or when dealing with
+                # keep-alive connections.
+                requestState.end(0)
+        except socket.error:
+            # let protocol/server handle socket related errors
+            raise
+        except Exception, err:
+            print 'processor: exception occurred while handling request id %i, exception: %s' % (
+                requestState.requestId, str(err))
+            traceback.print_exc(file=sys.stdout)
+            requestState.end(1)
+
+    def _processBuffer(self, connectionState, buf, pos, end):
+        '''process all complete records at buf[pos:end], returns the
+        position of the first unprocessed byte
+        '''
+        view = memoryview(buf)
+        unpackHeader = _headerStruct.unpack_from
+        zeroCopy = self.zeroCopyInput
 
-        pos = 0
-        datalen = len(data)
+        while end - pos >= FCGI_HEADER_LEN:
+            version, type, requestId, contentLength, paddingLength = unpackHeader(buf, pos)
+            cpos = pos + FCGI_HEADER_LEN
+            npos = cpos + contentLength + paddingLength
 
-        while pos < datalen:
-            if pos + FCGI_HEADER_LEN > datalen:
-                connectionState.pendingData = data[pos:]
+            if npos > end:
                 break
 
-            version, type, requestId, contentLength, paddingLength = _unpack(FCGI_Header, data[pos:pos + FCGI_HEADER_LEN])
-            cpos = pos + FCGI_HEADER_LEN
+            content = view[cpos:cpos + contentLength]
+            if type == FCGI_STDIN or type == FCGI_DATA:
+                if not zeroCopy:
+                    content = content.tobytes()
+            elif type != FCGI_PARAMS:
+                # PairReader copies out only what it needs from FCGI_PARAMS
+                content = content.tobytes()
+            pos = npos
 
-            if cpos + contentLength + paddingLength > datalen:
-                connectionState.pendingData = data[pos:]
+            self.processRecord(connectionState, type, requestId, content)
+
+            if connectionState.requestsPool is None:
+                # connection was cleaned up while processing
                 break
 
-            content = data[cpos:cpos + contentLength]
-            pos += FCGI_HEADER_LEN + contentLength + paddingLength
+        return pos
 
-            self.processRecord(connectionState, type, requestId, content)
+    def processInput(self, connectionState, amount):
+        '''process amount bytes received into the memoryview
+        returned by connectionState.reserveInput()
+        '''
+        cs = connectionState
+        cs.inputEnd += amount
+        cs.inputStart = self._processBuffer(cs, cs.inputBuffer, cs.inputStart, cs.inputEnd)
+
+        if cs.inputStart == cs.inputEnd and not self.zeroCopyInput:
+            # no views were handed out, the buffer can be reused
+            cs.inputStart = cs.inputEnd = 0
+
+    def processRawInput(self, connectionState, data):
+        '''process raw input already read from the web server, data
+        may be a string or any other bytes-like object
+        '''
+        cs = connectionState
+        if cs.inputStart == cs.inputEnd:
+            # nothing pending, process complete records in place
+            pos = self._processBuffer(cs, data, 0, len(data))
+            if pos:
+                data = memoryview(data)[pos:]
+
+        amount = len(data)
+        if amount and cs.requestsPool is not None:
+            cs.reserveInput(amount)[0:amount] = data
+            self.processInput(cs, amount)
 
 def testnamevalues():
     
@@ -699,6 +2244,67 @@ def testnamevalues():
     test('alpha', 'bravo' * r())
     test('alpha' * r(), 'bravo' * r())
 
+def testpairreader():
+    pairs = {
+        'HTTP_COOKIE': 'c' * random.randint(200, 70000),
+        'QUERY_STRING': 'q' * 0x7f,
+        'A': '',
+        'L' * 0x80: 'v',
+    }
+    data = ''.join(dictToPairs(pairs))
+
+    # split at every possible position
+    for i in xrange(0, 300):
+        reader = PairReader()
+        decoded = dict(reader.feed(data[:i]) + reader.feed(data[i:]))
+        assert not reader.incomplete()
+        assert decoded == pairs
+
+    # split in many small records
+    reader = PairReader()
+    decoded = {}
+    pos = 0
+    while pos < len(data):
+        n = random.randint(1, 10)
+        decoded.update(reader.feed(data[pos:pos + n]))
+        pos += n
+    assert not reader.incomplete()
+    assert decoded == pairs
+
+def testenvironment():
+    params = {
+        'QUERY_STRING': 'a=1&b=2&a=3&c=',
+        'HTTP_COOKIE': 'sid=abc; theme=dark;sid=other; empty=',
+        'CONTENT_TYPE': 'Text/HTML; charset=UTF-8',
+        'HTTP_ACCEPT_ENCODING': 'identity;q=0.5, gzip, br;q=0.9, compress;q=0',
+        'LARGE': 'x' * 1000,
+    }
+    data = ''.join(dictToPairs(params))
+
+    env = FastCGIEnvironment()
+    env.feed(memoryview(data)[0:500])
+    env.feed(memoryview(data)[500:])
+    assert env.close()
+
+    assert len(env) == len(params)
+    assert dict(env) == params
+    assert 'LARGE' in env and 'MISSING' not in env
+    assert env.get('MISSING') is None
+
+    assert env.queryArgs == {'a': ['1', '3'], 'b': ['2'], 'c': ['']}
+    assert env.cookies == {'sid': 'abc', 'theme': 'dark', 'empty': ''}
+    assert env.contentType == ('text/html', {'charset': 'UTF-8'})
+    assert env.charset == 'UTF-8'
+    assert env.acceptEncodings == ['gzip', 'br', 'identity']
+    assert env.queryArgs is env.queryArgs
+
+    env['QUERY_STRING'] = 'd=4'
+    assert env.queryArgs == {'d': ['4']}
+
+    env = FastCGIEnvironment()
+    env.feed(data[:-1])
+    assert not env.close()
+
 def testprocessor():
     fcgi_stdin = cStringIO.StringIO()
     fcgi_stdout = cStringIO.StringIO()
@@ -892,8 +2498,1356 @@ def testgetvalues():
         print '\n'.join(debugRecords(fcgi_stdout.getvalue()))
         sys.exit(1)
 
+def testcorkedoutput():
+    writes = []
+
+    def handler(request, type, content):
+        if type == FCGI_PARAMS:
+            request.write('content-type: text/plain\r\n\r\n')
+            request.write('hello')
+            request.error('oops')
+
+    processor = FastCGIProcessor()
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+
+    cs.cork()
+    processor.processRawInput(cs,
+        makeDiscreteRecord(FCGI_BEGIN_REQUEST, 1, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+        makeStreamRecord(FCGI_PARAMS, 1, '') +
+        makeStreamRecord(FCGI_STDIN, 1, ''))
+    processor.generateOutput(handler)
+    assert not writes
+    cs.uncork()
+
+    # a single write, every record aligned to 8 bytes
+    assert len(writes) == 1
+    pos = 0
+    for header, content in splitRecords(writes[0]):
+        pos += FCGI_HEADER_LEN + header[FCGI_Header_CONTENTLENGTH] + header[FCGI_Header_PADDINGLENGTH]
+        assert pos % 8 == 0
+    types = [h[FCGI_Header_TYPE] for h, c in splitRecords(writes[0])]
+    assert types == [FCGI_STDOUT, FCGI_STDOUT, FCGI_STDERR, FCGI_STDOUT, FCGI_STDERR, FCGI_END_REQUEST]
+
+    # the threshold flushes a corked connection
+    del writes[:]
+    cs.cork()
+    request = FastCGIRequestState(cs, 2)
+    request.write('x' * 40000)
+    assert not writes
+    request.write('x' * 40000)
+    assert len(writes) == 1
+    request.write('y')
+    assert len(writes) == 1
+    request.flush()
+    assert len(writes) == 2
+    cs.uncork()
+
+def testlargewrite():
+    import mmap
+    import tempfile
+
+    body = ''.join([chr(random.randint(0, 255)) for i in xrange(200000)])
+    spool = tempfile.TemporaryFile()
+    spool.write(body)
+    spool.flush()
+
+    for data in (body, bytearray(body), memoryview(body), mmap.mmap(spool.fileno(), 0), 'small', bytearray('small')):
+        writes = []
+        cs = FastCGIConnectionState(lambda: None, writes.append)
+        request = FastCGIRequestState(cs, 1)
+        cs.cork()
+        request.write(data)
+        request.end()
+        cs.uncork()
+
+        records = splitRecords(''.join([asString(w) for w in writes]))
+        for header, content in records:
+            assert header[FCGI_Header_CONTENTLENGTH] <= FCGI_MAX_CONTENT_LEN
+        assert ''.join([c for h, c in records if h[FCGI_Header_TYPE] == FCGI_STDOUT]) == asString(data[:])
+        assert records[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+
+    # with writeSequence, the pieces are written at once, not joined
+    sequences = []
+    cs = FastCGIConnectionState(lambda: None, None, sequences.append)
+    request = FastCGIRequestState(cs, 1)
+    cs.cork()
+    request.write(memoryview(body))
+    request.end()
+    cs.uncork()
+    pieces = sum(sequences, [])
+    assert len(sequences) < len(pieces)
+    assert [type(p) for p in pieces[:2]] == [str, memoryview]
+    records = splitRecords(''.join([asString(p) for p in pieces]))
+    assert ''.join([c for h, c in records if h[FCGI_Header_TYPE] == FCGI_STDOUT]) == body
+
+def testfilerecords():
+    import tempfile
+
+    body = ''.join([chr(random.randint(0, 255)) for i in xrange(150001)])
+    spool = tempfile.TemporaryFile()
+    spool.write(body)
+    spool.flush()
+    header = _pack(FCGI_HeaderVTR, 1, FCGI_STDOUT, 1)
+
+    # read() returns whole records
+    records = FileRecords(header, spool, 3, len(body) - 3)
+    size = len(records)
+    chunks = []
+    while len(records):
+        chunks.append(records.read())
+    stream = ''.join(chunks)
+    assert len(stream) == size and len(stream) % 8 == 0
+    assert ''.join([c for h, c in splitRecords(stream)]) == body[3:]
+    assert [len(splitRecords(chunk)) for chunk in chunks] == [1] * len(chunks)
+
+    # sendTo() resumes where a non-blocking socket stopped
+    a, b = socket.socketpair()
+    a.setblocking(0)
+    records = FileRecords(header, spool, 0, len(body))
+    size = len(records)
+    received = []
+    while len(records):
+        records.sendTo(a)
+        received.append(b.recv(size))
+    stream = ''.join(received)
+    assert len(stream) == size
+    assert ''.join([c for h, c in splitRecords(stream)]) == body
+
+def testrawinput():
+    body = ''.join([chr(random.randint(0, 255)) for i in xrange(50000)])
+
+    stream = cStringIO.StringIO()
+    stream.write(makeDiscreteRecord(FCGI_BEGIN_REQUEST, 1, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN))
+    stream.write(makeStreamRecord(FCGI_PARAMS, 1, ''.join(dictToPairs({'CONTENT_LENGTH': len(body)}))))
+    stream.write(makeStreamRecord(FCGI_PARAMS, 1, ''))
+    pos = 0
+    while pos < len(body):
+        chunk = body[pos:pos + random.randint(1, 8192)]
+        # padded records, as some web servers do
+        stream.write(_pack(FCGI_Header, 1, FCGI_STDIN, 1, len(chunk), 5) + chunk + '\0' * 5)
+        pos += len(chunk)
+    stream.write(makeStreamRecord(FCGI_STDIN, 1, ''))
+    stream = stream.getvalue()
+
+    def feed(processor, direct):
+        received = []
+
+        def handler(request, type, content):
+            if type == FCGI_STDIN:
+                if not content:
+                    return
+                received.append(content)
+            return 1
+
+        fcgi_stdout = cStringIO.StringIO()
+        cs = FastCGIConnectionState(lambda: None, fcgi_stdout.write)
+        pos = 0
+        while pos < len(stream):
+            data = stream[pos:pos + random.randint(1, 3000)]
+            pos += len(data)
+            if direct:
+                buf = cs.reserveInput(len(data))
+                buf[0:len(data)] = data
+                processor.processInput(cs, len(data))
+            else:
+                processor.processRawInput(cs, data)
+            processor.generateOutput(handler)
+
+        assert cs.inputStart == cs.inputEnd
+        return received, splitRecords(fcgi_stdout.getvalue())
+
+    try:
+        processor = FastCGIProcessor()
+        for direct in (False, True):
+            received, records = feed(processor, direct)
+            assert ''.join(received) == body
+            assert records[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+
+        processor.zeroCopyInput = True
+        received, records = feed(processor, True)
+        assert isinstance(received[0], memoryview)
+        assert ''.join([c.tobytes() for c in received]) == body
+        assert records[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+
+    except AssertionError:
+        traceback.print_exc(file=sys.stdout)
+        sys.exit(1)
+
+def testthreadpool():
+    import thread
+    import time
+    import threading
+    import Queue
+    import threadpool
+
+    class Waiter(object):
+        # a Deferred
+        def __init__(self):
+            self.callbacks = []
+        def addBoth(self, callback):
+            self.callbacks.append(callback)
+        def fire(self):
+            for callback in self.callbacks:
+                callback(None)
+
+    calls = Queue.Queue()
+    writes = []
+    events = {}
+    waiters = []
+    drains = []
+
+    def drain():
+        assert thread.get_ident() == loopThread
+        drains.append(1)
+        waiters.append(Waiter())
+        return waiters[-1]
+
+    def write(data):
+        # output reaches the connection in the loop thread only
+        assert thread.get_ident() == loopThread
+        writes.append(data)
+
+    def handler(request, type, content):
+        events.setdefault(request.requestId, []).append((type, content))
+        if request.requestId == 1 and type == FCGI_PARAMS:
+            # blocks, request 2 is handled meanwhile
+            time.sleep(0.2)
+        if type == FCGI_STDIN and not content:
+            return output(request)
+        return 1
+
+    def output(request):
+        # pulled by the pool thread, which waits for the transport
+        assert thread.get_ident() != loopThread
+        yield 'done '
+        yield str(request.requestId)
+
+    loopThread = thread.get_ident()
+    processor = FastCGIProcessor()
+    processor.executor = threadpool.HandlerPool(2, lambda f, *args: calls.put((f, args)))
+    cs = FastCGIConnectionState(lambda: None, write, drain=drain)
+
+    input = ''
+    for i in (1, 2):
+        input += makeDiscreteRecord(FCGI_BEGIN_REQUEST, i, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN)
+        input += makeStreamRecord(FCGI_PARAMS, i, '')
+    for chunk in ('a', 'b', 'c', ''):
+        for i in (1, 2):
+            input += makeStreamRecord(FCGI_STDIN, i, chunk)
+    processor.processRawInput(cs, input)
+    processor.generateOutput(handler)
+
+    # the event loop
+    ended = []
+    while cs.requestsPool:
+        f, args = calls.get(timeout=5)
+        f(*args)
+        while waiters:
+            waiters.pop().fire()
+        for h, c in splitRecords(''.join(writes)):
+            if h[FCGI_Header_TYPE] == FCGI_END_REQUEST and h[FCGI_Header_REQUESTID] not in ended:
+                ended.append(h[FCGI_Header_REQUESTID])
+    processor.executor.stop()
+
+    assert ended == [2, 1]
+    assert len(drains) == 4     # one per chunk
+    for i in (1, 2):
+        assert events[i] == [(FCGI_PARAMS, None), (FCGI_STDIN, 'a'), (FCGI_STDIN, 'b'), (FCGI_STDIN, 'c'), (FCGI_STDIN, None)]
+
+    # the event loop is gone, a thread waiting in drain() does not
+    # keep stop() from returning
+    def endless(request, type, content):
+        if type == FCGI_STDIN and not content:
+            return iter(lambda: 'x', None)
+        return 1
+
+    processor = FastCGIProcessor()
+    processor.executor = threadpool.HandlerPool(1, lambda f, *args: calls.put((f, args)))
+    processor.executor.drainWait = 0.05
+    cs = FastCGIConnectionState(lambda: None, write, drain=drain)
+    input = makeDiscreteRecord(FCGI_BEGIN_REQUEST, 1, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN)
+    input += makeStreamRecord(FCGI_PARAMS, 1, '')
+    input += makeStreamRecord(FCGI_STDIN, 1, '')
+    processor.processRawInput(cs, input)
+    processor.generateOutput(endless)
+    time.sleep(0.1)
+    stopper = threading.Thread(target=processor.executor.stop)
+    stopper.start()
+    stopper.join(5)
+    assert not stopper.isAlive()
+
+def testprocesspool():
+    import Queue
+    import processpool
+
+    calls = Queue.Queue()
+    writes = []
+
+    def handler(request, type, content):
+        if type == FCGI_PARAMS:
+            request.write('%s %i' % (request.params['SCRIPT_NAME'], os.getpid()))
+        elif type == FCGI_STDIN and content:
+            request.write(' stdin=%s' % content[:])
+            return 1
+        return type != FCGI_STDIN or content is not None
+
+    def offload(request):
+        return request.params['SCRIPT_NAME'] == '/cpu'
+
+    processor = FastCGIProcessor()
+    processor.executor = processpool.ProcessPool(1, lambda f, *args: calls.put((f, args)), handler, offload)
+    processor.executor.start()
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+
+    input = ''
+    for i, name in ((1, '/cpu'), (2, '/io')):
+        input += makeDiscreteRecord(FCGI_BEGIN_REQUEST, i, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN)
+        input += makeStreamRecord(FCGI_PARAMS, i, ''.join(dictToPairs({'SCRIPT_NAME': name})))
+        input += makeStreamRecord(FCGI_PARAMS, i, '')
+        input += makeStreamRecord(FCGI_STDIN, i, 'abc')
+        input += makeStreamRecord(FCGI_STDIN, i, 'def')
+        input += makeStreamRecord(FCGI_STDIN, i, '')
+    processor.processRawInput(cs, input)
+    processor.generateOutput(handler)
+
+    # request 2 was handled right away
+    assert not cs.hasRequest(2)
+    while cs.requestsPool:
+        f, args = calls.get(timeout=5)
+        f(*args)
+    processor.executor.stop()
+
+    output = {}
+    for h, c in splitRecords(''.join(writes)):
+        if h[FCGI_Header_TYPE] == FCGI_STDOUT:
+            output[h[FCGI_Header_REQUESTID]] = output.get(h[FCGI_Header_REQUESTID], '') + c
+    name, pid = output[1].split()[:2]
+    assert name == '/cpu' and int(pid) != os.getpid()
+    assert output[1].endswith(' stdin=abcdef')
+    assert output[2] == '/io %i stdin=abc stdin=def' % os.getpid()
+
+def testbackpressure():
+    class Executor(object):
+        # runs the calls when told so, like a busy thread pool
+        def __init__(self):
+            self.calls = []
+        def dispatch(self, requestState, function, *args):
+            self.calls.append((function, args))
+        def run(self, count):
+            for function, args in self.calls[:count]:
+                function(*args)
+            del self.calls[:count]
+
+    def handler(request, type, content):
+        return type != FCGI_STDIN or content
+
+    resumed = []
+    processor = FastCGIProcessor()
+    processor.executor = Executor()
+    cs = FastCGIConnectionState(lambda: None, lambda data: None)
+    cs.inputHighWatermark = 1000
+    cs.inputLowWatermark = 300
+    cs.resumeReading = lambda: resumed.append(cs.readingPaused())
+
+    input = makeDiscreteRecord(FCGI_BEGIN_REQUEST, 1, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN)
+    input += makeStreamRecord(FCGI_PARAMS, 1, '')
+    processor.processRawInput(cs, input)
+    for i in xrange(5):
+        processor.processRawInput(cs, makeStreamRecord(FCGI_STDIN, 1, 'x' * 250))
+        processor.generateOutput(handler)
+    assert cs.queuedInput == 1250
+    assert FastCGIConnectionState.processQueuedInput == 1250
+    assert cs.readingPaused()
+
+    # the transport checks again as input is handled, still above the
+    # low watermark
+    processor.executor.run(4)
+    assert cs.queuedInput == 500 and resumed == [True] * 3
+    processor.executor.run(1)
+    assert resumed[-1] is False and not cs.readingPaused()
+
+    # input of an ended request is not waited for
+    processor.processRawInput(cs, makeStreamRecord(FCGI_STDIN, 1, 'x' * 2000))
+    processor.generateOutput(handler)
+    assert cs.readingPaused()
+    cs.requestsPool[1].end()
+    assert cs.queuedInput == 0 and resumed[-1] is False
+
+    cs.cleanup()
+    assert FastCGIConnectionState.processQueuedInput == 0
+    assert not FastCGIConnectionState.pausedConnections
+
+def teststream():
+    writes = []
+    pulled = []
+    closed = []
+
+    def rows(request, count, fail):
+        try:
+            for i in xrange(count):
+                pulled.append(i)
+                yield '%i,%i\n' % (request.requestId, i)
+            if fail:
+                raise ValueError('no more rows')
+        finally:
+            closed.append(request.requestId)
+
+    def handler(request, type, content):
+        if type == FCGI_STDIN and not content:
+            request.write('content-type: text/csv\r\n\r\n')
+            return rows(request, request.requestId * 10000, request.requestId == 2)
+        return 1
+
+    def request(requestId):
+        processor.processRawInput(cs,
+            makeDiscreteRecord(FCGI_BEGIN_REQUEST, requestId, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+            makeStreamRecord(FCGI_PARAMS, requestId, '') +
+            makeStreamRecord(FCGI_STDIN, requestId, ''))
+        processor.generateOutput(handler)
+
+    def transport():
+        # reads the output objects a record at a time, as twistedfcgi
+        output = []
+        for data in writes:
+            if isinstance(data, LazyRecords):
+                while len(data):
+                    output.append(data.read())
+            else:
+                output.append(data)
+        del writes[:]
+        return splitRecords(''.join(output))
+
+    processor = FastCGIProcessor()
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+
+    request(1)
+    assert not pulled and 1 in cs.requestsPool
+
+    # pulled as the transport takes output, ended once exhausted
+    assert isinstance(writes[-1], IteratorRecords)
+    records = transport()
+    stdout = ''.join(c for h, c in records if h[FCGI_Header_TYPE] == FCGI_STDOUT)
+    assert stdout == 'content-type: text/csv\r\n\r\n' + ''.join('1,%i\n' % i for i in xrange(10000))
+    assert records[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+    assert _unpack(FCGI_EndRequestBody, records[-1][1])[0] == 0
+    assert 1 not in cs.requestsPool and closed == [1]
+
+    # an error ends the request with status 1
+    request(2)
+    records = transport()
+    assert records[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+    assert _unpack(FCGI_EndRequestBody, records[-1][1])[0] == 1
+    assert closed == [1, 2]
+
+    # an aborted request stops pulling
+    del pulled[:]
+    request(3)
+    writes[-1].read()
+    assert 0 < len(pulled) < 30000
+    processor.processRawInput(cs, makeStreamRecord(FCGI_ABORT_REQUEST, 3, ''))
+    processor.generateOutput(handler)
+    records = transport()
+    assert len(pulled) < 30000 and closed == [1, 2, 3]
+    assert _unpack(FCGI_EndRequestBody, records[-1][1])[0] == 1
+
+def testadmission():
+    def handler(request, type, content):
+        if type == FCGI_STDIN and not content:
+            request.write('hello')
+            return
+        return 1
+
+    def begin(cs, requestId, flags=FCGI_KEEP_CONN):
+        writes[:] = []
+        processor.processRawInput(cs, makeDiscreteRecord(FCGI_BEGIN_REQUEST,
+            requestId, FCGI_BeginRequestBody, FCGI_RESPONDER, flags))
+        records = splitRecords(''.join(writes))
+        if records:
+            # refused, FCGI_END_REQUEST only
+            assert len(records) == 1 and records[0][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+            return _unpack(FCGI_EndRequestBody, records[0][1])[1]
+
+    def finish(cs, requestId):
+        processor.processRawInput(cs, makeStreamRecord(FCGI_PARAMS, requestId, '') +
+            makeStreamRecord(FCGI_STDIN, requestId, ''))
+        processor.generateOutput(handler)
+
+    # no limits by default
+    writes = []
+    processor = FastCGIProcessor()
+    connections = [FastCGIConnectionState(lambda: None, writes.append) for i in xrange(12)]
+    for i in xrange(2):
+        for cs in connections:
+            assert begin(cs, 1) is None
+            finish(cs, 1)
+    assert processor.refusedCount == 0 and processor.activeConnections == 0
+
+    writes = []
+    processor = FastCGIProcessor()
+    processor.maxConns = 2
+    processor.maxReqs = 3
+    a, b, c = [FastCGIConnectionState(lambda: None, writes.append) for i in xrange(3)]
+
+    assert begin(a, 1) is None and begin(a, 2) is None and begin(b, 1) is None
+    assert begin(b, 2) == FCGI_OVERLOADED and not b.hasRequest(2)
+    assert begin(c, 1) == FCGI_OVERLOADED
+    assert processor.activeRequests == 3 and processor.activeConnections == 2
+    finish(a, 1)
+    assert processor.activeRequests == 2
+    # a third connection is over the limit still
+    assert begin(c, 1) == FCGI_OVERLOADED
+    # until a connection has no requests left
+    finish(a, 2)
+    assert processor.activeConnections == 1
+    assert begin(c, 1) is None and begin(b, 2) is None
+
+    processor.configMpxsConns = 0
+    assert begin(b, 3) == FCGI_CANT_MPX_CONN
+    a.cleanup()
+    b.cleanup()
+    c.cleanup()
+    assert processor.activeRequests == 0 and processor.activeConnections == 0
+    assert processor.refusedCount == 4 and processor.requestCount == 5
+
+    # refused without FCGI_KEEP_CONN, the connection is closed once the
+    # requests it has ended
+    closed = []
+    processor = FastCGIProcessor()
+    processor.maxReqs = 2
+    a = FastCGIConnectionState(lambda: closed.append(1), writes.append)
+    assert begin(a, 1) is None and begin(a, 2) is None
+    assert begin(a, 3, 0) == FCGI_OVERLOADED
+    finish(a, 1)
+    assert not closed
+    finish(a, 2)
+    assert closed == [1]
+    a.cleanup()
+
+    # a standing queue: shed once even the shortest delay of an
+    # interval is above target
+    shedder = CoDelShedder(target=0.05, interval=0.5)
+    assert not shedder.shed(0.2, 100.0)
+    assert not shedder.shed(0.01, 100.2)    # a burst, not standing
+    assert not shedder.shed(0.2, 100.5)
+    assert not shedder.shed(0.1, 100.7)
+    assert shedder.shed(0.2, 101.0)
+    assert not shedder.shed(0.04, 101.1)    # short waits go on
+    assert shedder.shed(0.06, 101.2)
+    assert not shedder.shed(0.01, 101.5)    # drained
+    assert not shedder.shed(0.2, 101.6)
+
+    writes = []
+    processor = FastCGIProcessor()
+    processor.shedder = shedder
+    shedder.dropping = True
+    shedder.intervalEnd = time.time() + 60
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+    begin(cs, 1)
+    cs.requestsPool[1].beginTime -= 1
+    finish(cs, 1)
+    records = splitRecords(''.join(writes))
+    assert records[0][1].startswith('Status: 503')
+    assert records[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+    assert processor.shedCount == 1 and not cs.requestsPool
+
+def testrequesttimeout():
+    class Call(object):
+        def __init__(self, function, args):
+            self.function = function
+            self.args = args
+            self.cancelled = False
+        def cancel(self):
+            self.cancelled = True
+
+    def callLater(delay, function, *args):
+        assert delay == 30
+        calls.append(Call(function, args))
+        return calls[-1]
+
+    def handler(request, type, content):
+        if type == FCGI_STDIN and not content and request.requestId == 1:
+            return
+        return 1        # request 2 gets stuck
+
+    calls = []
+    writes = []
+    processor = FastCGIProcessor()
+    processor.requestTimeout = 30
+    processor.callLater = callLater
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+    for i in (1, 2, 3):
+        processor.processRawInput(cs,
+            makeDiscreteRecord(FCGI_BEGIN_REQUEST, i, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+            makeStreamRecord(FCGI_PARAMS, i, '') +
+            makeStreamRecord(FCGI_STDIN, i, ''))
+    processor.generateOutput(handler)
+    assert len(calls) == 3 and calls[0].cancelled and not calls[1].cancelled
+
+    del writes[:]
+    calls[1].function(*calls[1].args)
+    records = splitRecords(''.join(writes))
+    assert records[0][0][FCGI_Header_TYPE] == FCGI_STDERR and 'timed out' in records[0][1]
+    assert records[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+    assert _unpack(FCGI_EndRequestBody, records[-1][1])[0] == 1
+    assert 2 not in cs.requestsPool and processor.timedOutCount == 1
+
+    # the deadlines of a lost connection are cancelled
+    cs.cleanup()
+    assert calls[2].cancelled
+
+def testtimers():
+    import selectserver
+    import selectfcgi
+
+    def handler(request, type, content):
+        if type == FCGI_STDIN and content is None:
+            if request.params['SCRIPT_NAME'] == '/big':
+                request.write('x' * (4 << 20))
+            return
+        return 1
+
+    def advance(seconds):
+        clock[0] += seconds
+        server.runTimers()
+
+    def connect(path, stdin=True):
+        # a connection with a request, ended when stdin is
+        a, b = socket.socketpair()
+        a.setblocking(0)
+        p = selectfcgi.FastCGIProtocol(a, None)
+        p.handleConnect(server)
+        server.addProtocol(p, selectserver.READ)
+        b.sendall(makeDiscreteRecord(FCGI_BEGIN_REQUEST, 1, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+            makeStreamRecord(FCGI_PARAMS, 1, ''.join(dictToPairs({'SCRIPT_NAME': path}))) +
+            makeStreamRecord(FCGI_PARAMS, 1, ''))
+        if stdin:
+            b.sendall(makeStreamRecord(FCGI_STDIN, 1, ''))
+        server.handleReadable(p)
+        return p, p.fileno(), b
+
+    clock = [1000.0]
+    server = selectfcgi.FastCGIServer(None, handler)
+    server.clock = lambda: clock[0]
+    server.poller = selectserver.SelectPoller()
+    server.protocols = {}
+    server.interest = {}
+    server.timers = []
+    server.now = clock[0]
+    server.fcgiProcessor = FastCGIProcessor()
+    server.fcgiProcessor.callLater = server.callLater
+
+    # calls run in time order, cancelled ones do not
+    calls = []
+    server.callLater(2, calls.append, 'b')
+    server.callLater(1, calls.append, 'a')
+    server.callLater(1.5, calls.append, 'x').cancel()
+    assert server.pollTimeout() == 1
+    advance(1)
+    assert calls == ['a']
+    advance(1)
+    assert calls == ['a', 'b'] and not server.timers
+
+    # closed once idle for idleTimeout, not while a request runs
+    server.idleTimeout = 10
+    p, fd, b = connect('/', stdin=False)
+    advance(30)
+    assert fd in server.protocols
+    b.sendall(makeStreamRecord(FCGI_STDIN, 1, ''))
+    server.handleReadable(p)
+    assert not p.connectionState.requestsPool
+    advance(9)
+    assert fd in server.protocols
+    advance(1)
+    assert fd not in server.protocols
+    assert splitRecords(b.recv(65536))[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+    b.close()
+
+    # a request running for requestTimeout is ended with an error
+    server.idleTimeout = 0
+    server.fcgiProcessor.requestTimeout = 5
+    p, fd, b = connect('/', stdin=False)
+    advance(4)
+    assert p.connectionState.requestsPool
+    advance(1)
+    assert not p.connectionState.requestsPool and server.fcgiProcessor.timedOutCount == 1
+    records = splitRecords(b.recv(65536))
+    assert records[0][0][FCGI_Header_TYPE] == FCGI_STDERR and 'timed out' in records[0][1]
+    assert _unpack(FCGI_EndRequestBody, records[-1][1])[0] == 1
+    server.closeProtocol(p, False)
+    b.close()
+
+    # closed once its output did not progress for writeTimeout
+    server.fcgiProcessor.requestTimeout = 0
+    server.writeTimeout = 3
+    p, fd, b = connect('/big')
+    assert p.outputbuffer
+    advance(2)
+    b.recv(65536)
+    server.handleWritable(p)
+    advance(2)
+    assert fd in server.protocols and p.outputbuffer
+    advance(1)
+    assert fd not in server.protocols
+    b.close()
+
+def testtwisted():
+    try:
+        import twistedfcgi
+        from twisted.internet import defer
+        from twisted.test import proto_helpers
+    except ImportError:
+        # twisted is not installed
+        return
+
+    def handler(request, type, content):
+        events.append((request.requestId, type))
+        if request.requestId == 1 and type == FCGI_PARAMS:
+            # the next events of request 1 wait for it
+            deferreds.append(defer.Deferred())
+            return deferreds[-1]
+        if type == FCGI_STDIN and content is None:
+            if request.requestId == 3:
+                # waits while the transport buffer is full
+                d = request.drain()
+                d.addCallback(lambda _: request.write('drained'))
+                return d
+            request.write('done')
+            return
+        return 1
+
+    def requests(*ids):
+        input = ''
+        for i in ids:
+            input += makeDiscreteRecord(FCGI_BEGIN_REQUEST, i, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN)
+            input += makeStreamRecord(FCGI_PARAMS, i, '')
+            input += makeStreamRecord(FCGI_STDIN, i, 'a')
+            input += makeStreamRecord(FCGI_STDIN, i, '')
+        return input
+
+    def ended():
+        return [h[FCGI_Header_REQUESTID] for h, c in splitRecords(transport.value())
+            if h[FCGI_Header_TYPE] == FCGI_END_REQUEST]
+
+    events = []
+    deferreds = []
+    factory = twistedfcgi.FastCGIFactory(handler)
+    factory.startFactory()
+    p = factory.buildProtocol(None)
+    transport = proto_helpers.StringTransport()
+    p.makeConnection(transport)
+    assert transport.producer is p and transport.streaming
+
+    # request 2 is handled while request 1 waits for its Deferred
+    p.dataReceived(requests(1, 2))
+    assert events == [(1, FCGI_PARAMS), (2, FCGI_PARAMS), (2, FCGI_STDIN), (2, FCGI_STDIN)]
+    assert ended() == [2]
+    deferreds[0].callback(1)
+    assert events[-2:] == [(1, FCGI_STDIN), (1, FCGI_STDIN)] and ended() == [2, 1]
+
+    # a full transport pauses reading and the handlers waiting on drain()
+    p.pauseProducing()
+    assert transport.producerState == 'paused'
+    p.dataReceived(requests(3))
+    assert ended() == [2, 1] and 'drained' not in transport.value()
+    p.resumeProducing()
+    assert transport.producerState == 'producing'
+    assert ended() == [2, 1, 3] and 'drained' in transport.value()
+
+    p.connectionLost(None)
+    factory.stopFactory()
+
+def testasyncio():
+    try:
+        import asynciofcgi
+    except ImportError:
+        # neither asyncio nor trollius is installed
+        return
+    asyncio = asynciofcgi.asyncio
+
+    class Transport(object):
+        def __init__(self):
+            self.data = []
+            self.reading = True
+            self.closed = False
+        def write(self, data):
+            self.data.append(data)
+        def close(self):
+            self.closed = True
+        def get_write_buffer_size(self):
+            return 0
+        def pause_reading(self):
+            self.reading = False
+        def resume_reading(self):
+            self.reading = True
+
+    def handler(request, type, content):
+        events.append((request.requestId, type))
+        if request.requestId == 1 and type == FCGI_PARAMS:
+            # the next events of request 1 wait for it
+            futures.append(asyncio.Future(loop=loop))
+            return futures[-1]
+        if type == FCGI_STDIN and content is None:
+            request.write('done')
+            return
+        return 1
+
+    def ended():
+        return [h[FCGI_Header_REQUESTID] for h, c in splitRecords(''.join(transport.data))
+            if h[FCGI_Header_TYPE] == FCGI_END_REQUEST]
+
+    events = []
+    futures = []
+    loop = asyncio.new_event_loop()
+    server = asynciofcgi.FastCGIServer(handler, loop)
+    p = server()
+    transport = Transport()
+    p.connection_made(transport)
+
+    # request 2 is handled while request 1 waits for its future
+    input = ''
+    for i in (1, 2):
+        input += makeDiscreteRecord(FCGI_BEGIN_REQUEST, i, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN)
+        input += makeStreamRecord(FCGI_PARAMS, i, '')
+        input += makeStreamRecord(FCGI_STDIN, i, 'a')
+        input += makeStreamRecord(FCGI_STDIN, i, '')
+    p.data_received(input)
+    assert events == [(1, FCGI_PARAMS), (2, FCGI_PARAMS), (2, FCGI_STDIN), (2, FCGI_STDIN)]
+    assert ended() == [2]
+    futures[0].set_result(1)
+    loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    assert events[-2:] == [(1, FCGI_STDIN), (1, FCGI_STDIN)] and ended() == [2, 1]
+
+    # a full transport pauses reading and the drain() futures
+    p.pause_writing()
+    assert not transport.reading
+    waiter = p.drain()
+    assert not waiter.done()
+    p.resume_writing()
+    assert waiter.done() and transport.reading
+
+    p.connection_lost(None)
+    loop.close()
+
+def testcancel():
+    events = []
+    cancelled = []
+
+    def handler(request, type, content):
+        events.append((request.requestId, type, content))
+        if type == FCGI_PARAMS:
+            request.addCancelCallback(lambda request: cancelled.append((request.requestId, request.cancelReason)))
+        return 1
+
+    writes = []
+    processor = FastCGIProcessor()
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+    input = ''
+    for i in (1, 2):
+        input += makeDiscreteRecord(FCGI_BEGIN_REQUEST, i, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN)
+        input += makeStreamRecord(FCGI_PARAMS, i, '')
+    processor.processRawInput(cs, input)
+    processor.generateOutput(handler)
+
+    # the stdin queued before the abort is not handled
+    processor.processRawInput(cs, makeStreamRecord(FCGI_STDIN, 1, 'abc') + makeStreamRecord(FCGI_ABORT_REQUEST, 1, ''))
+    processor.generateOutput(handler)
+    assert events[-1] == (1, FCGI_ABORT_REQUEST, None) and (1, FCGI_STDIN, 'abc') not in events
+    assert cancelled == [(1, 'abort')]
+    assert cs.queuedInput == 0
+
+    # the connection is lost, output is discarded
+    request = cs.getRequest(2)
+    processor.processRawInput(cs, makeStreamRecord(FCGI_STDIN, 2, 'abc'))
+    cs.cleanup()
+    assert cancelled == [(1, 'abort'), (2, 'disconnect')]
+    assert request.ended and request.cancelled
+    request.write('nobody reads this')
+    request.end()
+    processor.generateOutput(handler)
+    assert (2, FCGI_STDIN, 'abc') not in events
+    assert FastCGIConnectionState.processQueuedInput == 0
+
+    # callbacks added late are called right away
+    request.addCancelCallback(lambda request: cancelled.append(request.requestId))
+    assert cancelled[-1] == 2
+
+def testbatchinput():
+    events = []
+
+    def handler(request, type, content):
+        events.append((request.requestId, type, content))
+        return 1
+
+    processor = FastCGIProcessor()
+    processor.batchInput = 8
+    cs = FastCGIConnectionState(lambda: None, lambda data: None)
+    input = ''
+    for i in (1, 2):
+        input += makeDiscreteRecord(FCGI_BEGIN_REQUEST, i, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN)
+        input += makeStreamRecord(FCGI_PARAMS, i, '')
+    for chunk in ('abc', 'def', 'ghi'):
+        input += makeStreamRecord(FCGI_STDIN, 1, chunk)
+    input += makeStreamRecord(FCGI_STDIN, 2, 'xyz')
+    input += makeStreamRecord(FCGI_STDIN, 1, 'jk')
+    input += makeStreamRecord(FCGI_STDIN, 1, '')
+    processor.processRawInput(cs, input)
+    processor.generateOutput(handler)
+
+    # adjacent chunks are merged up to batchInput, other requests and
+    # the end of the stream are not
+    assert events == [
+        (1, FCGI_PARAMS, None), (2, FCGI_PARAMS, None),
+        (1, FCGI_STDIN, 'abcdef'), (1, FCGI_STDIN, 'ghi'),
+        (2, FCGI_STDIN, 'xyz'), (1, FCGI_STDIN, 'jk'), (1, FCGI_STDIN, None),
+        ], events
+    assert cs.queuedInput == 0
+
+    # same with memoryviews
+    events[:] = []
+    processor.zeroCopyInput = True
+    processor.processRawInput(cs, makeStreamRecord(FCGI_STDIN, 2, 'a') + makeStreamRecord(FCGI_STDIN, 2, 'b'))
+    processor.generateOutput(handler)
+    assert events == [(2, FCGI_STDIN, 'ab')], events
+    assert cs.queuedInput == 0
+
+def testfairoutput():
+    writes = []
+
+    def handler(request, type, content):
+        if type == FCGI_STDIN and not content:
+            if request.requestId < 3:
+                request.write(memoryview('%i' % request.requestId * 300000))
+            else:
+                request.write('small')
+            return 0
+        return 1
+
+    def begin(requestId, priority=1):
+        processor.processRawInput(cs,
+            makeDiscreteRecord(FCGI_BEGIN_REQUEST, requestId, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+            makeStreamRecord(FCGI_PARAMS, requestId, ''))
+        cs.getRequest(requestId).priority = priority
+
+    def finish(requestId):
+        processor.processRawInput(cs, makeStreamRecord(FCGI_STDIN, requestId, ''))
+        processor.generateOutput(handler)
+
+    def stdout(records, requestId):
+        return ''.join(c for h, c in records
+            if h[FCGI_Header_TYPE] == FCGI_STDOUT and h[FCGI_Header_REQUESTID] == requestId)
+
+    processor = FastCGIProcessor()
+    processor.fairOutput = True
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+    for requestId in (1, 2, 3):
+        begin(requestId, requestId == 2 and 3 or 1)
+    finish(1)
+    finish(2)
+    finish(3)
+    scheduler = writes.pop()
+    assert isinstance(scheduler, OutputScheduler) and not writes, writes
+
+    # the short response does not wait for the bulk ones, they are
+    # interleaved at record boundaries, 3:1 by priority
+    output = []
+    while len(scheduler):
+        output.append(scheduler.read())
+    records = splitRecords(''.join(output[:3]))
+    ends = [h[FCGI_Header_REQUESTID] for h, c in records if h[FCGI_Header_TYPE] == FCGI_END_REQUEST]
+    assert ends == [3] and stdout(records, 3) == 'small'
+    records = splitRecords(''.join(output[3:7]))
+    assert len(stdout(records, 2)) == 3 * len(stdout(records, 1)) > 0
+    records = splitRecords(''.join(output))
+    assert stdout(records, 1) == '1' * 300000 and stdout(records, 2) == '2' * 300000
+    assert not scheduler.queued
+
+    # written again once there is more output, sent as the socket takes it
+    class Socket(object):
+        def __init__(self):
+            self.received = []
+        def send(self, data):
+            data = asString(data)[:1000]
+            self.received.append(data)
+            return len(data)
+
+    begin(4)
+    finish(4)
+    assert writes.pop() is scheduler
+    sock = Socket()
+    while len(scheduler):
+        assert scheduler.sendTo(sock)
+    records = splitRecords(''.join(sock.received))
+    assert stdout(records, 4) == 'small' and records[-1][0][FCGI_Header_TYPE] == FCGI_END_REQUEST
+
+    # files sent by multiplexed requests are interleaved a record at a time
+    import tempfile
+    body = ''.join([chr(random.randint(0, 255)) for i in xrange(150001)])
+    spool = tempfile.TemporaryFile()
+    spool.write(body)
+    spool.flush()
+    for requestId in (5, 6):
+        begin(requestId)
+        cs.getRequest(requestId).sendfile(spool)
+        cs.getRequest(requestId).end()
+    assert writes.pop() is scheduler
+    output = []
+    while len(scheduler):
+        output.append(scheduler.read())
+    records = splitRecords(''.join(output))
+    assert [h[FCGI_Header_REQUESTID] for h, c in records][:4] == [5, 6, 5, 6]
+    assert stdout(records, 5) == body and stdout(records, 6) == body
+
+def testlanes():
+    calls = []
+    writes = []
+
+    def handler(request, type, content):
+        calls.append((request.requestId, type))
+        return not (type == FCGI_STDIN and content is None)
+
+    def begin(requestId, path):
+        processor.processRawInput(cs,
+            makeDiscreteRecord(FCGI_BEGIN_REQUEST, requestId, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+            makeStreamRecord(FCGI_PARAMS, requestId, ''.join(dictToPairs({'SCRIPT_NAME': path}))) +
+            makeStreamRecord(FCGI_PARAMS, requestId, '') +
+            makeStreamRecord(FCGI_STDIN, requestId, 'body'))
+        processor.generateOutput(handler)
+
+    def finish(requestId):
+        processor.processRawInput(cs, makeStreamRecord(FCGI_STDIN, requestId, ''))
+        processor.generateOutput(handler)
+
+    processor = FastCGIProcessor()
+    export = Lane('export', prefixes=['/export'], concurrency=1, queueSize=1)
+    other = Lane('other')
+    processor.lanes = [export, other]
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+
+    # one export runs, the next one waits, the one after is shed
+    begin(1, '/export/a')
+    begin(2, '/export/b')
+    begin(3, '/export/c')
+    assert calls == [(1, FCGI_PARAMS), (1, FCGI_STDIN)], calls
+    assert export.running == 1 and list(export.waiting) == [cs.getRequest(2)]
+    assert export.shedCount == 1 and 3 not in cs.requestsPool
+    assert processor.overloadedResponse in ''.join(map(asString, writes))
+
+    # the other lane is not held
+    begin(4, '/health')
+    finish(4)
+    assert calls[-3:] == [(4, FCGI_PARAMS), (4, FCGI_STDIN), (4, FCGI_STDIN)] and 4 not in cs.requestsPool
+    assert cs.getRequest(1).lane is export and other.running == 0
+
+    # once the running export ends, the waiting one gets its events in order
+    finish(2)
+    assert calls[-1][0] == 4
+    finish(1)
+    assert calls[-4:] == [(1, FCGI_STDIN), (2, FCGI_PARAMS), (2, FCGI_STDIN), (2, FCGI_STDIN)], calls
+    assert export.running == 0 and not export.waiting and not export.held
+
+    # an aborted request leaves the queue without running
+    begin(5, '/export/d')
+    begin(6, '/export/e')
+    aborted = cs.getRequest(6)
+    processor.processRawInput(cs, makeStreamRecord(FCGI_ABORT_REQUEST, 6, ''))
+    processor.generateOutput(handler)
+    assert not export.waiting and (6, FCGI_PARAMS) not in calls and (6, FCGI_ABORT_REQUEST) not in calls
+    assert processor.shedCount == 1 and aborted.dropped and not aborted.shed
+    finish(5)
+    assert export.running == 0 and cs.queuedInput == 0
+
+    # prefixes match whole path segments
+    begin(7, '/exporter')
+    begin(8, '/exports-old')
+    assert cs.getRequest(7).lane is other and cs.getRequest(8).lane is other
+    finish(7)
+    finish(8)
+    begin(9, '/export')
+    assert cs.getRequest(9).lane is export
+    finish(9)
+
+def testrouter():
+    import router
+
+    calls = []
+
+    def endpoint(name):
+        def handler(request, type, content):
+            calls.append((name, request.pathArgs, type))
+            return not (type == FCGI_STDIN and content is None)
+        return handler
+
+    routes = router.Router()
+    for i in xrange(300):
+        routes.add('/api/v%i/items' % i, endpoint('items%i' % i))
+        routes.add('/api/v%i/items/{id}' % i, endpoint('item%i' % i), methods=('GET',))
+    routes.add('/api/v1/items/new', endpoint('new'))
+    routes.add('/api/v1/items/{id}/tags/{tag}', endpoint('tag'))
+    routes.add('/files/{path:path}', endpoint('files'))
+
+    assert routes.match('/api/v299/items')[1] == {}
+    assert routes.match('/api/v7/items/42/')[1] == {'id': '42'}
+    assert routes.match('/api/v1/items/new')[0][None].__name__ == 'handler'
+    assert routes.match('/api/v1/items/3/tags/x')[1] == {'id': '3', 'tag': 'x'}
+    assert routes.match('/files/a/b.txt')[1] == {'path': 'a/b.txt'}
+    assert routes.match('/api/v1/items/3/other') == (None, None)
+    try:
+        routes.add('/api/v1/items/{other}', endpoint('x'))
+    except ValueError:
+        pass
+    else:
+        assert False, 'conflicting argument names'
+
+    writes = []
+    processor = FastCGIProcessor()
+    cs = FastCGIConnectionState(lambda: None, writes.append)
+
+    def request(requestId, path, method):
+        params = {'SCRIPT_NAME': path, 'REQUEST_METHOD': method}
+        processor.processRawInput(cs,
+            makeDiscreteRecord(FCGI_BEGIN_REQUEST, requestId, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+            makeStreamRecord(FCGI_PARAMS, requestId, ''.join(dictToPairs(params))) +
+            makeStreamRecord(FCGI_PARAMS, requestId, '') +
+            makeStreamRecord(FCGI_STDIN, requestId, ''))
+        processor.generateOutput(routes)
+        output = ''.join(map(asString, writes))
+        del writes[:]
+        return output
+
+    # the endpoint gets every event of the request
+    request(1, '/api/v5/items/9', 'GET')
+    assert calls == [('item5', {'id': '9'}, FCGI_PARAMS), ('item5', {'id': '9'}, FCGI_STDIN)], calls
+    assert '404' in request(2, '/nowhere', 'GET')
+    output = request(3, '/api/v5/items/9', 'POST')
+    assert '405' in output and 'Allow: GET, HEAD\r\n' in output
+    request(4, '/api/v5/items/9', 'HEAD')
+    assert len(calls) == 4 and calls[-1][0] == 'item5' and not cs.requestsPool
+
+def testresponsecache():
+    import responsecache
+
+    calls = []
+    headers = {
+        '/private': 'Cache-Control: private\r\n',
+        '/plain': '',                           # no opt in
+        '/vary': 'Cache-Control: max-age=30\r\nVary: Accept-Encoding\r\n',
+        '/me': 'Cache-Control: max-age=30\r\n',  # not public
+    }
+
+    def handler(request, type, content):
+        calls.append((request.requestId, type))
+        if type == FCGI_PARAMS:
+            uri = request.params['REQUEST_URI']
+            request.write('Content-Type: text/plain\r\n')
+            request.write(headers.get(uri, 'Cache-Control: public, max-age=30\r\n'))
+            request.write('\r\n' + uri * 100)
+        return not (type == FCGI_STDIN and content is None)
+
+    writes = []
+    processor = FastCGIProcessor()
+    cs = FastCGIConnectionState(lambda: None, lambda *pieces: writes.append(pieces))
+    cache = responsecache.ResponseCache(handler, maxSize=900)
+
+    def request(requestId, uri, method='GET', **params):
+        params.update({'REQUEST_URI': uri, 'REQUEST_METHOD': method})
+        processor.processRawInput(cs,
+            makeDiscreteRecord(FCGI_BEGIN_REQUEST, requestId, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+            makeStreamRecord(FCGI_PARAMS, requestId, ''.join(dictToPairs(params))) +
+            makeStreamRecord(FCGI_PARAMS, requestId, '') +
+            makeStreamRecord(FCGI_STDIN, requestId, ''))
+        processor.generateOutput(cache)
+        records = splitRecords(''.join(''.join(map(asString, pieces)) for pieces in writes))
+        count = len(writes)
+        del writes[:]
+        return records, count
+
+    # a hit is written at once, with the request id of the request
+    first, count = request(1, '/a')
+    assert cache.misses == 1 and len(calls) == 2
+    second, count = request(2, '/a')
+    assert cache.hits == 1 and len(calls) == 2 and count == 1
+    assert [(h[1], c) for h, c in first] == [(h[1], c) for h, c in second]
+    assert set(h[FCGI_Header_REQUESTID] for h, c in second) == set([2])
+    assert not cs.requestsPool
+
+    # neither POSTs nor responses that do not opt in, or vary on
+    # other headers, are cached
+    for uri in ('/private', '/plain', '/vary'):
+        request(3, uri)
+        request(4, uri)
+    request(5, '/a', 'POST')
+    assert cache.hits == 1 and len(calls) == 16
+
+    # nor are they shared among hosts, or with requests with credentials
+    del calls[:]
+    cache.maxSize = 4000
+    request(1, '/a', HTTP_HOST='b.example')
+    request(2, '/me', HTTP_COOKIE='sid=alice')
+    request(3, '/me')
+    request(4, '/me', HTTP_AUTHORIZATION='Basic Ym9i')
+    request(5, '/me')
+    request(6, '/a', HTTP_COOKIE='sid=bob')
+    assert [call[0] for call in calls] == [1, 1, 2, 2, 3, 3, 4, 4]
+    assert cache.hits == 3
+
+    # expired and least recently used responses are dropped
+    cache.clear()
+    cache.maxSize = 900
+    request(6, '/b')
+    request(7, '/a')
+    request(8, '/c')
+    request(9, '/a')
+    request(10, '/d')
+    assert cache.evictions == 2 and [key[2] for key in cache.entries] == ['/a', '/d']
+    assert cache.size <= cache.maxSize
+    cache.entries[('GET', '', '/a')].expires = 0
+    request(11, '/a')
+    assert cache.hits == 4 and calls[-1] == (11, FCGI_STDIN)
+
+def testsingleflight():
+    import singleflight
+
+    class Executor(object):
+        # runs the calls when told so, like a busy thread pool
+        def __init__(self):
+            self.calls = []
+        def dispatch(self, requestState, function, *args):
+            self.calls.append((function, args))
+        def run(self):
+            calls = self.calls
+            self.calls = []
+            for function, args in calls:
+                function(*args)
+
+    class Call(object):
+        def __init__(self, function, args):
+            self.function = function
+            self.args = args
+            self.cancelled = False
+        def cancel(self):
+            self.cancelled = True
+
+    def callLater(delay, function, *args):
+        timers.append(Call(function, args))
+        return timers[-1]
+
+    def handler(request, type, content):
+        calls.append((request.requestId, type))
+        if type == FCGI_PARAMS:
+            if request.params['REQUEST_URI'] == '/fail':
+                request.end(1)
+                return
+            if request.params['REQUEST_URI'] == '/login':
+                request.write('Set-Cookie: sid=%i\r\n' % request.requestId)
+            request.write('Content-Type: text/plain\r\n\r\n' + request.params['REQUEST_URI'])
+        return not (type == FCGI_STDIN and content is None)
+
+    def begin(cs, requestId, uri, **params):
+        params.update({'REQUEST_URI': uri, 'REQUEST_METHOD': 'GET'})
+        processor.processRawInput(cs,
+            makeDiscreteRecord(FCGI_BEGIN_REQUEST, requestId, FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN) +
+            makeStreamRecord(FCGI_PARAMS, requestId, ''.join(dictToPairs(params))) +
+            makeStreamRecord(FCGI_PARAMS, requestId, '') +
+            makeStreamRecord(FCGI_STDIN, requestId, ''))
+
+    def output(writes):
+        records = splitRecords(''.join(''.join(map(asString, pieces)) for pieces in writes))
+        del writes[:]
+        return records
+
+    calls = []
+    timers = []
+    writes1 = []
+    writes2 = []
+    processor = FastCGIProcessor()
+    processor.executor = Executor()
+    processor.callLater = callLater
+    processor.coalescer = coalescer = singleflight.SingleFlight(maxWait=5)
+    cs1 = FastCGIConnectionState(lambda: None, lambda *pieces: writes1.append(pieces))
+    cs2 = FastCGIConnectionState(lambda: None, lambda *pieces: writes2.append(pieces))
+
+    # the identical requests, on both connections, wait for the first
+    # one and get its records with their own request id
+    begin(cs1, 1, '/a')
+    begin(cs1, 2, '/a')
+    begin(cs2, 1, '/a')
+    begin(cs1, 3, '/b')
+    processor.generateOutput(handler)
+    processor.executor.run()
+    assert calls == [(1, FCGI_PARAMS), (1, FCGI_STDIN), (3, FCGI_PARAMS), (3, FCGI_STDIN)]
+    records = output(writes1)
+    first = [(h[FCGI_Header_TYPE], c) for h, c in records if h[FCGI_Header_REQUESTID] == 1]
+    second = [(h[FCGI_Header_TYPE], c) for h, c in records if h[FCGI_Header_REQUESTID] == 2]
+    assert first == second and first[0] == (FCGI_STDOUT, 'Content-Type: text/plain\r\n\r\n/a')
+    assert [(h[FCGI_Header_TYPE], c) for h, c in output(writes2)] == first
+    assert not cs1.requestsPool and not cs2.requestsPool
+    assert coalescer.coalescedCount == 2 and not coalescer.flights and not coalescer.held
+    assert len(timers) == 2 and timers[0].cancelled and timers[1].cancelled
+    assert not coalescer.deadlines
+
+    # they run their handler when the first one fails, or once they
+    # waited for maxWait
+    del calls[:]
+    del timers[:]
+    begin(cs1, 1, '/fail')
+    begin(cs1, 2, '/fail')
+    begin(cs1, 3, '/a')
+    begin(cs1, 4, '/a')
+    begin(cs2, 1, '/a')
+    processor.generateOutput(handler)
+    assert [args[1].requestId for function, args in processor.executor.calls] == [1, 1, 3, 3]
+    cs2.requestsPool[1].end(1)
+    assert len(timers) == 3
+    timers[1].function(*timers[1].args)
+    processor.executor.run()
+    processor.executor.run()
+    assert sorted(calls) == [(1, FCGI_PARAMS), (1, FCGI_STDIN), (2, FCGI_PARAMS), (2, FCGI_STDIN),
+        (3, FCGI_PARAMS), (3, FCGI_STDIN), (4, FCGI_PARAMS), (4, FCGI_STDIN)]
+    assert not cs1.requestsPool and not cs2.requestsPool
+    assert coalescer.fallbackCount == 2 and coalescer.coalescedCount == 2
+    assert not coalescer.flights and not coalescer.held and not coalescer.deadlines
+
+    # requests with credentials do not wait, nor are responses meant for
+    # one user shared
+    del calls[:]
+    begin(cs1, 1, '/a', HTTP_COOKIE='sid=alice')
+    begin(cs1, 2, '/a', HTTP_COOKIE='sid=bob')
+    begin(cs1, 3, '/a', HTTP_AUTHORIZATION='Basic Ym9i')
+    begin(cs1, 4, '/login')
+    begin(cs1, 5, '/login')
+    processor.generateOutput(handler)
+    processor.executor.run()
+    processor.executor.run()
+    assert sorted(set(call[0] for call in calls)) == [1, 2, 3, 4, 5]
+    records = output(writes1)
+    assert [c for h, c in records if h[FCGI_Header_REQUESTID] == 5][0].startswith('Set-Cookie: sid=5\r\n')
+    assert coalescer.fallbackCount == 3 and coalescer.coalescedCount == 2
+    assert not coalescer.flights and not coalescer.held and not coalescer.deadlines
+
 if __name__ == '__main__':
     testnamevalues()
+    testpairreader()
+    testenvironment()
     testprocessor()
     testunknowrole()
     testgetvalues()
+    testcorkedoutput()
+    testlargewrite()
+    testfilerecords()
+    testrawinput()
+    testthreadpool()
+    testprocesspool()
+    testbackpressure()
+    teststream()
+    testadmission()
+    testrequesttimeout()
+    testtimers()
+    testtwisted()
+    testasyncio()
+    testcancel()
+    testbatchinput()
+    testfairoutput()
+    testlanes()
+    testrouter()
+    testresponsecache()
+    testsingleflight()
@@ -34,7 +34,7 @@ def handler(request, type, content):
         request.write('content-type: text/plain\r\n\r\n')
         request.write('request id: %i\n' % request.requestId)
         request.write('role: %s\n' % fastcgi.FCGI_ROLE_NAMES[request.role])
-        request.write(pprint.pformat(request.params))
+        request.write(pprint.pformat(dict(request.params)))
         request.write('\n')
 
     if content:
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''a fastcgi application on asyncio, the handler is a coroutine that
+waits without blocking other requests
+'''
+
+# NO_PROXY=\* curl http://localhost:8020/
+
+import os
+import stat
+import sys
+
+import fastcgi
+import asynciofcgi
+
+asyncio = asynciofcgi.asyncio
+
+@asyncio.coroutine
+def handler(request, type, content):
+    if type == fastcgi.FCGI_PARAMS:
+        request.write('content-type: text/plain\r\n\r\n')
+        request.write('request id: %i\n' % request.requestId)
+        for i in xrange(3):
+            # e.g.: a database query
+            yield asyncio.From(asyncio.sleep(1))
+            request.write('waited %i second(s)\n' % (i + 1))
+            yield asyncio.From(request.drain())
+
+    if type == fastcgi.FCGI_STDIN and not content:
+        request.write('we\'re done, received %i calls\n' % (request.callCount,))
+        raise asyncio.Return(None)
+
+    raise asyncio.Return(1)        # not done yet
+
+def test():
+    if stat.S_ISSOCK(os.fstat(fastcgi.FCGI_LISTENSOCK_FILENO)[stat.ST_MODE]):
+        print 'using pre-set fastcgi environment'
+        sys.stdout.flush()
+        address = fastcgi.FCGI_LISTENSOCK_FILENO
+    else:
+        address = 'fcgi.socket'
+
+    try:
+        asynciofcgi.FastCGIServer(handler).run(address)
+    except KeyboardInterrupt:
+        if address == 'fcgi.socket':
+            os.unlink(address)
+
+if __name__ == '__main__':
+    test()
@@ -20,7 +20,7 @@ def handler(request, type, content):
 
         request.write('request id: %i\n' % request.requestId)
         request.write('role: %s\n' % fastcgi.FCGI_ROLE_NAMES[request.role])
-        request.write(pprint.pformat(request.params))
+        request.write(pprint.pformat(dict(request.params)))
         request.write('\n')
 
     if content:
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+'''pre-forked worker processes sharing a listening socket, so a
+single threaded server makes use of more than one cpu (see
+selectfcgi.FastCGIServer.runWorkers and twistedfcgi.runWorkers)
+
+everything imported before forking (e.g.: the handler and its
+dependencies) is shared copy-on-write by the workers
+'''
+
+import os
+import sys
+import time
+import errno
+import signal
+import traceback
+
+try:
+    _pagesize = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _pagesize = 4096
+
+def residentSize(pid):
+    '''resident set size of a process in bytes, 0 if unknown (linux
+    only, reads /proc)
+    '''
+    try:
+        f = open('/proc/%i/statm' % pid)
+        try:
+            return int(f.read().split()[1]) * _pagesize
+        finally:
+            f.close()
+    except (IOError, ValueError, IndexError):
+        return 0
+
+class Supervisor(object):
+    '''forks workers processes that run worker(), respawns the ones
+    that exit and recycles the ones above maxRSS bytes (0 disables
+    it), workers must finish their work and exit on SIGTERM
+    '''
+
+    checkInterval = 1.0     # seconds between checks
+    gracePeriod = 30.0      # seconds a worker has to exit after SIGTERM
+
+    def __init__(self, worker, workers, maxRSS=0):
+        self.worker = worker
+        self.workers = workers
+        self.maxRSS = maxRSS
+        self.children = {}      # pid -> time SIGTERM was sent or None
+        self.running = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                # the supervisor tells workers when to stop
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self.worker()
+            except:
+                traceback.print_exc(file=sys.stdout)
+                status = 1
+            sys.stdout.flush()
+            os._exit(status)
+
+        self.children[pid] = None
+
+    def terminate(self, pid):
+        if self.children.get(pid, 0) is None:
+            self.children[pid] = time.time()
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno == errno.ECHILD:
+                    self.children.clear()
+                    break
+                raise
+
+            if not pid:
+                break
+
+            recycled = self.children.pop(pid, None)
+            # workers exit with status 0 when done (e.g.: maxRequests)
+            if recycled is None and status and self.running:
+                print 'worker %i exited unexpectedly, status %i' % (pid, status)
+
+    def check(self):
+        now = time.time()
+        for pid, terminated in self.children.items():
+            if terminated is None:
+                if self.maxRSS and residentSize(pid) > self.maxRSS:
+                    print 'recycling worker %i, resident size above %i bytes' % (pid, self.maxRSS)
+                    self.terminate(pid)
+            elif now - terminated > self.gracePeriod:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def numWorkers(self):
+        '''workers running and not being recycled
+        '''
+        return len([t for t in self.children.itervalues() if t is None])
+
+    def run(self):
+        '''fork the workers and supervise them until SIGTERM or SIGINT
+        '''
+        def stop(signum, frame):
+            self.running = False
+
+        handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            handlers[signum] = signal.signal(signum, stop)
+
+        self.running = True
+        try:
+            while self.running:
+                self.reap()
+                # recycled workers are replaced right away
+                for i in xrange(self.workers - self.numWorkers()):
+                    self.spawn()
+                self.check()
+                time.sleep(self.checkInterval)
+        finally:
+            self.running = False
+            for pid in self.children.keys():
+                self.terminate(pid)
+            while self.children:
+                self.reap()
+                self.check()
+                time.sleep(0.1)
+
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
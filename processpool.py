@@ -0,0 +1,550 @@
+# -*- coding: utf-8 -*-
+
+'''runs the handler of selected FastCGI requests in worker processes,
+for CPU bound handlers that threads do not help because of the GIL
+(see fastcgi.FastCGIProcessor.executor)
+
+a selected request is spooled to a file (in /dev/shm when available,
+so it stays in memory): FCGI_PARAMS as name-value pairs, followed by
+FCGI_STDIN, FCGI_DATA goes to a second file. once complete, a worker
+process maps the files and replays the usual handler events:
+
+    handler(request, FCGI_PARAMS, None)
+    handler(request, FCGI_STDIN, content)   # the whole body, if any
+    handler(request, FCGI_STDIN, None)
+    handler(request, FCGI_DATA, content)    # FCGI_FILTER only
+    handler(request, FCGI_DATA, None)
+
+content is a read only buffer of the mapped file, request is an
+OffloadedRequest. the output is streamed back to the request state
+of the connection as the worker writes it
+'''
+
+import os
+import sys
+import mmap
+import errno
+import signal
+import struct
+import tempfile
+import socket
+import threading
+import traceback
+import Queue
+
+# the pipes of the workers forked by a Spawner are passed with these
+from _multiprocessing import sendfd, recvfd
+
+import fastcgi
+import threadpool
+
+from fastcgi import FCGI_PARAMS, FCGI_STDIN, FCGI_DATA, FCGI_ABORT_REQUEST, \
+    FCGI_STDOUT, FCGI_STDERR, FCGI_END_REQUEST, FCGI_FILTER, FCGI_REQUEST_COMPLETE
+
+if os.path.isdir('/dev/shm'):
+    spoolDir = '/dev/shm'
+else:
+    spoolDir = None             # tempfile default
+
+# request id, role, keep connection, params, stdin and data lengths,
+# lengths of the spool file paths
+_jobStruct = struct.Struct('!HBBIQQHH')
+
+# output message type (FCGI_STDOUT, FCGI_STDERR or FCGI_END_REQUEST)
+# and length
+_messageStruct = struct.Struct('!BI')
+_endStruct = struct.Struct('!IB')
+
+# the pid of a worker forked by a Spawner
+_pidStruct = struct.Struct('!i')
+
+try:
+    _maxfd = os.sysconf('SC_OPEN_MAX')
+except (AttributeError, ValueError, OSError):
+    _maxfd = 256
+
+def _readExactly(fd, size):
+    pieces = []
+    while size:
+        try:
+            data = os.read(fd, size)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        if not data:
+            raise EOFError
+        pieces.append(data)
+        size -= len(data)
+    return ''.join(pieces)
+
+def _writeAll(fd, data):
+    while data:
+        try:
+            sent = os.write(fd, data)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        data = buffer(data, sent)
+
+class OffloadedRequest(object):
+    '''what handlers running in a worker process get instead of a
+    FastCGIRequestState, output is sent to the server process
+    '''
+
+    # written at once when there is this much
+    outputThreshold = 65536
+
+    def __init__(self, fd, requestId, role, keepConnection, params):
+        self.fd = fd
+        self.requestId = requestId
+        self.role = role
+        self.keepConnection = keepConnection
+        self.params = params
+        self.callCount = 0
+        self.stdinLength = 0
+        self.dataLength = 0
+        self.appStatus = 0
+        self.ended = False
+
+        self.output = []
+        self.outputSize = 0
+
+    def _send(self, type, data):
+        if self.ended:
+            return
+        self.output.append(_messageStruct.pack(type, len(data)))
+        self.output.append(fastcgi.asString(data))
+        self.outputSize += len(data)
+        if self.outputSize >= self.outputThreshold:
+            self.flush()
+
+    def write(self, data):
+        if data:
+            self._send(FCGI_STDOUT, data)
+
+    def error(self, data):
+        if data:
+            self._send(FCGI_STDERR, data)
+
+    def sendfile(self, file, offset=0, count=None):
+        '''see FastCGIRequestState.sendfile, the file is read by the
+        worker process
+        '''
+        close = isinstance(file, basestring)
+        if close:
+            file = open(file, 'rb')
+        try:
+            file.seek(offset)
+            while count is None or count > 0:
+                data = file.read(count is None and 65536 or min(count, 65536))
+                if not data:
+                    break
+                self.write(data)
+                if count is not None:
+                    count -= len(data)
+        finally:
+            if close:
+                file.close()
+
+    def flush(self):
+        output = self.output
+        if output:
+            self.output = []
+            self.outputSize = 0
+            _writeAll(self.fd, ''.join(output))
+
+    def end(self, appStatus=0, protocolStatus=FCGI_REQUEST_COMPLETE):
+        if self.ended:
+            return
+        self._send(FCGI_END_REQUEST, _endStruct.pack(appStatus, protocolStatus))
+        self.flush()
+        self.ended = True
+        self.appStatus = appStatus
+
+def _mapFile(path, size):
+    if not size:
+        return None
+    f = open(path, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def serve(handler, jobs, results):
+    '''worker process loop, runs the jobs read from the jobs file
+    descriptor until it is closed
+    '''
+    while 1:
+        try:
+            header = _readExactly(jobs, _jobStruct.size)
+        except EOFError:
+            break
+
+        requestId, role, keepConnection, paramsLength, stdinLength, dataLength, \
+            inputPathLength, dataPathLength = _jobStruct.unpack(header)
+        inputPath = _readExactly(jobs, inputPathLength)
+        dataPath = _readExactly(jobs, dataPathLength)
+
+        maps = []
+        params = fastcgi.FastCGIEnvironment()
+        request = OffloadedRequest(results, requestId, role, bool(keepConnection), params)
+        try:
+            input = _mapFile(inputPath, paramsLength + stdinLength)
+            maps.append(input)
+            if paramsLength:
+                params.feed(input[:paramsLength])
+            params.close()
+
+            events = [(FCGI_PARAMS, None)]
+            if stdinLength:
+                events.append((FCGI_STDIN, buffer(input, paramsLength, stdinLength)))
+            events.append((FCGI_STDIN, None))
+            request.stdinLength = stdinLength
+
+            if role == FCGI_FILTER:
+                data = _mapFile(dataPath, dataLength)
+                maps.append(data)
+                if dataLength:
+                    events.append((FCGI_DATA, buffer(data)))
+                events.append((FCGI_DATA, None))
+                request.dataLength = dataLength
+
+            for type, content in events:
+                request.callCount += 1
+                result = handler(request, type, content)
+                if fastcgi.isIterator(result):
+                    # the pipe to the server takes it as fast as it can
+                    for chunk in result:
+                        request.write(chunk)
+                    break
+                if not result:
+                    break
+            request.end(0)
+        except Exception, err:
+            print 'processpool: exception occurred while handling request id %i, exception: %s' % (
+                requestId, str(err))
+            traceback.print_exc(file=sys.stdout)
+            sys.stdout.flush()
+            request.end(1)
+        finally:
+            for m in maps:
+                if m is not None:
+                    m.close()
+
+def _closeAllBut(*fds):
+    # nothing else of the server, e.g.: connections must be closed
+    # when the server closes them
+    low = 3
+    for fd in sorted(fds):
+        os.closerange(low, fd)
+        low = fd + 1
+    os.closerange(low, _maxfd)
+
+def forkWorker(handler):
+    '''fork a worker process running serve(handler), from a process
+    without threads: the child would inherit the locks other threads
+    hold (e.g.: the import lock or stdout's)
+    '''
+    jobsRead, jobs = os.pipe()
+    results, resultsWrite = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            # children forked by a Spawner are not reaped by it
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            _closeAllBut(jobsRead, resultsWrite)
+            serve(handler, jobsRead, resultsWrite)
+        except:
+            traceback.print_exc(file=sys.stdout)
+            status = 1
+        sys.stdout.flush()
+        os._exit(status)
+
+    os.close(jobsRead)
+    os.close(resultsWrite)
+    return Worker(pid, jobs, results)
+
+class Worker(object):
+    '''a worker process and the pipes to it
+    '''
+
+    def __init__(self, pid, jobs, results):
+        self.pid = pid
+        self.jobs = jobs
+        self.results = results
+
+    def close(self):
+        if self.jobs is not None:
+            os.close(self.jobs)
+            os.close(self.results)
+            self.jobs = self.results = None
+            try:
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+
+class Job(object):
+    '''a request being spooled
+    '''
+
+    def __init__(self, requestState):
+        self.requestState = requestState
+        self.input = tempfile.NamedTemporaryFile(prefix='fcgi-', dir=spoolDir)
+        self.data = None
+        self.done = False           # sent to a worker or aborted
+        self.worker = None          # the worker running it
+        self.cancelled = False
+        self.paramsLength = 0
+        self.stdinLength = 0
+        self.dataLength = 0
+
+        params = ''.join(fastcgi.dictToPairs(requestState.params))
+        self.input.write(params)
+        self.paramsLength = len(params)
+
+        if requestState.role == FCGI_FILTER:
+            self.data = tempfile.NamedTemporaryFile(prefix='fcgi-', dir=spoolDir)
+
+    def complete(self, type):
+        '''true once the streams the worker needs were received
+        '''
+        if self.data:
+            return type == FCGI_DATA
+        return type == FCGI_STDIN
+
+    def append(self, type, content):
+        if type == FCGI_STDIN:
+            self.input.write(content)
+            self.stdinLength += len(content)
+        elif type == FCGI_DATA and self.data:
+            self.data.write(content)
+            self.dataLength += len(content)
+
+    def close(self):
+        self.input.close()
+        if self.data:
+            self.data.close()
+
+    def header(self):
+        self.input.flush()
+        inputPath = self.input.name
+        dataPath = ''
+        if self.data:
+            self.data.flush()
+            dataPath = self.data.name
+        rs = self.requestState
+        return _jobStruct.pack(rs.requestId, rs.role, rs.keepConnection,
+            self.paramsLength, self.stdinLength, self.dataLength,
+            len(inputPath), len(dataPath)) + inputPath + dataPath
+
+class Spawner(object):
+    '''a process forked before any thread is started, forking the
+    workers that replace the failed ones (see forkWorker). spawn()
+    returns them, their pipes passed over a unix socket
+    '''
+
+    def __init__(self, handler):
+        self.lock = threading.Lock()
+        self.sock, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 0
+            try:
+                _closeAllBut(child.fileno())
+                self.serve(handler, child.fileno())
+            except:
+                traceback.print_exc(file=sys.stdout)
+                status = 1
+            sys.stdout.flush()
+            os._exit(status)
+        child.close()
+
+    def serve(self, handler, fd):
+        # forks a worker per byte read, until the server closes the
+        # socket or exits. the workers are reaped as they exit
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        while 1:
+            try:
+                _readExactly(fd, 1)
+            except EOFError:
+                break
+            worker = forkWorker(handler)
+            _writeAll(fd, _pidStruct.pack(worker.pid))
+            sendfd(fd, worker.jobs)
+            sendfd(fd, worker.results)
+            os.close(worker.jobs)
+            os.close(worker.results)
+
+        # the workers left exit as their pipes are closed, they are
+        # reaped before the spawner exits not to be left to init
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        while 1:
+            try:
+                os.waitpid(-1, 0)
+            except OSError, err:
+                if err.errno != errno.EINTR:
+                    break
+
+    def spawn(self):
+        '''a new worker, from any thread
+        '''
+        self.lock.acquire()
+        try:
+            fd = self.sock.fileno()
+            _writeAll(fd, 'w')
+            pid, = _pidStruct.unpack(_readExactly(fd, _pidStruct.size))
+            jobs = recvfd(fd)
+            results = recvfd(fd)
+        finally:
+            self.lock.release()
+        return Worker(pid, jobs, results)
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+class ProcessPool(threadpool.HandlerPool):
+    '''runs handler in processes worker processes for the requests
+    offload(requestState) selects (e.g.: by role or SCRIPT_NAME),
+    the others are dispatched to executor (e.g.: a HandlerPool) or
+    handled in the event loop when it is None. a thread per process
+    feeds it and streams the output back
+    '''
+
+    def __init__(self, processes, callFromThread, handler, offload, executor=None):
+        threadpool.HandlerPool.__init__(self, processes, callFromThread)
+        self.handler = handler
+        self.offload = offload
+        self.executor = executor
+        self.idle = Queue.Queue()       # workers, None once stopping
+        self.spawner = None
+
+    def start(self):
+        # the processes are forked before any thread is started
+        for i in xrange(self.threads):
+            self.idle.put(forkWorker(self.handler))
+        self.spawner = Spawner(self.handler)
+        threadpool.HandlerPool.start(self)
+
+    def stop(self):
+        # threads waiting for a worker give up
+        self.idle.put(None)
+        threadpool.HandlerPool.stop(self)
+        while not self.idle.empty():
+            worker = self.idle.get()
+            if worker is not None:
+                worker.close()
+        if self.spawner is not None:
+            self.spawner.close()
+            self.spawner = None
+        if self.executor:
+            self.executor.stop()
+
+    def dispatch(self, requestState, function, *args):
+        # args end with the record type and content, see
+        # FastCGIProcessor.generateOutput
+        type = args[-2]
+        content = args[-1]
+
+        job = getattr(requestState, 'job', None)
+        if job is None:
+            if type == FCGI_PARAMS and self.offload(requestState):
+                # FCGI_PARAMS is always the first event
+                requestState.job = Job(requestState)
+                requestState.addCancelCallback(self.cancel)
+            elif self.executor:
+                self.executor.dispatch(requestState, function, *args)
+            else:
+                function(*args)
+            return
+
+        if job.done:
+            return
+
+        if type == FCGI_ABORT_REQUEST:
+            job.done = True
+            job.close()
+        elif content is not None:
+            job.append(type, content)
+            requestState.inputHandled(len(content))
+        elif job.complete(type):
+            job.done = True
+            threadpool.HandlerPool.dispatch(self, requestState, self.run, requestState, job)
+
+    def cancel(self, requestState):
+        '''drop the job of a cancelled request, or stop the worker
+        running it, it is replaced
+        '''
+        job = requestState.job
+        self.lock.acquire()
+        try:
+            job.cancelled = True
+            if not job.done:
+                job.done = True
+                job.close()
+            elif job.worker is not None:
+                os.kill(job.worker.pid, signal.SIGKILL)
+        finally:
+            self.lock.release()
+
+    def run(self, requestState, job):
+        '''send job to an idle worker and stream its output back to
+        requestState, runs in a pool thread
+        '''
+        worker = self.idle.get()
+        if worker is None:
+            # stopping
+            self.idle.put(None)
+            requestState.end(1)
+            job.close()
+            return
+        self.lock.acquire()
+        try:
+            if job.cancelled:
+                # before it got a worker
+                self.idle.put(worker)
+                job.close()
+                return
+            job.worker = worker
+        finally:
+            self.lock.release()
+
+        try:
+            _writeAll(worker.jobs, job.header())
+            while 1:
+                type, length = _messageStruct.unpack(_readExactly(worker.results, _messageStruct.size))
+                data = _readExactly(worker.results, length)
+                if type == FCGI_STDOUT:
+                    requestState.write(data)
+                elif type == FCGI_STDERR:
+                    requestState.error(data)
+                else:
+                    appStatus, protocolStatus = _endStruct.unpack(data)
+                    requestState.end(appStatus, protocolStatus)
+                    break
+        except Exception, err:
+            # the worker died (or is out of sync, or its request was
+            # cancelled), the spawner replaces it
+            if not job.cancelled:
+                print 'processpool: worker %i failed while handling request id %i: %r' % (
+                    worker.pid, requestState.requestId, err)
+            worker.close()
+            worker = None
+            requestState.end(1)
+            try:
+                worker = self.spawner.spawn()
+            except Exception, err:
+                print 'processpool: cannot replace a failed worker: %r' % (err,)
+        finally:
+            self.lock.acquire()
+            job.worker = None
+            self.lock.release()
+            if worker is not None:
+                self.idle.put(worker)
+            job.close()
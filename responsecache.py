@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+'''caches whole responses of a handler in memory, already encoded as
+FastCGI records, a hit is written with a single call and the handler
+is not called:
+
+    cache = ResponseCache(handler, maxSize=64 << 20, ttl=60, vary=('HTTP_ACCEPT_ENCODING',))
+    server = selectfcgi.FastCGIServer(sock, cache)
+
+GET and HEAD responses are cached by REQUEST_METHOD, host (HTTP_HOST
+or SERVER_NAME), REQUEST_URI and the params named in vary, when their
+Cache-Control header allows it: for its max-age (or s-maxage) seconds,
+ttl for public ones without either. responses with a status other
+than 200, Set-Cookie, a Vary header naming other request headers than
+vary (or *), output on stderr or from files and iterators (see
+FastCGIRequestState.sendfile and stream) are not cached. requests with
+an Authorization or Cookie header not in vary are only answered with,
+and only cache, public responses. the least recently used responses
+are dropped above maxSize bytes. the cache may be used by the threads
+of a threadpool.HandlerPool
+'''
+
+import time
+import struct
+import threading
+import collections
+
+from fastcgi import FCGI_PARAMS, FCGI_STDOUT, FCGI_HEADER_LEN, LazyRecords, asString
+
+_idStruct = struct.Struct('!H')
+_lengthsStruct = struct.Struct('!BHHB')     # type, request id, content and padding lengths
+
+class _Entry(object):
+
+    def __init__(self, key, response, requestId, expires, public):
+        self.key = key
+        self.response = response        # records, FCGI_END_REQUEST included
+        self.requestId = requestId      # of the records
+        self.expires = expires
+        self.public = public            # Cache-Control public, see hasCredentials
+
+def _records(data):
+    # (type, offset of the header, content length) of the records in data
+    pos = 0
+    end = len(data)
+    while pos < end:
+        type, requestId, contentLength, paddingLength = _lengthsStruct.unpack_from(data, pos + 1)
+        yield type, pos, contentLength
+        pos += FCGI_HEADER_LEN + contentLength + paddingLength
+
+def setRequestId(response, requestId):
+    '''response, encoded records, with their request id changed
+    '''
+    data = bytearray(response)
+    packedId = _idStruct.pack(requestId)
+    for type, pos, contentLength in _records(data):
+        data[pos + 2:pos + 4] = packedId
+    return str(data)
+
+def responseHeaders(response):
+    '''the CGI headers of response, encoded records, as a dict of
+    lowercase names to values
+    '''
+    head = []
+    for type, pos, contentLength in _records(response):
+        if type == FCGI_STDOUT:
+            head.append(response[pos + FCGI_HEADER_LEN:pos + FCGI_HEADER_LEN + contentLength])
+            if '\r\n\r\n' in head[-1] or '\n\n' in head[-1]:
+                break
+    head = ''.join(head).replace('\r\n', '\n').split('\n\n', 1)[0]
+
+    headers = {}
+    for line in head.split('\n'):
+        name, sep, value = line.partition(':')
+        if sep:
+            name = name.strip().lower()
+            if name in headers:
+                headers[name] += ', ' + value.strip()
+            else:
+                headers[name] = value.strip()
+    return headers
+
+def requestKey(request, vary=(), methods=('GET', 'HEAD')):
+    '''(method, host, REQUEST_URI and the values of the params in vary)
+    of request, None if its method is not one of methods
+    '''
+    params = request.params
+    method = params.get('REQUEST_METHOD', 'GET')
+    if method not in methods:
+        return None
+    host = params.get('HTTP_HOST') or params.get('SERVER_NAME', '')
+    return (method, host.lower(), params.get('REQUEST_URI', '')) + tuple([params.get(name) for name in vary])
+
+def hasCredentials(request, vary=()):
+    '''true if request has an Authorization or a Cookie header that is
+    not one of the params in vary, the responses to it may be meant for
+    its user only
+    '''
+    params = request.params
+    for name in ('HTTP_AUTHORIZATION', 'HTTP_COOKIE'):
+        if params.get(name) and name not in vary:
+            return True
+    return False
+
+def cacheControl(headers):
+    '''the Cache-Control directives of headers as a dict of lowercase
+    names to values, None for those without one
+    '''
+    directives = {}
+    for directive in headers.get('cache-control', '').lower().split(','):
+        name, sep, value = directive.strip().partition('=')
+        if name:
+            directives[name] = sep and value.strip('"') or None
+    return directives
+
+def varies(headers, vary):
+    '''true if a response with headers varies on request headers that
+    are not params in vary (see the Vary header)
+    '''
+    for name in headers.get('vary', '').split(','):
+        name = name.strip()
+        if name == '*':
+            return True
+        if name and 'HTTP_' + name.upper().replace('-', '_') not in vary:
+            return True
+    return False
+
+def maxAge(headers, default):
+    '''seconds a response with headers may be cached, default for a
+    public one without max-age, 0 if it may not
+    '''
+    if 'set-cookie' in headers:
+        return 0
+    status = headers.get('status', '200')
+    if not status.startswith('200'):
+        return 0
+
+    directives = cacheControl(headers)
+    if 'no-store' in directives or 'no-cache' in directives or 'private' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return int(directives[name])
+            except (TypeError, ValueError):
+                return 0
+    if 'public' in directives:
+        return default
+    return 0
+
+class ResponseCache(object):
+    '''a handler answering from the cache, calling handler otherwise
+    '''
+
+    methods = ('GET', 'HEAD')
+
+    def __init__(self, handler, maxSize=64 << 20, ttl=60, vary=()):
+        self.handler = handler
+        self.maxSize = maxSize          # bytes of the responses cached
+        self.ttl = ttl                  # seconds, for public responses without max-age
+        self.vary = tuple(vary)         # params the responses depend on
+
+        # handlers may run in threads, the loop thread caches their output
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()   # key -> _Entry, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, request):
+        '''the cache key of request, None if it is not cached
+        '''
+        return requestKey(request, self.vary, self.methods)
+
+    def get(self, key, now, credentials=False):
+        '''the entry answering a request with key, None for a miss,
+        credentials is true for a request with them, see hasCredentials
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry.expires <= now:
+                self.size -= len(entry.response)
+                entry = None
+            if entry is not None:
+                # most recently used
+                self.entries[key] = entry
+                if credentials and not entry.public:
+                    entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+        finally:
+            self.lock.release()
+
+    def put(self, key, response, requestId, now, credentials=False):
+        headers = responseHeaders(response)
+        age = maxAge(headers, self.ttl)
+        if age <= 0 or len(response) > self.maxSize or varies(headers, self.vary):
+            return
+        public = 'public' in cacheControl(headers)
+        if credentials and not public:
+            return
+
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.response)
+            self.entries[key] = _Entry(key, response, requestId, now + age, public)
+            self.size += len(response)
+            while self.size > self.maxSize:
+                key, entry = self.entries.popitem(last=False)
+                self.size -= len(entry.response)
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def __call__(self, request, type, content):
+        if type == FCGI_PARAMS and hasattr(request, 'endWith'):
+            # the first event of a request
+            key = self.key(request)
+            if key is not None:
+                credentials = hasCredentials(request, self.vary)
+                entry = self.get(key, time.time(), credentials)
+                if entry is not None:
+                    request.cacheHit = True
+                    response = entry.response
+                    if entry.requestId != request.requestId:
+                        response = setRequestId(response, request.requestId)
+                    request.endWith(response)
+                    return None
+                self.capture(request, key, credentials)
+        elif request.cacheHit:
+            # answered already
+            return None
+        return self.handler(request, type, content)
+
+    def capture(self, request, key, credentials):
+        # keep a copy of the records request writes, they are cached
+        # once it ends
+        request.writeTransport = _Capture(self, request, key, credentials, request.writeTransport)
+
+class _Capture(object):
+    # the writeTransport of a request whose response may be cached
+
+    def __init__(self, cache, request, key, credentials, writeTransport):
+        self.cache = cache
+        self.request = request
+        self.key = key
+        self.credentials = credentials
+        self.writeTransport = writeTransport
+        self.pieces = []
+        self.size = 0
+
+    def __call__(self, *data):
+        self.writeTransport(*data)
+        pieces = self.pieces
+        if pieces is None:
+            # not cached
+            return
+        for piece in data:
+            if isinstance(piece, LazyRecords):
+                # files and iterators are not kept in memory
+                self.pieces = None
+                return
+            pieces.append(asString(piece))
+            self.size += len(piece)
+
+        request = self.request
+        if self.size > self.cache.maxSize:
+            self.pieces = None
+        elif request.ended:
+            self.pieces = None
+            if not request.appStatus and not request.needCloseStderr:
+                self.cache.put(self.key, ''.join(pieces), request.requestId, time.time(), self.credentials)
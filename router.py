@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+'''dispatches each request to the endpoint of its path and method, a
+router is the handler of the server:
+
+    router = Router()
+
+    @router.route('/users/{id}', methods=('GET',))
+    def user(request, type, content):
+        if type == fastcgi.FCGI_PARAMS:
+            request.write('content-type: text/plain\\r\\n\\r\\n')
+            request.write('user %s\\n' % request.pathArgs['id'])
+        ...
+
+    router.add('/static/{path:path}', files)
+    server = selectfcgi.FastCGIServer(sock, router)
+
+endpoints are handlers, they get all the events of the requests routed
+to them (FCGI_PARAMS, FCGI_STDIN, FCGI_DATA and FCGI_ABORT_REQUEST) and
+return what a handler returns. {name} matches a path segment, {name:path}
+the rest of the path, the values are in request.pathArgs
+
+routes are compiled into a trie of path segments, the paths without
+arguments are found in a dict first, so routing a request takes time
+proportional to the length of its path, not to the number of routes.
+static segments win over {name}, which wins over {name:path}
+'''
+
+import fastcgi
+
+def _split(path):
+    # '/a/b/' -> ['a', 'b'], '/' -> []
+    path = path.strip('/')
+    if not path:
+        return []
+    return path.split('/')
+
+class _Node(object):
+    # a path segment of the trie
+
+    def __init__(self):
+        self.children = {}      # static segment -> node
+        self.param = None       # the {name} child
+        self.paramName = None
+        self.rest = None        # method -> endpoint of {name:path}
+        self.restName = None
+        self.endpoints = None   # method -> endpoint of the path ending here
+
+class Router(object):
+    '''a handler dispatching to the endpoints of the routes added
+    '''
+
+    notFoundResponse = 'Status: 404 Not Found\r\n' \
+        'Content-Type: text/plain\r\n\r\nnot found\n'
+    methodNotAllowedResponse = 'Status: 405 Method Not Allowed\r\nAllow: %s\r\n' \
+        'Content-Type: text/plain\r\n\r\nmethod not allowed\n'
+
+    def __init__(self):
+        self.root = _Node()
+        self.static = {}        # path without arguments -> method -> endpoint
+
+    def add(self, path, endpoint, methods=None):
+        '''route the requests for path (e.g.: '/users/{id}') to endpoint,
+        methods is a list of REQUEST_METHODs, None takes any method
+        '''
+        segments = _split(path)
+        node = self.root
+        static = True
+        for i, segment in enumerate(segments):
+            if segment.startswith('{') and segment.endswith('}'):
+                static = False
+                name = segment[1:-1]
+                if name.endswith(':path'):
+                    if i != len(segments) - 1:
+                        raise ValueError('%r: {%s} must be the last segment' % (path, name))
+                    name = name[:-5]
+                    if node.rest is not None and node.restName != name:
+                        raise ValueError('%r: {%s:path} conflicts with {%s:path}' % (path, name, node.restName))
+                    if node.rest is None:
+                        node.rest = {}
+                        node.restName = name
+                    self._set(node.rest, path, endpoint, methods)
+                    return
+                if node.param is None:
+                    node.param = _Node()
+                    node.paramName = name
+                elif node.paramName != name:
+                    raise ValueError('%r: {%s} conflicts with {%s}' % (path, name, node.paramName))
+                node = node.param
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _Node()
+                node = child
+
+        if node.endpoints is None:
+            node.endpoints = {}
+        self._set(node.endpoints, path, endpoint, methods)
+        if static:
+            # the same dict, as the trie
+            self.static['/' + '/'.join(segments)] = node.endpoints
+
+    def _set(self, endpoints, path, endpoint, methods):
+        for method in methods or (None,):
+            if method in endpoints:
+                raise ValueError('%r is routed already for %s' % (path, method or 'any method'))
+            endpoints[method] = endpoint
+
+    def route(self, path, methods=None):
+        '''a decorator adding the decorated endpoint, see add()
+        '''
+        def decorator(endpoint):
+            self.add(path, endpoint, methods)
+            return endpoint
+        return decorator
+
+    def match(self, path):
+        '''(method -> endpoint, path arguments) of path, (None, None)
+        if no route matches it
+        '''
+        segments = _split(path)
+        endpoints = self.static.get('/' + '/'.join(segments))
+        if endpoints is not None:
+            return endpoints, {}
+        args = {}
+        endpoints = self._match(self.root, segments, 0, args)
+        if endpoints is None:
+            return None, None
+        return endpoints, args
+
+    def _match(self, node, segments, i, args):
+        if i == len(segments):
+            if node.endpoints:
+                return node.endpoints
+            if node.rest is not None:
+                args[node.restName] = ''
+                return node.rest
+            return None
+
+        segment = segments[i]
+        child = node.children.get(segment)
+        if child is not None:
+            endpoints = self._match(child, segments, i + 1, args)
+            if endpoints is not None:
+                return endpoints
+        if node.param is not None:
+            endpoints = self._match(node.param, segments, i + 1, args)
+            if endpoints is not None:
+                args[node.paramName] = segment
+                return endpoints
+        if node.rest is not None:
+            args[node.restName] = '/'.join(segments[i:])
+            return node.rest
+        return None
+
+    def path(self, request):
+        '''the path of request to route
+        '''
+        params = request.params
+        path = params.get('SCRIPT_NAME', '') + params.get('PATH_INFO', '')
+        if not path:
+            path = params.get('REQUEST_URI', '').split('?', 1)[0]
+        return path
+
+    def resolve(self, request):
+        '''the endpoint of request, sets request.pathArgs, None if it
+        was answered with a 404 or a 405
+        '''
+        endpoints, args = self.match(self.path(request))
+        if endpoints is None:
+            request.write(self.notFoundResponse)
+            return None
+
+        method = request.params.get('REQUEST_METHOD', 'GET')
+        endpoint = endpoints.get(method)
+        if endpoint is None and method == 'HEAD':
+            endpoint = endpoints.get('GET')
+        if endpoint is None:
+            endpoint = endpoints.get(None)
+        if endpoint is None:
+            allowed = set(endpoints)
+            if 'GET' in allowed:
+                # answered by the GET endpoint
+                allowed.add('HEAD')
+            request.write(self.methodNotAllowedResponse % ', '.join(sorted(allowed)))
+            return None
+
+        request.pathArgs = args
+        return endpoint
+
+    def __call__(self, request, type, content):
+        if type == fastcgi.FCGI_PARAMS:
+            # the first event of a request
+            request.endpoint = self.resolve(request)
+        endpoint = request.endpoint
+        if endpoint is None:
+            # answered already
+            return None
+        return endpoint(request, type, content)
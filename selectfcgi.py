@@ -9,9 +9,13 @@ import socket
 import _socket
 import errno
 import stat
+import signal
 
 import selectserver
 import fastcgi
+import prefork
+import threadpool
+import processpool
 
 FastCGIConnectionState = fastcgi.FastCGIConnectionState
 
@@ -27,10 +31,57 @@ class FastCGIProtocol(selectserver.Protocol):
         self.server = server
         self.processor = server.fcgiProcessor
         self.connectionState = FastCGIConnectionState(self.disconnect, self.write)
+        self.connectionState.resumeReading = self.checkBackpressure
+        # requests are read while the output of others is sent
+        self.duplex = self.processor.fairOutput
 
     def handleInput(self):
-        self.processor.processRawInput(self.connectionState, self.read(65536))
-        self.processor.generateOutput(self.server.handler)
+        cs = self.connectionState
+        amount = self.readInto(cs.reserveInput(65536))
+        if not amount:
+            # would block or closed by peer, the server knows
+            return
+
+        cs.cork()
+        try:
+            self.processor.processInput(cs, amount)
+            self.processor.generateOutput(self.server.handler)
+        finally:
+            cs.uncork()
+        self.checkBackpressure()
+
+        server = self.server
+        if server.maxRequests and self.processor.requestCount >= server.maxRequests and server.running:
+            # recycle this worker, it exits once its requests are done
+            server.stop()
+
+    def checkBackpressure(self):
+        '''stop reading while the input waiting for the handlers is
+        above the watermarks (see FastCGIConnectionState.readingPaused),
+        unsent output needs none, the server does not read a connection
+        while it has output to send, unless it is duplex, then the output
+        waiting in the scheduler counts
+        '''
+        cs = self.connectionState
+        if cs is None:
+            return
+        if cs.scheduler is not None:
+            cs.setUnsentOutput(len(cs.scheduler))
+        if cs.readingPaused():
+            self.server.pauseReading(self)
+        else:
+            self.server.resumeReading(self)
+
+    def flush(self):
+        selectserver.Protocol.flush(self)
+        if self.duplex:
+            # the output sent may resume reading
+            self.checkBackpressure()
+
+    def idle(self):
+        # no request and no partial record
+        cs = self.connectionState
+        return cs is None or not (cs.requestsPool or cs.inputStart < cs.inputEnd)
 
     def handleDisconnect(self, closedByPeer):
         self.connectionState.cleanup()
@@ -54,6 +105,40 @@ class FastCGIServer(selectserver.Server):
 
     protocol = FastCGIProtocol
 
+    workers = 1             # see runWorkers()
+    maxRequests = 0         # requests a worker handles before exiting, 0 = unlimited
+
+    # handlers run in a pool of this many threads, so blocking ones do
+    # not stall the server, 0 runs them in the server loop
+    threads = 0
+
+    # the requests offload(requestState) selects (e.g.: by role or
+    # SCRIPT_NAME) run the handler in a pool of offloadProcesses
+    # worker processes, for CPU bound handlers
+    offload = None
+    offloadProcesses = 2
+
+    # a fastcgi.CoDelShedder answers requests that waited too long for
+    # a handler thread with a 503, see fastcgi.FastCGIProcessor.shedder
+    shedder = None
+
+    # in seconds, 0 disables: requests are ended with an error once
+    # they take longer than requestTimeout, see also idleTimeout and
+    # writeTimeout of selectserver.Server
+    requestTimeout = 0
+
+    # share the output of multiplexed connections among their requests,
+    # see fastcgi.FastCGIProcessor.fairOutput
+    fairOutput = False
+
+    # a list of fastcgi.Lane, each with its own share of the handler
+    # capacity, see fastcgi.FastCGIProcessor.lanes
+    lanes = None
+
+    # a singleflight.SingleFlight answering identical concurrent
+    # requests at once, see fastcgi.FastCGIProcessor.coalescer
+    coalescer = None
+
     def __init__(self, listensocket, handler):
         '''listensocket can be an integer or a socket object,
            socket is expected to be a non-blocking socket
@@ -96,6 +181,49 @@ class FastCGIServer(selectserver.Server):
                 print 'opening an AF_INET (%r, %i) socket for fastcgi server' % (self.host, self.port)
         return self.serversocket
 
+    def busy(self):
+        for p in self.protocols.itervalues():
+            if p.connectionState and p.connectionState.busy():
+                return True
+        return False
+
     def run(self):
         self.fcgiProcessor = fastcgi.FastCGIProcessor()
-        selectserver.Server.run(self)
+        self.fcgiProcessor.processes = self.workers
+        self.fcgiProcessor.shedder = self.shedder
+        self.fcgiProcessor.requestTimeout = self.requestTimeout
+        self.fcgiProcessor.callLater = self.callLater
+        self.fcgiProcessor.fairOutput = self.fairOutput
+        self.fcgiProcessor.lanes = self.lanes
+        self.fcgiProcessor.coalescer = self.coalescer
+        if self.threads:
+            self.fcgiProcessor.executor = threadpool.HandlerPool(self.threads, self.callFromThread)
+        if self.offload:
+            self.fcgiProcessor.executor = processpool.ProcessPool(self.offloadProcesses,
+                self.callFromThread, self.handler, self.offload, self.fcgiProcessor.executor)
+            # fork the workers before there are connections
+            self.fcgiProcessor.executor.start()
+
+        try:
+            selectserver.Server.run(self)
+        finally:
+            if self.fcgiProcessor.executor:
+                self.fcgiProcessor.executor.stop()
+            for lane in self.lanes or ():
+                lane.stop()
+
+    def runWorker(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        self.run()
+
+    def runWorkers(self, workers, maxRequests=0, maxRSS=0):
+        '''pre-fork mode, opens (or uses the inherited) listening
+        socket and forks workers processes running this server on it,
+        import the handler before so its memory is shared. a worker
+        is replaced after maxRequests requests or when its resident
+        size grows above maxRSS bytes (0 disables them)
+        '''
+        self.createServerSocket()
+        self.workers = workers
+        self.maxRequests = maxRequests
+        prefork.Supervisor(self.runWorker, workers, maxRSS).run()
@@ -8,22 +8,59 @@ by twisted matrix framework)
 # nc -q1 localhost 8030 < file.in > file.out && sha1sum file.in file.out
 
 import sys
+import os
+import time
+import errno
+import fcntl
+import heapq
+import collections
 import select
 import socket
 import signal
 import traceback
 
+# output that is sent with socket.send, anything else sends itself
+_buffertypes = frozenset((str, buffer, bytearray, memoryview))
+
+# scatter-gather output, when the platform has it
+_hasSendmsg = hasattr(socket.socket, 'sendmsg')
+try:
+    _iovmax = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _iovmax = 1024
+
+# errors of non-blocking sockets that are not ready
+_wouldblock = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def _tail(data, offset):
+    # data[offset:] without copying
+    if type(data) is buffer:
+        return buffer(data, offset)
+    return memoryview(data)[offset:]
+
 class Protocol(object):
+    server = None
     sock = None
     address = None
     outputbuffer = None
+    outputoffset = 0            # bytes already sent from outputbuffer[0]
     disconnecting = None        # state after disconnect() transition
+    wouldblock = False          # last read found no more input, for now
+    closedbypeer = False        # last read found the end of input
+    readpaused = False          # not read until resumed, see Server.pauseReading
+    duplex = False              # read while output is pending, see Server.updateInterest
+    lastRead = 0                # Server.now of the last input
+    lastWrite = 0               # Server.now of the last output progress
     
     def __init__(self, sock, address):
         self.sock = sock
         self.address = address
-        self.outputbuffer = None
+        self.outputbuffer = collections.deque()
+        self.outputoffset = 0
         self.disconnecting = False
+        self.wouldblock = False
+        self.closedbypeer = False
+        self.readpaused = False
 
     def handleConnect(self, server):
         '''called after server accepts client connection
@@ -37,17 +74,25 @@ class Protocol(object):
         print 'client disconnected, closed by peer? %s' % closedByPeer
 
     def handleInput(self):
-        '''called when there is data to be read
+        '''called when there is data to be read, should read once,
+        the server calls it again while there is input left
         '''
         read = self.read(16384)
-        print 'read %i bytes, writing back' % len(read)
-        self.write(read)
+        if read:
+            print 'read %i bytes, writing back' % len(read)
+            self.write(read)
 
     def handleSocketError(self, errcode, errmsg):
         '''socket errors
         '''
         print 'socket error code: %i = %s' % (errcode, errmsg)
 
+    def idle(self):
+        '''true while closing the connection loses no work, see
+        Server.idleTimeout
+        '''
+        return True
+
     def handleUnknownException(self, e):
         '''called when a non-socket exception occured in input handling
         '''
@@ -60,57 +105,271 @@ class Protocol(object):
         return self.sock.fileno()
 
     def read(self, amount):
-        '''read protocol data, calling more than once
-        may block
+        '''read protocol data, never blocks, an empty string means
+        that there is no input for now (wouldblock is set) or that
+        the peer closed the connection (closedbypeer is set)
+        '''
+        try:
+            data = self.sock.recv(amount)
+        except socket.error, err:
+            if err.args[0] not in _wouldblock:
+                raise
+            self.wouldblock = True
+            return ''
+
+        if not data:
+            self.closedbypeer = True
+        elif len(data) < amount:
+            # socket buffer was drained, spare a recv only to find that
+            self.wouldblock = True
+        return data
+
+    def readInto(self, buffer):
+        '''read protocol data straight into a writable buffer (e.g.:
+        bytearray or memoryview), returns the amount of bytes read,
+        see read()
         '''
-        return self.sock.recv(amount)
+        try:
+            amount = self.sock.recv_into(buffer)
+        except socket.error, err:
+            if err.args[0] not in _wouldblock:
+                raise
+            self.wouldblock = True
+            return 0
+
+        if not amount:
+            self.closedbypeer = True
+        elif amount < len(buffer):
+            self.wouldblock = True
+        return amount
 
     def write(self, data):
-        '''write protocol data
+        '''write protocol data, besides strings and other bytes-like
+        objects, data may be an object that sends itself through a
+        sendTo(sock) method returning the amount sent and tells how much
+        is left with len() (e.g.: fastcgi.FileRecords)
         '''
-        if self.outputbuffer:
-            # do a fifo
-            if data:
-                self.outputbuffer.append(data)
-           
-            data = ''
-            sent = 0
-            
-            while self.outputbuffer and sent == len(data):
-                data = self.outputbuffer.pop(0)
-                sent = self.sock.send(data)
-            
-            if sent < len(data):
-                self.outputbuffer.insert(0, data[sent:])
-            else:
-                # successfully wrote all output buffer
-                self.outputbuffer = None
-        else:
-            sent = self.sock.send(data)
-            if sent < len(data):
-                self.outputbuffer = [data[sent:]]
+        if data:
+            if not self.outputbuffer and self.server:
+                # the wait for the peer starts now, see Server.writeTimeout
+                self.lastWrite = self.server.now
+            self.outputbuffer.append(data)
+        if self.server and self.server.callingFromThread:
+            # out of the protocol handlers, the server flushes it
+            self.server.touched.add(self)
+        elif self.outputbuffer:
+            self.flush()
 
     def flush(self):
         '''try to flush all pending data, may not send
         all data at once, must be called later if there
         is still data remaining to be sent
         '''
-        data = ''
-        sent = 0
-        while self.outputbuffer and sent == len(data):
-            data = self.outputbuffer.pop(0)
-            sent = self.sock.send(data)
-        if sent < len(data):
-            self.outputbuffer.insert(0, data[sent:])
+        outputbuffer = self.outputbuffer
+        sock = self.sock
+        while outputbuffer:
+            data = outputbuffer[0]
+            if type(data) not in _buffertypes:
+                # sends until it would block
+                if data.sendTo(sock) and self.server:
+                    self.lastWrite = self.server.now
+                if len(data):
+                    return
+                outputbuffer.popleft()
+                continue
+
+            if _hasSendmsg:
+                # gather consecutive buffers in a single call
+                iov = []
+                for data in outputbuffer:
+                    if type(data) not in _buffertypes or len(iov) == _iovmax:
+                        break
+                    iov.append(data)
+            else:
+                iov = [data]
+
+            if self.outputoffset:
+                iov[0] = _tail(iov[0], self.outputoffset)
+
+            try:
+                if len(iov) > 1:
+                    sent = sock.sendmsg(iov)
+                    size = sum(map(len, iov))
+                else:
+                    sent = sock.send(iov[0])
+                    size = len(iov[0])
+            except socket.error, err:
+                if err.args[0] not in _wouldblock:
+                    raise
+                return
+
+            if sent and self.server:
+                self.lastWrite = self.server.now
+
+            # drop what was completely sent, keep an offset into the rest
+            offset = self.outputoffset + sent
+            while outputbuffer and type(outputbuffer[0]) in _buffertypes and offset >= len(outputbuffer[0]):
+                offset -= len(outputbuffer.popleft())
+            self.outputoffset = offset
+
+            if sent < size:
+                # partial send, socket is full
+                return
 
     def disconnect(self):
         '''prepare the protocol to be disconnected
         '''
         self.disconnecting = True
+        if self.server and self.server.callingFromThread:
+            self.server.touched.add(self)
 
     #def __del__(self):
     #    print 'omg, im dying!'
 
+# poller events, same values as poll(2) and epoll(7) use
+READ = 0x001
+WRITE = 0x004
+
+def _interrupted(err):
+    return err.args and err.args[0] == errno.EINTR
+
+class SelectPoller(object):
+    '''select(2) based poller, only for compatibility, it is limited
+    to FD_SETSIZE (usually 1024) file descriptors
+    '''
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events):
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        if events & READ:
+            self.readers.add(fd)
+        else:
+            self.readers.discard(fd)
+        if events & WRITE:
+            self.writers.add(fd)
+        else:
+            self.writers.discard(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout=None):
+        '''returns a list of (fd, events), timeout in seconds or None
+        to wait forever
+        '''
+        try:
+            r, w, _ = select.select(self.readers, self.writers, (), timeout)
+        except (select.error, IOError), err:
+            if _interrupted(err):
+                return []
+            raise
+        return [(fd, READ) for fd in r] + [(fd, WRITE) for fd in w]
+
+    def close(self):
+        self.readers = self.writers = None
+
+class PollPoller(object):
+    '''poll(2) based poller
+    '''
+
+    def __init__(self):
+        self._poll = select.poll()
+
+    def register(self, fd, events):
+        self._poll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            return self._poll.poll(timeout)
+        except (select.error, IOError), err:
+            if _interrupted(err):
+                return []
+            raise
+
+    def close(self):
+        self._poll = None
+
+class EpollPoller(object):
+    '''epoll(7) based poller (linux), level-triggered unless told
+    otherwise, edge-triggered mode requires protocols to read and write
+    until the socket would block
+    '''
+
+    def __init__(self, edgeTriggered=False):
+        self._epoll = select.epoll()
+        self.edgeTriggered = edgeTriggered
+        self.flags = edgeTriggered and select.EPOLLET or 0
+
+    def register(self, fd, events):
+        self._epoll.register(fd, events | self.flags)
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, events | self.flags)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        try:
+            return self._epoll.poll(timeout)
+        except (select.error, IOError), err:
+            if _interrupted(err):
+                return []
+            raise
+
+    def close(self):
+        self._epoll.close()
+
+def createPoller():
+    '''returns the best poller available for this platform
+    '''
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+class DelayedCall(object):
+    '''a call scheduled with Server.callLater
+    '''
+
+    def __init__(self, server, time, function, args):
+        self.server = server
+        self.time = time
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        '''the call will not happen, may be called more than once
+        '''
+        if self.active():
+            self.cancelled = True
+            self.server.cancelledTimers += 1
+
 class Server(object):
 
     host = ''
@@ -119,10 +378,44 @@ class Server(object):
     
     protocol = Protocol
 
+    # a callable returning the poller, e.g.: SelectPoller or
+    # lambda: EpollPoller(edgeTriggered=True)
+    pollerFactory = staticmethod(createPoller)
+
     # a future enchancement would be the ability to listen
     # for various server sockets, but for now, i only need
     # one server socket
     serversocket = None
+
+    poller = None
+    protocols = None            # file descriptor -> protocol
+    interest = None             # file descriptor -> READ, WRITE or 0 (reading paused)
+    edgeTriggered = False       # poller is edge-triggered
+    pending = None
+    running = False             # accepting connections, see stop()
+
+    # see callFromThread()
+    threadCalls = None
+    wakeupfds = None            # self-pipe (read, write) ends
+    callingFromThread = False
+    touched = None
+
+    # reads of a connection per readiness event, so one busy
+    # connection does not starve the others
+    maxReadsPerEvent = 16
+
+    # in seconds, 0 disables: connections idle (see Protocol.idle) for
+    # idleTimeout are closed, and so are the ones whose output does not
+    # progress for writeTimeout (the peer does not read)
+    idleTimeout = 0
+    writeTimeout = 0
+
+    # see callLater()
+    clock = staticmethod(time.time)
+    timers = None               # heap of (time, sequence, DelayedCall)
+    timerSequence = 0
+    cancelledTimers = 0         # cancelled calls still in timers
+    now = 0                     # time of the last poll return
     
     # used for debug
     raiseAllErrors = True
@@ -146,150 +439,377 @@ class Server(object):
         return sock
 
     def numProtocols(self):
-        return len(self._input) - 1
+        return len(self.protocols)
+
+    def busy(self):
+        '''true while there is work in progress, run() only returns
+        after stop() once this is false
+        '''
+        return bool(self.protocols)
+
+    def notify(self, method, *args):
+        '''call a protocol handler, errors are raised or printed
+        as raiseAllErrors and outputTraceback tell
+        '''
+        try:
+            method(*args)
+        except:
+            if self.raiseAllErrors:
+                raise
+            if self.outputTraceback:
+                traceback.print_exc(file=sys.stdout)
+
+    def addProtocol(self, p, events):
+        p.server = self
+        p.lastRead = p.lastWrite = self.now
+        fd = p.fileno()
+        self.protocols[fd] = p
+        self.interest[fd] = events
+        self.poller.register(fd, events)
+        if self.idleTimeout or self.writeTimeout:
+            self.callLater(min(filter(None, (self.idleTimeout, self.writeTimeout))),
+                self.checkTimeouts, p, fd)
+
+    def removeProtocol(self, p):
+        fd = p.fileno()
+        if self.protocols.pop(fd, None) is not None:
+            del self.interest[fd]
+            self.poller.unregister(fd)
+
+    def setInterest(self, p, events):
+        fd = p.fileno()
+        if self.interest[fd] != events:
+            self.interest[fd] = events
+            self.poller.modify(fd, events)
+
+    def updateInterest(self, p):
+        '''wait for what p needs next: its output to drain, more input
+        or nothing while its reading is paused, duplex protocols (e.g.:
+        multiplexed connections) wait for both, they must pause their
+        reading once their output grows too much
+        '''
+        if p.outputbuffer:
+            if p.duplex and not p.readpaused:
+                self.setInterest(p, WRITE | READ)
+            else:
+                self.setInterest(p, WRITE)
+        elif p.readpaused:
+            self.setInterest(p, 0)
+        else:
+            self.setInterest(p, READ)
+
+    def pauseReading(self, p):
+        '''stop reading from p until resumeReading(p), e.g.: its input
+        comes faster than it is handled (a protocol that is not duplex
+        is never read while it has output to send, that throttles the
+        output already)
+        '''
+        if not p.readpaused:
+            p.readpaused = True
+            if self.protocols.get(p.fileno()) is p:
+                self.updateInterest(p)
+
+    def resumeReading(self, p):
+        if p.readpaused:
+            p.readpaused = False
+            if self.protocols.get(p.fileno()) is p:
+                self.updateInterest(p)
+
+    def closeProtocol(self, p, closedByPeer):
+        self.removeProtocol(p)
+        p.sock.close()
+        self.notify(p.handleDisconnect, closedByPeer)
+
+    def callLater(self, delay, function, *args):
+        '''run function(*args) in delay seconds, returns a DelayedCall
+        that may be cancelled, must be called from the event loop thread
+        (use callFromThread to call it from others)
+        '''
+        call = DelayedCall(self, self.clock() + delay, function, args)
+        self.timerSequence += 1
+        timers = self.timers
+        heapq.heappush(timers, (call.time, self.timerSequence, call))
+        if self.cancelledTimers > 64 and self.cancelledTimers * 2 > len(timers):
+            # mostly cancelled calls (e.g.: deadlines of requests that
+            # ended in time), they would wait for their time otherwise
+            timers[:] = [t for t in timers if not t[2].cancelled]
+            heapq.heapify(timers)
+            self.cancelledTimers = 0
+        return call
+
+    def pollTimeout(self):
+        '''seconds until the next timer is due, None if there is none
+        '''
+        timers = self.timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+            self.cancelledTimers -= 1
+        if not timers:
+            return None
+        return max(0, timers[0][0] - self.clock())
+
+    def runTimers(self):
+        timers = self.timers
+        self.now = now = self.clock()
+        while timers and timers[0][0] <= now:
+            call = heapq.heappop(timers)[2]
+            if call.cancelled:
+                self.cancelledTimers -= 1
+                continue
+            call.called = True
+            self.notify(call.function, *call.args)
+
+    def checkTimeouts(self, p, fd):
+        '''close p once its output did not progress for writeTimeout or
+        once it was idle for idleTimeout, see if it was again later
+        otherwise
+        '''
+        if self.protocols.get(fd) is not p:
+            # closed already
+            return
+
+        now = self.now
+        deadline = None
+        if p.outputbuffer:
+            if self.writeTimeout:
+                deadline = p.lastWrite + self.writeTimeout
+        elif self.idleTimeout and p.idle():
+            deadline = max(p.lastRead, p.lastWrite) + self.idleTimeout
+
+        if deadline is None:
+            # busy, or not a concern of the timeouts set
+            self.callLater(min(filter(None, (self.idleTimeout, self.writeTimeout))),
+                self.checkTimeouts, p, fd)
+        elif now >= deadline:
+            self.closeProtocol(p, False)
+        else:
+            self.callLater(deadline - now, self.checkTimeouts, p, fd)
+
+    def callFromThread(self, function, *args):
+        '''run function(*args) in the event loop thread, may be called
+        from any thread (e.g.: handlers running in a thread pool), output
+        written meanwhile is flushed by the event loop, calls are
+        dropped while the server is not running
+        '''
+        wakeupfds = self.wakeupfds
+        if wakeupfds is None:
+            return
+
+        self.threadCalls.append((function, args))
+        try:
+            os.write(wakeupfds[1], 'x')
+        except OSError, err:
+            # a full pipe means a wake up is pending already
+            if err.errno not in _wouldblock:
+                raise
+
+    def runThreadCalls(self):
+        try:
+            while os.read(self.wakeupfds[0], 4096):
+                pass
+        except OSError, err:
+            if err.errno not in _wouldblock:
+                raise
+
+        threadCalls = self.threadCalls
+        self.callingFromThread = True
+        try:
+            while threadCalls:
+                function, args = threadCalls.popleft()
+                self.notify(function, *args)
+        finally:
+            self.callingFromThread = False
+
+        # protocols written or disconnected by the calls wait to be
+        # writable, so sending and closing happen as usual
+        touched = self.touched
+        self.touched = set()
+        for p in touched:
+            try:
+                fd = p.fileno()
+            except socket.error:
+                # closed already
+                continue
+            if self.protocols.get(fd) is p:
+                self.updateInterest(p)
+
+    def handleAccept(self):
+        # accept until the backlog is empty, required by edge-triggered
+        # pollers and by listening sockets shared among processes
+        while 1:
+            try:
+                sock, address = self.serversocket.accept()
+            except socket.error, err:
+                if err.args[0] in _wouldblock or err.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+
+            sock.setblocking(0)
+            p = self.protocol(sock, address)
+            p.handleConnect(self)
+            if p.outputbuffer:
+                self.addProtocol(p, WRITE)
+            elif p.disconnecting:
+                p.sock.close()
+                self.notify(p.handleDisconnect, False)
+            else:
+                self.addProtocol(p, READ)
+
+    def handleReadable(self, s):
+        try:
+            # one read per call, until the socket would block, the
+            # peer closes or the fairness cap is reached
+            s.wouldblock = False
+            s.lastRead = self.now
+            for i in xrange(self.maxReadsPerEvent):
+                s.handleInput()
+                if s.closedbypeer or s.wouldblock or s.disconnecting or s.readpaused \
+                        or (s.outputbuffer and not s.duplex):
+                    break
+            else:
+                if self.edgeTriggered:
+                    # input may be left, the poller will not tell it again
+                    self.pending.add(s.fileno())
+
+            if s.closedbypeer:
+                # client closed connection
+                self.closeProtocol(s, True)
+            elif s.disconnecting and not s.outputbuffer:
+                self.closeProtocol(s, False)
+            else:
+                # input -> output, or paused
+                self.updateInterest(s)
+
+        except socket.error, (errcode, errmsg):
+            self.removeProtocol(s)
+            s.sock.close()
+
+            if self.raiseAllErrors:
+                raise
+            if self.outputTraceback:
+                traceback.print_exc(file=sys.stdout)
+
+            self.notify(s.handleDisconnect, False)
+            self.notify(s.handleSocketError, errcode, errmsg)
+
+        except Exception, e:
+            self.removeProtocol(s)
+            s.sock.close()
+
+            if self.raiseAllErrors:
+                raise
+            if self.outputTraceback:
+                traceback.print_exc(file=sys.stdout)
+
+            self.notify(s.handleDisconnect, False)
+            self.notify(s.handleUnknownException, e)
+
+    def handleWritable(self, s):
+        s.flush()
+        if s.outputbuffer:
+            return
+
+        # output -> input
+        if s.disconnecting:
+            self.closeProtocol(s, False)
+        else:
+            self.updateInterest(s)
 
     def run(self):
         self.serversocket = self.createServerSocket()
         server = self.serversocket
+        serverfd = server.fileno()
+
+        self.poller = poller = self.pollerFactory()
+        self.protocols = protocols = {}
+        self.interest = interest = {}
+
+        # file descriptors that reached the reads cap with input left,
+        # only edge-triggered pollers need it, the others tell them again
+        self.edgeTriggered = getattr(poller, 'edgeTriggered', False)
+        self.pending = pending = set()
+
+        self.timers = timers = []
+        self.cancelledTimers = 0
+        self.now = self.clock()
+
+        self.threadCalls = collections.deque()
+        self.touched = set()
+        self.wakeupfds = os.pipe()
+        for fd in self.wakeupfds:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        wakeupfd = self.wakeupfds[0]
+        poller.register(wakeupfd, READ)
+
+        server.setblocking(0)
+        poller.register(serverfd, READ)
+
+        self.running = True
+        while self.running or self.busy():
+            if pending:
+                ready = poller.poll(0)
+                ready.extend([(fd, READ) for fd in pending if interest.get(fd, 0) & READ])
+                pending.clear()
+            else:
+                ready = poller.poll(self.pollTimeout())
+            self.now = self.clock()
 
-        input = [server]
-        output = []
-        exception = []
-
-        self._input = input
+            for fd, events in ready:
+                if fd == serverfd:
+                    if self.running:
+                        self.handleAccept()
+                    continue
 
-        protocol = self.protocol
+                if fd == wakeupfd:
+                    self.runThreadCalls()
+                    continue
 
-        while 1:
-            inputready, outputready, _ = select.select(input, output, exception)
-
-            for s in inputready:
-
-                if s == server:
-                    p = protocol(*server.accept())
-                    p.handleConnect(self)
-                    if p.outputbuffer:
-                        output.append(p)
-                    elif p.disconnecting:
-                        p.sock.close()
-
-                        try:
-                            p.handleDisconnect(False)
-                        except:
-                            if self.raiseAllErrors:
-                                raise
-                            if self.outputTraceback:
-                                traceback.print_exc(file=sys.stdout)
-
-                    else:
-                        input.append(p)
-                else:
-                    try:
-                        if not s.sock.recv(1, socket.MSG_PEEK):
-                            # client closed connection
-                            input.remove(s)
-                            s.sock.close()
-
-                            try:
-                                s.handleDisconnect(True)
-                            except:
-                                if self.raiseAllErrors:
-                                    raise
-                                if self.outputTraceback:
-                                    traceback.print_exc(file=sys.stdout)
-
-                            continue
-
-                        s.handleInput()
-
-                        if s.outputbuffer:
-                            # input -> output
-                            input.remove(s)
-                            output.append(s)
-                        elif s.disconnecting:
-                            input.remove(s)
-                            s.sock.close()
-
-                            try:
-                                s.handleDisconnect(False)
-                            except:
-                                if self.raiseAllErrors:
-                                    raise
-                                if self.outputTraceback:
-                                    traceback.print_exc(file=sys.stdout)
-                    
-                    except socket.error, (errcode, errmsg):
-                        input.remove(s)
-
-                        if self.raiseAllErrors:
-                            raise
-                        if self.outputTraceback:
-                            traceback.print_exc(file=sys.stdout)
-
-                        try:
-                            s.handleDisconnect(False)
-                        except:
-                            if self.raiseAllErrors:
-                                raise
-                            if self.outputTraceback:
-                                traceback.print_exc(file=sys.stdout)
-
-                        try:
-                            s.handleSocketError(errcode, errmsg)
-                        except:
-                            if self.raiseAllErrors:
-                                raise
-                            if self.outputTraceback:
-                                traceback.print_exc(file=sys.stdout)
-
-                    except Exception, e:
-                        if self.raiseAllErrors:
-                            raise
-                        if self.outputTraceback:
-                            traceback.print_exc(file=sys.stdout)
-
-                        try:
-                            s.handleDisconnect(False)
-                        except:
-                            if self.raiseAllErrors:
-                                raise
-                            if self.outputTraceback:
-                                traceback.print_exc(file=sys.stdout)
-
-                        try:
-                            s.handleUnknownException(e)
-                        except:
-                            if self.raiseAllErrors:
-                                raise
-                            if self.outputTraceback:
-                                traceback.print_exc(file=sys.stdout)
-
-            for s in outputready:
-                s.flush()
-                if s.outputbuffer:
+                s = protocols.get(fd)
+                if s is None:
+                    # closed while handling a previous event
                     continue
-                
-                # output -> input
-                output.remove(s)
-                if s.disconnecting:
-                    s.sock.close()
-
-                    try:
-                        s.handleDisconnect(False)
-                    except:
-                        if self.raiseAllErrors:
-                            raise
-                        if self.outputTraceback:
-                            traceback.print_exc(file=sys.stdout)
 
+                # a protocol either waits for input or for its output
+                # to drain, errors and hangups are found by recv/send
+                wanted = interest[fd]
+                if wanted == WRITE:
+                    self.handleWritable(s)
+                elif wanted == READ:
+                    self.handleReadable(s)
+                elif wanted:
+                    # duplex, both
+                    if events & READ:
+                        self.handleReadable(s)
+                    if events & ~READ and protocols.get(fd) is s and interest[fd] & WRITE:
+                        self.handleWritable(s)
                 else:
-                    input.append(s)
+                    # reading paused, only a hangup or an error is
+                    # reported, nothing can be sent to the peer anymore
+                    self.closeProtocol(s, True)
+
+            if timers:
+                self.runTimers()
 
         # end loop
 
+        for s in protocols.values():
+            self.closeProtocol(s, False)
+
+        wakeupfds = self.wakeupfds
+        self.wakeupfds = None
+        for fd in wakeupfds:
+            os.close(fd)
+
+        poller.close()
         server.close()
 
     def stop(self):
+        '''stop accepting connections, run() returns as soon as the
+        server is not busy, may be called from a signal handler
+        '''
+        if self.running:
+            self.running = False
+            self.poller.unregister(self.serversocket.fileno())
         if self.serversocket:
             self.serversocket.close()
 
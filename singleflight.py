@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+'''answers the identical requests running at once with the output of
+the first one (request collapsing), so a popular response that is not
+cached (e.g.: it just expired from a responsecache.ResponseCache) is
+made once, not once per request waiting for it:
+
+    server = selectfcgi.FastCGIServer(sock, handler)
+    server.coalescer = SingleFlight(maxWait=5)
+
+the first GET or HEAD of a key (see responsecache.requestKey) runs its
+handler, the identical requests arriving before it ends wait, their
+events held, and are ended with a copy of its records, their request
+ids rewritten. requests with an Authorization or Cookie header not in
+vary do not wait, nor are they waited for. the output is kept in
+memory until the first request ends: when it is above maxSize, sent
+from files or iterators (see FastCGIRequestState.sendfile and stream),
+ends with an error or is cancelled, or when it is not to be shared
+(a status other than 200, Set-Cookie, Cache-Control private or
+no-store, or a Vary header naming other request headers than vary),
+the waiting requests run their handler as usual instead, as does each
+of them once it waited for maxWait seconds
+'''
+
+from fastcgi import FCGI_PARAMS, LazyRecords, asString
+from responsecache import requestKey, hasCredentials, responseHeaders, cacheControl, varies, setRequestId
+
+class _Flight(object):
+    # a request running for the identical requests waiting for it
+
+    def __init__(self, key, leader):
+        self.key = key
+        self.leader = leader
+        self.followers = []     # request states, in arrival order
+        self.pieces = []        # the output of leader, None once it is not kept
+        self.size = 0
+
+class SingleFlight(object):
+    '''holds the events of a request while an identical one runs, see
+    fastcgi.FastCGIProcessor.coalescer
+    '''
+
+    methods = ('GET', 'HEAD')
+
+    def __init__(self, maxWait=5, maxSize=1 << 20, vary=()):
+        self.maxWait = maxWait          # seconds a request waits, 0 as long as the first one runs
+        self.maxSize = maxSize          # bytes of output kept for the waiting requests
+        self.vary = tuple(vary)         # params the responses depend on
+
+        self.flights = {}               # key -> _Flight
+        self.held = {}                  # request state -> (processor, handler, event)s
+        self.deadlines = {}             # request state -> call ending its wait
+        self.coalescedCount = 0         # requests answered with the output of another
+        self.fallbackCount = 0          # requests that waited, then ran their handler
+
+    def key(self, request):
+        '''the key of the requests request is identical to, None if it
+        does not wait for them
+        '''
+        return requestKey(request, self.vary, self.methods)
+
+    def dispatch(self, processor, handler, item):
+        '''true if the event of item, a (requestState, type, content)
+        tuple, is held or dropped, false if processor handles it as usual
+        '''
+        requestState = item[0]
+        held = self.held.get(requestState)
+        if held is not None:
+            held.append((processor, handler, item))
+            return True
+        if requestState.coalesced:
+            # answered already
+            return True
+        if item[1] != FCGI_PARAMS or not hasattr(requestState, 'endWith'):
+            return False
+
+        # the first event of a request
+        key = self.key(requestState)
+        if key is None or hasCredentials(requestState, self.vary):
+            return False
+        flight = self.flights.get(key)
+        if flight is None:
+            self.start(requestState, key)
+            return False
+        flight.followers.append(requestState)
+        self.held[requestState] = [(processor, handler, item)]
+        if self.maxWait and processor.callLater:
+            self.deadlines[requestState] = processor.callLater(self.maxWait, self.giveUp, flight, requestState)
+        return True
+
+    def start(self, requestState, key):
+        # requestState runs for the identical requests arriving meanwhile
+        flight = self.flights[key] = _Flight(key, requestState)
+        requestState.writeTransport = _Fanout(self, flight, requestState.writeTransport)
+        requestState.addCancelCallback(lambda requestState: self.release(flight))
+
+    def land(self, flight):
+        # flight is over, identical requests arriving from now on
+        # start another one
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+        flight.pieces = None
+        followers = flight.followers
+        flight.followers = []
+        for requestState in followers:
+            deadline = self.deadlines.pop(requestState, None)
+            if deadline is not None:
+                deadline.cancel()
+        return followers
+
+    def shared(self, response):
+        '''true if response, encoded records, may answer other requests
+        than the one it was made for
+        '''
+        headers = responseHeaders(response)
+        if 'set-cookie' in headers or not headers.get('status', '200').startswith('200'):
+            return False
+        directives = cacheControl(headers)
+        if 'private' in directives or 'no-store' in directives:
+            return False
+        return not varies(headers, self.vary)
+
+    def answer(self, flight):
+        '''end the requests waiting for flight with its output
+        '''
+        response = ''.join(flight.pieces)
+        if not self.shared(response):
+            self.release(flight)
+            return
+        requestId = flight.leader.requestId
+        for requestState in self.land(flight):
+            del self.held[requestState]
+            requestState.coalesced = True
+            if requestState.ended:
+                # aborted or lost while waiting
+                continue
+            self.coalescedCount += 1
+            if requestState.requestId != requestId:
+                requestState.endWith(setRequestId(response, requestState.requestId))
+            else:
+                requestState.endWith(response)
+
+    def release(self, flight):
+        '''the requests waiting for flight run their handler
+        '''
+        for requestState in self.land(flight):
+            self.fallBack(requestState)
+
+    def giveUp(self, flight, requestState):
+        # requestState waited for maxWait seconds
+        del self.deadlines[requestState]
+        flight.followers.remove(requestState)
+        self.fallBack(requestState)
+
+    def fallBack(self, requestState):
+        # requestState runs its handler
+        events = self.held.pop(requestState)
+        if requestState.ended:
+            # it never ran, nothing to tell its handler (e.g.: an abort)
+            return
+        self.fallbackCount += 1
+        for processor, handler, item in events:
+            processor.dispatchEvent(handler, item)
+
+class _Fanout(object):
+    # the writeTransport of a request others wait for
+
+    def __init__(self, coalescer, flight, writeTransport):
+        self.coalescer = coalescer
+        self.flight = flight
+        self.writeTransport = writeTransport
+
+    def __call__(self, *data):
+        self.writeTransport(*data)
+        flight = self.flight
+        pieces = flight.pieces
+        if pieces is None:
+            # nobody waits for it anymore
+            return
+        for piece in data:
+            if isinstance(piece, LazyRecords):
+                # files and iterators are not kept in memory
+                self.coalescer.release(flight)
+                return
+            pieces.append(asString(piece))
+            flight.size += len(piece)
+
+        request = flight.leader
+        if flight.size > self.coalescer.maxSize:
+            self.coalescer.release(flight)
+        elif request.ended:
+            if request.appStatus:
+                self.coalescer.release(flight)
+            else:
+                self.coalescer.answer(flight)
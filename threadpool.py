@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+'''runs FastCGI handlers in a pool of threads, so a handler blocking
+(e.g.: on a database) does not stall the event loop and the other
+requests (see fastcgi.FastCGIProcessor.executor)
+
+handlers run in the pool threads, but the output of a request is
+written by the event loop thread only, through the callFromThread
+function the loop provides (e.g.: selectserver.Server.callFromThread
+or twisted's reactor.callFromThread). request.drain() blocks the
+calling thread until the transport takes more output and returns None,
+instead of the Deferred or future the event loop would get. the
+iterators handlers return (see FastCGIRequestState.stream) are pulled
+by the thread that ran the handler, so they may block too
+'''
+
+import sys
+import thread
+import threading
+import traceback
+import collections
+import Queue
+
+class HandlerPool(object):
+    '''a fixed number of threads running dispatched calls, the calls
+    of a request run one at a time and in the order they were
+    dispatched (e.g.: FCGI_PARAMS, the FCGI_STDIN chunks and then its
+    end), calls of different requests run concurrently
+    '''
+
+    drainWait = 1               # seconds between the checks of a waiting drain() for stop()
+
+    def __init__(self, threads, callFromThread):
+        self.threads = threads
+        self.callFromThread = callFromThread
+        self.workers = []
+        self.loopThread = None
+        self.stopping = False
+
+        self.ready = Queue.Queue()      # requests with calls to run
+        self.lock = threading.Lock()
+        self.pending = {}               # request state -> deque of calls
+        self.draining = set()           # events the drain() calls of threads wait for
+
+    def start(self):
+        '''start the threads, dispatch() calls it, the calling thread
+        is taken as the event loop thread
+        '''
+        self.loopThread = thread.get_ident()
+        self.stopping = False
+        for i in xrange(self.threads):
+            t = threading.Thread(target=self.work, name='fastcgi-handler-%i' % i)
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(t)
+
+    def stop(self):
+        '''stop the threads once the calls already dispatched are done,
+        the threads waiting in drain() return (the event loop may not
+        run anymore)
+        '''
+        self.lock.acquire()
+        try:
+            self.stopping = True
+            for drained in self.draining:
+                drained.set()
+        finally:
+            self.lock.release()
+        for t in self.workers:
+            self.ready.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+
+    def dispatch(self, requestState, function, *args):
+        '''run function(*args) in a thread, after the previous calls
+        dispatched for requestState, must be called from the event loop
+        '''
+        if not self.workers:
+            self.start()
+
+        self.lock.acquire()
+        try:
+            calls = self.pending.get(requestState)
+            if calls is not None:
+                # a thread is on it already
+                calls.append((function, args))
+                return
+            self.pending[requestState] = collections.deque([(function, args)])
+        finally:
+            self.lock.release()
+
+        if not hasattr(requestState, 'pool'):
+            self.bind(requestState)
+        self.ready.put(requestState)
+
+    def bind(self, requestState):
+        # the request state methods that reach the connection run in
+        # the event loop thread, whatever thread calls them
+        requestState.pool = self
+        for name in ('writeTransport', 'flush', 'end', 'endWith', 'inputHandled'):
+            setattr(requestState, name, self.marshal(requestState, getattr(requestState, name)))
+        requestState.drain = self.marshalDrain(requestState, requestState.drain)
+        requestState.stream = self.marshalStream(requestState, requestState.stream)
+
+    def marshal(self, requestState, method):
+        def call(*args):
+            if thread.get_ident() == self.loopThread:
+                method(*args)
+            else:
+                self.callFromThread(self.calledFromThread, requestState, method, args)
+        return call
+
+    def marshalDrain(self, requestState, drain):
+        # a thread cannot wait on the Deferred or future drain returns,
+        # it waits for an event set once it fires, or once the pool
+        # stops
+        def call():
+            if thread.get_ident() == self.loopThread:
+                return drain()
+            drained = threading.Event()
+            self.lock.acquire()
+            try:
+                if self.stopping:
+                    return
+                self.draining.add(drained)
+            finally:
+                self.lock.release()
+            try:
+                self.callFromThread(self.drainFromThread, requestState, drain, drained)
+                while not drained.isSet() and not self.stopping:
+                    drained.wait(self.drainWait)
+            finally:
+                self.lock.acquire()
+                self.draining.discard(drained)
+                self.lock.release()
+        return call
+
+    def marshalStream(self, requestState, stream):
+        # the event loop would pull the iterator, the thread does
+        def call(iterator):
+            if thread.get_ident() == self.loopThread:
+                stream(iterator)
+            else:
+                self.pull(requestState, iterator)
+        return call
+
+    def pull(self, requestState, iterator):
+        '''write the chunks iterator yields as the transport takes them
+        and end requestState, in the calling thread
+        '''
+        if requestState.ended or requestState.streaming:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            return
+
+        requestState.streaming = True
+        try:
+            for chunk in iterator:
+                if requestState.ended or self.stopping:
+                    # aborted, or the event loop may be gone
+                    break
+                requestState.write(chunk)
+                requestState.drain()
+            else:
+                requestState.end(0)
+        except Exception, err:
+            print 'processor: exception occurred while streaming request id %i, exception: %s' % (
+                requestState.requestId, str(err))
+            traceback.print_exc(file=sys.stdout)
+            requestState.end(1)
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+    def drainFromThread(self, requestState, drain, drained):
+        waiter = None
+        try:
+            if not requestState.ended:
+                waiter = drain()
+        finally:
+            if hasattr(waiter, 'addBoth'):
+                waiter.addBoth(lambda result: drained.set())
+            elif hasattr(waiter, 'add_done_callback'):
+                waiter.add_done_callback(lambda future: drained.set())
+            else:
+                drained.set()
+
+    def calledFromThread(self, requestState, method, args):
+        if not requestState.ended:
+            # output of ended (e.g.: aborted) requests is dropped
+            method(*args)
+
+    def work(self):
+        while 1:
+            requestState = self.ready.get()
+            if requestState is None:
+                break
+
+            # run the calls of this request until there are none left,
+            # calls dispatched meanwhile are run by this thread too
+            while 1:
+                self.lock.acquire()
+                try:
+                    calls = self.pending[requestState]
+                    if not calls:
+                        del self.pending[requestState]
+                        break
+                    function, args = calls.popleft()
+                finally:
+                    self.lock.release()
+
+                try:
+                    function(*args)
+                except:
+                    traceback.print_exc(file=sys.stdout)
@@ -3,44 +3,356 @@
 '''a low-level fastcgi server using only twisted core
 '''
 
+import sys
+import socket
+import signal
+import collections
+
 import twisted.internet.protocol as protocol
+import twisted.internet.interfaces as interfaces
+import twisted.internet.defer as defer
+import twisted.python.failure as failure
+import zope.interface
 import fastcgi
+import prefork
+import threadpool
+import processpool
 
 FastCGIConnectionState = fastcgi.FastCGIConnectionState
+LazyRecords = fastcgi.LazyRecords
+isIterator = fastcgi.isIterator
+asString = fastcgi.asString
+
+class DeferredExecutor(object):
+    '''calls handlers in the reactor thread, a handler may return a
+    Deferred, the request goes on when it fires, as if the handler
+    returned its result, the next events of the request wait for it
+    (see fastcgi.FastCGIProcessor.executor)
+    '''
+
+    def __init__(self):
+        self.waiting = {}       # request state -> events waiting for its Deferred
+
+    def dispatch(self, requestState, function, *args):
+        # args are the handler and its arguments
+        handler, requestState, type, content = args
+        waiting = self.waiting.get(requestState)
+        if waiting is not None:
+            waiting.append((handler, type, content))
+        else:
+            self.call(handler, requestState, type, content)
+
+    def stop(self):
+        pass
+
+    def call(self, handler, requestState, type, content):
+        requestState.callCount += 1
+        if content:
+            requestState.inputHandled(len(content))
+        if requestState.streaming or requestState.shed or requestState.dropped:
+            # see FastCGIProcessor.callHandler
+            return
+        if requestState.cancelled and type != fastcgi.FCGI_ABORT_REQUEST:
+            return
+        try:
+            result = handler(requestState, type, content)
+        except Exception:
+            self.failed(failure.Failure(), requestState)
+            return
+
+        if isinstance(result, defer.Deferred):
+            self.waiting[requestState] = collections.deque()
+            result.addCallbacks(self.done, self.failed,
+                callbackArgs=(requestState,), errbackArgs=(requestState,))
+            if not result.called:
+                # e.g.: the query of a request whose client went away
+                requestState.addCancelCallback(lambda requestState: result.cancel())
+        elif isIterator(result):
+            requestState.stream(result)
+        elif not result:
+            requestState.end(0)
+
+    def done(self, result, requestState):
+        waiting = self.waiting.pop(requestState)
+        if isIterator(result):
+            requestState.stream(result)
+        elif not result:
+            requestState.end(0)
+
+        while waiting:
+            handler, type, content = waiting.popleft()
+            self.call(handler, requestState, type, content)
+            if requestState in self.waiting:
+                # another Deferred, the rest waits for it
+                self.waiting[requestState].extend(waiting)
+                break
 
-def _w2(w1, w2, d):
-    w1(d)
-    w2(d)
+    def failed(self, reason, requestState):
+        self.waiting.pop(requestState, None)
+        if requestState.cancelled and reason.check(defer.CancelledError):
+            return
+        print 'processor: exception occurred while handling request id %i, exception: %s' % (
+            requestState.requestId, reason.getErrorMessage())
+        reason.printTraceback(file=sys.stdout)
+        requestState.end(1)
 
+@zope.interface.implementer(interfaces.IPushProducer)
 class FastCGIProtocol(protocol.Protocol):
-    '''handles a connection with the web server
+    '''handles a connection with the web server, it is the streaming
+    producer of its transport: file output and the handlers waiting on
+    request.drain() are paused while the transport buffer is full, and
+    so is reading, as while the input waiting for the handlers is above
+    the watermarks (see FastCGIConnectionState.readingPaused)
     '''
 
     def connectionMade(self):
+        self.factory.connections.add(self)
         self.processor = self.factory.fcgiProcessor
-        write0 = self.transport.write
+        self.paused = False
+        self.readPaused = False
+        self.drainWaiters = []
+        self.pendingOutput = collections.deque()    # output behind LazyRecords
+        self.closing = False
+        self.connectionState = FastCGIConnectionState(self.loseConnection, self.write,
+            self.writeSequence, self.drain)
+        self.connectionState.resumeReading = self.checkBackpressure
+        self.transport.registerProducer(self, True)
+
+    def writeData(self, data):
+        # large output may come as bytes-like slices, twisted only
+        # takes strings
+        data = asString(data)
         if self.factory.dumpfile:
-            write1 = self.factory.dumpfile.write
-            write = lambda data: _w2(write1, write0, data)
+            self.factory.dumpfile.write(data)
+        self.transport.write(data)
+
+    def write(self, data):
+        if self.pendingOutput or isinstance(data, LazyRecords):
+            # files are read a record at a time, while not paused
+            self.pendingOutput.append(data)
+            self.writePending()
         else:
-            write = write0
-        self.connectionState = FastCGIConnectionState(self.transport.loseConnection, write)
+            self.writeData(data)
+
+    def writeSequence(self, pieces):
+        if self.pendingOutput:
+            self.pendingOutput.extend(pieces)
+            return
+        pieces = map(asString, pieces)
+        if self.factory.dumpfile:
+            self.factory.dumpfile.write(''.join(pieces))
+        self.transport.writeSequence(pieces)
+
+    def writePending(self):
+        pendingOutput = self.pendingOutput
+        while pendingOutput and not self.paused:
+            data = pendingOutput[0]
+            if isinstance(data, LazyRecords):
+                # the transport pauses us once its buffer is full
+                self.writeData(data.read())
+                if len(data):
+                    continue
+                data.done()
+            else:
+                self.writeData(data)
+            pendingOutput.popleft()
+
+        if self.closing and not pendingOutput:
+            self.transport.unregisterProducer()
+            self.transport.loseConnection()
+
+    def loseConnection(self):
+        # with pending output, the connection is closed once it is written
+        self.closing = True
+        if not self.pendingOutput:
+            self.transport.unregisterProducer()
+            self.transport.loseConnection()
+
+    def drain(self):
+        '''a Deferred fired once the transport takes more output
+        '''
+        if self.connectionState:
+            # corked output counts
+            self.connectionState.flush()
+        if self.paused and self.connectionState:
+            d = defer.Deferred()
+            self.drainWaiters.append(d)
+            return d
+        return defer.succeed(None)
+
+    def wakeDrainWaiters(self):
+        drainWaiters = self.drainWaiters
+        self.drainWaiters = []
+        for d in drainWaiters:
+            d.callback(None)
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self.paused = True
+        self.checkBackpressure()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.writePending()
+        if not self.paused:
+            self.wakeDrainWaiters()
+        self.checkBackpressure()
+
+    def checkBackpressure(self):
+        cs = self.connectionState
+        if cs is None:
+            return
+        if cs.scheduler is not None:
+            # output waits in the scheduler, the other requests of the
+            # connection are still read
+            cs.setUnsentOutput(len(cs.scheduler))
+            paused = cs.readingPaused()
+        else:
+            paused = cs.readingPaused() or self.paused
+        if paused != self.readPaused:
+            self.readPaused = paused
+            if paused:
+                self.transport.pauseProducing()
+            else:
+                self.transport.resumeProducing()
+
+    def stopProducing(self):
+        for data in self.pendingOutput:
+            if isinstance(data, LazyRecords):
+                data.done()
+        self.pendingOutput.clear()
 
     def dataReceived(self, data):
-        self.processor.processRawInput(self.connectionState, data)
-        self.processor.generateOutput(self.factory.handler)
+        cs = self.connectionState
+        cs.cork()
+        try:
+            self.processor.processRawInput(cs, data)
+            self.processor.generateOutput(self.factory.handler)
+        finally:
+            cs.uncork()
+        self.checkBackpressure()
+
+        factory = self.factory
+        if factory.maxRequests and self.processor.requestCount >= factory.maxRequests and factory.stopWorker:
+            # recycle this worker, it exits once its requests are done
+            factory.stopWorker()
 
     def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        self.stopProducing()
         self.connectionState.cleanup()
         self.connectionState = None
         self.processor = None
+        # writes of waiting handlers are dropped from now on
+        self.wakeDrainWaiters()
 
 class FastCGIFactory(protocol.Factory):
     protocol = FastCGIProtocol
 
-    def __init__(self, handler, dumpfile=None):
+    processes = 1           # see runWorkers()
+    maxRequests = 0         # requests a worker handles before exiting, 0 = unlimited
+    stopWorker = None
+    shedder = None          # see fastcgi.FastCGIProcessor.shedder
+    requestTimeout = 0      # see fastcgi.FastCGIProcessor.requestTimeout
+    fairOutput = False      # see fastcgi.FastCGIProcessor.fairOutput
+    lanes = None            # see fastcgi.FastCGIProcessor.lanes
+    coalescer = None        # see fastcgi.FastCGIProcessor.coalescer
+
+    def __init__(self, handler, dumpfile=None, threads=0, offload=None, offloadProcesses=2):
+        '''handlers run in the reactor thread and may return a Deferred
+        (see DeferredExecutor), threads greater than 0 runs them in a
+        pool of that many threads instead, the requests
+        offload(requestState) selects run the handler in a pool of
+        offloadProcesses worker processes (see selectfcgi.FastCGIServer)
+        '''
         self.handler = handler
         self.dumpfile = dumpfile
+        self.threads = threads
+        self.offload = offload
+        self.offloadProcesses = offloadProcesses
+        self.connections = set()
 
     def startFactory(self):
         self.fcgiProcessor = fastcgi.FastCGIProcessor()
+        self.fcgiProcessor.processes = self.processes
+        self.fcgiProcessor.shedder = self.shedder
+        self.fcgiProcessor.fairOutput = self.fairOutput
+        self.fcgiProcessor.lanes = self.lanes
+        self.fcgiProcessor.coalescer = self.coalescer
+        if self.threads or self.offload or self.requestTimeout or self.coalescer:
+            import twisted.internet.reactor as reactor
+        if self.requestTimeout or self.coalescer:
+            # also for coalescer.maxWait
+            self.fcgiProcessor.requestTimeout = self.requestTimeout
+            self.fcgiProcessor.callLater = reactor.callLater
+        if self.threads:
+            self.fcgiProcessor.executor = threadpool.HandlerPool(self.threads, reactor.callFromThread)
+        else:
+            self.fcgiProcessor.executor = DeferredExecutor()
+        if self.offload:
+            self.fcgiProcessor.executor = processpool.ProcessPool(self.offloadProcesses,
+                reactor.callFromThread, self.handler, self.offload, self.fcgiProcessor.executor)
+            self.fcgiProcessor.executor.start()
+
+    def stopFactory(self):
+        if self.fcgiProcessor.executor:
+            self.fcgiProcessor.executor.stop()
+        for lane in self.lanes or ():
+            lane.stop()
+
+    def busy(self):
+        for p in self.connections:
+            # closing connections may still have output to flush
+            if p.closing or p.connectionState.busy():
+                return True
+        return False
+
+def _socketFamily(sock):
+    # socket.fromfd does not tell the real family
+    name = sock.getsockname()
+    if isinstance(name, str):
+        return socket.AF_UNIX
+    if len(name) == 4:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+def runWorkers(factory, listensocket, workers, maxRequests=0, maxRSS=0):
+    '''pre-fork mode, forks workers processes that serve factory on
+    listensocket (a listening socket or its file descriptor, e.g.:
+    fastcgi.FCGI_LISTENSOCK_FILENO), see selectfcgi.FastCGIServer.runWorkers.
+    twisted.internet.reactor must not be imported before, each worker
+    installs its own
+    '''
+    if isinstance(listensocket, int):
+        listensocket = socket.fromfd(listensocket, socket.AF_INET, socket.SOCK_STREAM)
+    family = _socketFamily(listensocket)
+    # adoptStreamPort wants it non-blocking, so workers don't block in accept
+    listensocket.setblocking(0)
+
+    factory.processes = workers
+    factory.maxRequests = maxRequests
+
+    def worker():
+        import twisted.internet.reactor as reactor
+        import twisted.internet.task as task
+
+        port = reactor.adoptStreamPort(listensocket.fileno(), family, factory)
+
+        def stop():
+            if factory.stopWorker is None:
+                return
+            factory.stopWorker = None
+            # not stopListening(), it would unlink a shared unix socket
+            port.stopReading()
+
+            def check():
+                if not factory.busy():
+                    reactor.stop()
+            task.LoopingCall(check).start(0.1)
+
+        factory.stopWorker = stop
+        signal.signal(signal.SIGTERM, lambda signum, frame: reactor.callFromThread(stop))
+        reactor.run(installSignalHandlers=False)
+
+    prefork.Supervisor(worker, workers, maxRSS).run()